@@ -0,0 +1,188 @@
+from typing import Dict, List, Optional
+
+import hashlib
+import os
+import shutil
+import threading
+
+
+PLACEHOLDER = '###'
+
+# the size of the blocks used when hashing or copying the body of an a3m file
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_a3m_template(filepath:str) -> Dict:
+    """
+    This function will parse an experiment a3m file once, recording where the header, query placeholder and shared body are so that per structure a3m files can be streamed from it.
+
+    The experiment a3m files look like:
+        #274,99,9	1,1,1
+        ###
+        >hla_b_27_09	beta2m	grfaaaiak
+        GSHSMRYF...
+
+    Args:
+        filepath (str): The path to the experiment a3m file
+
+    Returns:
+        template (Dict): A dictionary with the following keys
+            filepath (str): The path to the experiment a3m file
+            header (str): The '#' header line without its newline, or None if there isn't one
+            chain_lengths (List[int]): The chain lengths from the header e.g. [274, 99, 9]
+            cardinalities (List[int]): The chain cardinalities from the header e.g. [1, 1, 1]
+            body_offset (int): The byte offset of the first line after the placeholder
+            body_size (int): The size of the body in bytes
+            body_digest (str): The sha256 digest of the body
+            depth (int): The number of sequences in the body
+    """
+    header = None
+    body_offset = None
+    with open(filepath, 'rb') as a3m_file:
+        while True:
+            line = a3m_file.readline()
+            if not line:
+                break
+            stripped = line.rstrip(b'\r\n').decode()
+            if stripped == PLACEHOLDER:
+                body_offset = a3m_file.tell()
+                break
+            elif stripped.startswith('#') and header is None:
+                header = stripped
+            elif stripped.startswith('>'):
+                break
+        if body_offset is None:
+            raise ValueError(f"No '{PLACEHOLDER}' query placeholder found before the first sequence in {filepath}")
+
+        # we'll hash the body as we go so that identical bodies can be recognised without comparing the files
+        body_hash = hashlib.sha256()
+        body_size = 0
+        depth = 0
+        previous_character = b'\n'
+        for block in iter(lambda: a3m_file.read(BLOCK_SIZE), b''):
+            body_hash.update(block)
+            body_size += len(block)
+            # each sequence starts with a '>' at the start of a line, which may be the first character of the block
+            depth += block.count(b'\n>') + (1 if previous_character == b'\n' and block[:1] == b'>' else 0)
+            previous_character = block[-1:]
+
+    chain_lengths = []
+    cardinalities = []
+    if header is not None:
+        fields = header[1:].split('\t')
+        chain_lengths = [int(length) for length in fields[0].split(',')]
+        if len(fields) > 1:
+            cardinalities = [int(cardinality) for cardinality in fields[1].split(',')]
+
+    return {
+        'filepath': filepath,
+        'header': header,
+        'chain_lengths': chain_lengths,
+        'cardinalities': cardinalities,
+        'body_offset': body_offset,
+        'body_size': body_size,
+        'body_digest': body_hash.hexdigest(),
+        'depth': depth
+    }
+
+
+def render_a3m_prefix(template:Dict, query_sequence:str, chain_lengths:Optional[List[int]]=None) -> bytes:
+    """
+    This function will create the part of a per structure a3m file that comes before the shared body, the header followed by the query sequence.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        query_sequence (str): The concatenated sequence of the structure to predict
+        chain_lengths (List[int]): The chain lengths of the query, if given the header is rewritten with them
+
+    Returns:
+        prefix (bytes): The header and query lines
+    """
+    header = template['header']
+    if header is not None and chain_lengths is not None and chain_lengths != template['chain_lengths']:
+        header = f"#{','.join(str(length) for length in chain_lengths)}\t{','.join(str(cardinality) for cardinality in template['cardinalities'])}"
+    query_header = '\t'.join(str(101 + chain) for chain in range(max(len(template['chain_lengths']), 1)))
+    prefix = f">{query_header}\n{query_sequence}\n"
+    if header is not None:
+        prefix = f"{header}\n{prefix}"
+    return prefix.encode()
+
+
+def copy_body(template:Dict, destination) -> None:
+    """
+    This function will append the shared body of the template to an open file, using copy_file_range so the copy stays in the kernel (and is a reflink on filesystems that support it).
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        destination (file): The binary file object to append the body to
+    """
+    destination.flush()
+    with open(template['filepath'], 'rb') as source:
+        offset = template['body_offset']
+        remaining = template['body_size']
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining, offset)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+        except (AttributeError, OSError):
+            # copy_file_range isn't available on every platform or filesystem, so we'll fall back to a buffered copy of whatever is left
+            source.seek(offset)
+            shutil.copyfileobj(source, destination, BLOCK_SIZE)
+            return
+    destination.seek(0, os.SEEK_END)
+
+
+def write_a3m_from_template(template:Dict, query_sequence:str, filepath:str, chain_lengths:Optional[List[int]]=None, store_folder:Optional[str]=None) -> str:
+    """
+    This function will write a per structure a3m file from a parsed template, as the header, the query and the shared body, without reading the body into memory.
+
+    If a store folder is given the file is written once into a content addressed store and hard linked into place, so identical queries share the same file on disk.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        query_sequence (str): The concatenated sequence of the structure to predict
+        filepath (str): The path to write the a3m file to
+        chain_lengths (List[int]): The chain lengths of the query, if given the header is rewritten with them
+        store_folder (str): An optional folder to use as a content addressed store of rendered a3m files
+
+    Returns:
+        digest (str): The sha256 digest identifying the contents of the a3m file
+    """
+    prefix = render_a3m_prefix(template, query_sequence, chain_lengths)
+    digest = hashlib.sha256(prefix + template['body_digest'].encode()).hexdigest()
+
+    if store_folder is None:
+        write_a3m_file(template, prefix, filepath)
+        return digest
+
+    store_filepath = f"{store_folder}/{digest[:2]}/{digest}.a3m"
+    if not os.path.exists(store_filepath):
+        os.makedirs(os.path.dirname(store_filepath), exist_ok=True)
+        write_a3m_file(template, prefix, store_filepath)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    try:
+        os.link(store_filepath, filepath)
+    except OSError:
+        # hard links don't work across filesystems, so we'll copy instead
+        shutil.copyfile(store_filepath, filepath)
+    return digest
+
+
+def write_a3m_file(template:Dict, prefix:bytes, filepath:str) -> None:
+    """
+    This function will write an a3m file atomically, so that a crash part of the way through never leaves a truncated file behind.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        prefix (bytes): The header and query lines
+        filepath (str): The path to write the a3m file to
+    """
+    tmp_filepath = f"{filepath}.{os.getpid()}_{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'wb') as a3m_file:
+        a3m_file.write(prefix)
+        copy_body(template, a3m_file)
+    os.replace(tmp_filepath, filepath)
@@ -0,0 +1,120 @@
+from typing import Dict, List, Optional
+
+import concurrent.futures
+import os
+import shutil
+import click
+from rich.console import Console
+
+from functions import load_config, completion_index_filepath
+from manifest import MANIFEST_FILENAME, load_completion_index, load_completion_manifest, verify_completion_manifest, drop_from_completion_index
+from prediction_archive import archive_filepath, is_archived, write_prediction_archive, verify_prediction_archive
+
+
+def archive_prediction(task:Dict) -> Dict:
+    """
+    This function will archive one finished prediction folder and then remove the folder, run in a worker process.
+
+    The folder is only archived if its completion manifest matches every file in it, checksums included, and only removed once the archive has been read back and verified.
+
+    Args:
+        task (Dict): A dictionary with the folder, its index_key, drop_pngs, keep_ranks and keep_folder
+
+    Returns:
+        result (Dict): A dictionary with the folder, its index_key, whether it was 'archived', the 'error' if it wasn't, whether its files no longer 'match' its manifest, and the size of the folder and of the archive in bytes
+    """
+    folder = task['folder']
+    result = {'folder': folder, 'index_key': task['index_key'], 'archived': False, 'error': None, 'match': True, 'folder_size': 0, 'archive_size': 0}
+    if not verify_completion_manifest(folder, check_checksums=True):
+        result['error'] = 'its completion manifest is missing or does not match its files'
+        result['match'] = False
+        return result
+    manifest = load_completion_manifest(folder)
+    # anything written after the manifest (or by hand) wouldn't be in the archive, so we'll leave those folders alone
+    listed = set(manifest_file['name'] for manifest_file in manifest['files']) | {MANIFEST_FILENAME}
+    unlisted = [filename for filename in os.listdir(folder) if filename not in listed]
+    if unlisted:
+        result['error'] = f"{len(unlisted)} files are not in its completion manifest e.g. {unlisted[0]}"
+        return result
+
+    write_prediction_archive(folder, manifest, drop_pngs=task['drop_pngs'], keep_ranks=task['keep_ranks'])
+    if not verify_prediction_archive(folder):
+        os.remove(archive_filepath(folder))
+        result['error'] = 'the archive could not be verified'
+        return result
+    result['archived'] = True
+    result['folder_size'] = sum(manifest_file['size'] for manifest_file in manifest['files'])
+    result['archive_size'] = os.path.getsize(archive_filepath(folder))
+    if not task['keep_folder']:
+        shutil.rmtree(folder)
+    return result
+
+
+def build_archive_tasks(config:Dict, experiment_numbers:Optional[List[str]], drop_pngs:bool, keep_ranks:Optional[int], keep_folders:bool) -> List[Dict]:
+    """
+    This function will find the finished experiment prediction folders which haven't been archived yet, from the completion index.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        experiment_numbers (List[str]): Only archive these experiments, or None for every experiment
+        drop_pngs (bool): Whether to leave the plots out of the archives
+        keep_ranks (int): Only archive the PDB files of the top ranked models, or None to keep all of them
+        keep_folders (bool): Whether to keep the folders once they are archived
+
+    Returns:
+        tasks (List[Dict]): The archive tasks
+    """
+    completed = load_completion_index(completion_index_filepath(config))
+    tasks = []
+    for index_key in completed:
+        experiment_number = index_key.split('/')[-2]
+        if experiment_numbers is not None and experiment_number not in experiment_numbers:
+            continue
+        folder = f"{config['PROJECT_FOLDER']}/{index_key}"
+        if is_archived(folder) or not os.path.exists(folder) or (keep_folders and os.path.exists(archive_filepath(folder))):
+            continue
+        tasks.append({'folder': folder, 'index_key': index_key, 'drop_pngs': drop_pngs, 'keep_ranks': keep_ranks, 'keep_folder': keep_folders})
+    return tasks
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="Only archive these experiments, separated by commas e.g. 31,32,33.")
+@click.option("--drop_pngs", is_flag=True, default=False, help="Leave the plots out of the archives.")
+@click.option("--keep_ranks", default=None, type=int, help="Only archive the PDB files of this many top ranked models, the scores of every model are kept.")
+@click.option("--keep_folders", is_flag=True, default=False, help="Keep the prediction folders once they are archived, rather than removing them.")
+@click.option("--workers", default=None, type=int, help="The number of worker processes, defaults to the number of CPUs.")
+def archive_predictions(environment, experiment_number, drop_pngs, keep_ranks, keep_folders, workers):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        tasks = build_archive_tasks(config, experiment_numbers, drop_pngs, keep_ranks, keep_folders)
+        console.print(f"Found {len(tasks)} finished prediction folders to archive")
+
+        results = []
+        with console.status(f"Archiving {len(tasks)} prediction folders...", spinner="dots"):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for result in executor.map(archive_prediction, tasks):
+                    if result['error'] is not None:
+                        console.print(f"[bold yellow]Did not archive {result['folder']}, {result['error']}[/bold yellow]")
+                    # a folder which no longer matches its manifest isn't finished after all, so we'll drop it from the index and the next run will predict it again
+                    if not result['match']:
+                        drop_from_completion_index(completion_index_filepath(config), result['index_key'], result['error'])
+                        console.print(f"[bold yellow]Dropped {result['folder']} from the completion index, it will be predicted again on the next run[/bold yellow]")
+                    results.append(result)
+
+        archived = [result for result in results if result['archived']]
+        folder_size = sum(result['folder_size'] for result in archived)
+        archive_size = sum(result['archive_size'] for result in archived)
+        console.print(f"Archived {len(archived)} prediction folders, {folder_size / 1024 ** 2:.1f} MB into {archive_size / 1024 ** 2:.1f} MB")
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    archive_predictions()
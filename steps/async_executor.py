@@ -0,0 +1,218 @@
+from typing import Callable, Dict, List, Optional
+
+import asyncio
+import datetime
+import inspect
+import os
+import signal
+import subprocess
+
+from telemetry import LOG_LINE_PATTERN, QUERY_PATTERN, RECYCLE_PATTERN, MODEL_TOOK_PATTERN
+
+
+def parse_progress_line(line:str) -> Optional[Dict]:
+    """
+    This function will parse a line of colabfold output into a progress update, if it is one.
+
+    Args:
+        line (str): A line of the container's stdout or stderr
+
+    Returns:
+        progress (Dict): A dictionary with the event ('query', 'recycle' or 'model') and its jobname, model, recycle, plddt or seconds, or None if the line isn't a progress line
+    """
+    match = LOG_LINE_PATTERN.match(line.rstrip('\r\n'))
+    message = match.group(2) if match else line.strip()
+    query_match = QUERY_PATTERN.match(message)
+    if query_match:
+        return {'event': 'query', 'jobname': query_match.group(1), 'sequence_length': int(query_match.group(2))}
+    recycle_match = RECYCLE_PATTERN.match(message)
+    if recycle_match:
+        return {'event': 'recycle', 'model': recycle_match.group(1), 'recycle': int(recycle_match.group(2)), 'plddt': float(recycle_match.group(3))}
+    model_match = MODEL_TOOK_PATTERN.match(message)
+    if model_match:
+        return {'event': 'model', 'model': model_match.group(1), 'seconds': float(model_match.group(2)), 'recycles': int(model_match.group(3))}
+    return None
+
+
+async def kill_container(container_name:Optional[str]) -> None:
+    # killing the docker client doesn't stop the container, so we'll stop it by name
+    if container_name:
+        killer = await asyncio.create_subprocess_shell(f"docker kill {container_name}", stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await killer.wait()
+
+
+async def stop_process(process:asyncio.subprocess.Process, container_name:Optional[str]) -> None:
+    await kill_container(container_name)
+    if process.returncode is None:
+        # the command runs in its own process group, so we'll kill everything the shell started along with it
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def run_command_async(command:str, log_filepath:str, timeout:Optional[float]=None, container_name:Optional[str]=None, on_progress:Optional[Callable[[Dict], None]]=None) -> int:
+    """
+    This function will run a shell command as a subprocess, streaming its stdout and stderr to log files as they arrive.
+
+    The container started by the command is killed if the command runs past the timeout, or if the task running it is cancelled (e.g. by Ctrl-C).
+
+    Args:
+        command (str): The shell command to run, without -ti as nothing is attached to a terminal
+        log_filepath (str): The path of the job's log, the output is appended to '<log_filepath>.stdout' and '<log_filepath>.stderr'
+        timeout (float): The wall clock timeout in seconds, or None for no timeout
+        container_name (str): The name of the docker container started by the command, if any
+        on_progress (Callable): An optional function called with each progress update parsed from the output
+
+    Returns:
+        returncode (int): The exit code of the command
+
+    Raises:
+        subprocess.TimeoutExpired: If the command runs for longer than the timeout
+    """
+    log_folder = os.path.dirname(log_filepath)
+    if log_folder and not os.path.exists(log_folder):
+        os.makedirs(log_folder, exist_ok=True)
+
+    # colabfold's progress bars can make for very long lines, so we'll allow for them
+    process = await asyncio.create_subprocess_shell(command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, limit=2 ** 24, start_new_session=True)
+    started = datetime.datetime.now().isoformat()
+
+    async def stream(reader:asyncio.StreamReader, filepath:str) -> None:
+        with open(filepath, 'a') as f:
+            f.write(f"# {started} {command}\n")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                text = line.decode(errors='replace')
+                f.write(text)
+                f.flush()
+                progress = parse_progress_line(text) if on_progress is not None else None
+                if progress is not None:
+                    on_progress(progress)
+
+    streams = asyncio.gather(stream(process.stdout, f"{log_filepath}.stdout"), stream(process.stderr, f"{log_filepath}.stderr"))
+    try:
+        await asyncio.wait_for(asyncio.shield(process.wait()), timeout=timeout)
+    except asyncio.TimeoutError:
+        await stop_process(process, container_name)
+        await streams
+        raise subprocess.TimeoutExpired(command, timeout)
+    except asyncio.CancelledError:
+        await stop_process(process, container_name)
+        await streams
+        raise
+    await streams
+    return process.returncode
+
+
+async def run_jobs_async(jobs:List[Dict], gpus:List[str], run_job:Callable, max_retries:int=1, timeout:Optional[float]=None, backoff:float=10.0, on_status:Optional[Callable[[Dict], None]]=None) -> Dict[str, Dict]:
+    """
+    This function will run a list of jobs with one worker per GPU on the event loop, each worker pulling jobs from a shared queue until every job is finished.
+
+    A failed or timed out job is put back on the queue after a delay which doubles with each attempt. If the run is cancelled every running job is cancelled (stopping its container) and every job left is marked as cancelled.
+
+    Args:
+        jobs (List[Dict]): A list of dictionaries, each with a unique 'job_id' key plus whatever run_job needs
+        gpus (List[str]): A list of GPUs, one worker is started for each entry
+        run_job (Callable): A coroutine function taking (job, gpu, timeout) that returns True if the job succeeded
+        max_retries (int): The number of times a failed or timed out job will be retried
+        timeout (float): The wall clock timeout in seconds for each attempt, or None for no timeout
+        backoff (float): The number of seconds before the first retry of a job, doubling for each retry after
+        on_status (Callable): An optional function called with the job status dictionary after every status change
+
+    Returns:
+        job_status (Dict[str, Dict]): A dictionary keyed by job_id with the status, attempts, gpu, start_time, end_time and error for each job
+    """
+    job_queue = asyncio.Queue()
+    job_status = {}
+    outstanding = [len(jobs)]
+    all_finished = asyncio.Event()
+    retry_tasks = set()
+
+    def update_status(job_id:str, **changes) -> None:
+        job_status[job_id].update(changes)
+        if on_status is not None:
+            on_status(dict(job_status[job_id]))
+
+    def finished() -> None:
+        outstanding[0] -= 1
+        if outstanding[0] == 0:
+            all_finished.set()
+
+    for job in jobs:
+        job_status[job['job_id']] = {'job_id': job['job_id'], 'status': 'queued', 'attempts': 0, 'gpu': None, 'error': None}
+        job_queue.put_nowait(job)
+    if len(jobs) == 0:
+        all_finished.set()
+
+    async def retry_later(job:Dict, delay:float) -> None:
+        await asyncio.sleep(delay)
+        job_queue.put_nowait(job)
+
+    async def worker(gpu:str) -> None:
+        while True:
+            job = await job_queue.get()
+            job_id = job['job_id']
+            attempts = job_status[job_id]['attempts'] + 1
+            update_status(job_id, status='running', attempts=attempts, gpu=gpu, start_time=datetime.datetime.now().isoformat())
+            try:
+                succeeded = await run_job(job, gpu, timeout)
+                error = None if succeeded else 'failed'
+            except subprocess.TimeoutExpired:
+                succeeded = False
+                error = 'timeout'
+            except asyncio.CancelledError:
+                update_status(job_id, status='cancelled', end_time=datetime.datetime.now().isoformat(), error='cancelled')
+                raise
+            except Exception as exception:
+                succeeded = False
+                error = repr(exception)
+            end_time = datetime.datetime.now().isoformat()
+            if succeeded:
+                update_status(job_id, status='done', end_time=end_time, error=None)
+            elif attempts <= max_retries:
+                # rather than holding up the worker, we'll put the job back on the queue once its backoff is over
+                delay = backoff * 2 ** (attempts - 1)
+                update_status(job_id, status='queued', end_time=end_time, error=error, retry_in=delay)
+                retry_task = asyncio.create_task(retry_later(job, delay))
+                retry_tasks.add(retry_task)
+                retry_task.add_done_callback(retry_tasks.discard)
+                continue
+            else:
+                update_status(job_id, status=error if error == 'timeout' else 'failed', end_time=end_time, error=error)
+            finished()
+
+    workers = [asyncio.create_task(worker(gpu)) for gpu in gpus]
+    try:
+        await all_finished.wait()
+    finally:
+        for task in workers + list(retry_tasks):
+            task.cancel()
+        # the cancelled workers stop their containers before they finish
+        await asyncio.gather(*workers, *retry_tasks, return_exceptions=True)
+        for status in job_status.values():
+            if status['status'] == 'queued':
+                status.update({'status': 'cancelled', 'error': 'cancelled'})
+    return job_status
+
+
+def run_jobs(jobs:List[Dict], gpus:List[str], run_job:Callable, max_retries:int=1, timeout:Optional[float]=None, backoff:float=10.0, on_status:Optional[Callable[[Dict], None]]=None) -> Dict[str, Dict]:
+    """
+    This function will run a list of jobs with run_jobs_async on a new event loop, it takes the same arguments.
+
+    On Ctrl-C the running containers are stopped before KeyboardInterrupt is raised. A plain function can be given as run_job, it is run in a thread.
+
+    Returns:
+        job_status (Dict[str, Dict]): A dictionary keyed by job_id with the status, attempts, gpu, start_time, end_time and error for each job
+    """
+    if not inspect.iscoroutinefunction(run_job):
+        blocking_run_job = run_job
+
+        async def run_job(job:Dict, gpu:str, timeout:Optional[float]) -> bool:
+            return await asyncio.to_thread(blocking_run_job, job, gpu, timeout)
+
+    # asyncio.run cancels the main task on Ctrl-C, which cancels the workers, then raises KeyboardInterrupt
+    return asyncio.run(run_jobs_async(jobs, gpus, run_job, max_retries=max_retries, timeout=timeout, backoff=backoff, on_status=on_status))
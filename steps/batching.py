@@ -0,0 +1,94 @@
+from typing import Dict, List
+
+import hashlib
+import os
+import shutil
+
+
+# these files are written once per colabfold_batch run rather than once per query, so each query folder gets a copy
+SHARED_OUTPUT_FILES = ['cite.bibtex', 'config.json', 'log.txt']
+
+
+def bucket_jobs_by_length(jobs:List[Dict], batch_size:int) -> List[List[Dict]]:
+    """
+    This function will group jobs into batches of the same total complex length, so that colabfold can reuse the compiled model within a batch.
+
+    Args:
+        jobs (List[Dict]): A list of job dictionaries, each with a 'sequence_length' key
+        batch_size (int): The maximum number of jobs in a batch
+
+    Returns:
+        batches (List[List[Dict]]): A list of batches, shortest sequences first
+    """
+    buckets = {}
+    for job in jobs:
+        buckets.setdefault(job['sequence_length'], []).append(job)
+    batches = []
+    for sequence_length in sorted(buckets):
+        bucket = buckets[sequence_length]
+        for start in range(0, len(bucket), batch_size):
+            batches.append(bucket[start:start + batch_size])
+    return batches
+
+
+def create_batch_id(batch:List[Dict]) -> str:
+    """
+    This function will create a stable identifier for a batch from the jobs in it, so that a rerun of the same batch reuses the same folders.
+
+    Args:
+        batch (List[Dict]): A list of job dictionaries, each with a 'job_id' key
+
+    Returns:
+        batch_id (str): The batch identifier e.g. 382_1f3a9c0e2b
+    """
+    digest = hashlib.sha1('\n'.join(sorted(job['job_id'] for job in batch)).encode()).hexdigest()[:10]
+    return f"{batch[0]['sequence_length']}_{digest}"
+
+
+def reset_folder(folder:str) -> None:
+    """
+    This function will create an empty folder, removing anything left over from a previous run.
+
+    Args:
+        folder (str): The folder to create
+    """
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+
+
+def split_batch_outputs(batch_output_folder:str, jobname_folders:Dict[str, str]) -> Dict[str, List[str]]:
+    """
+    This function will move the outputs of a batched colabfold_batch run into one folder per query.
+
+    ColabFold prefixes every per-query output with the query's jobname (the input file stem), the run-level files are copied into every query folder.
+
+    Args:
+        batch_output_folder (str): The output folder of the batched run
+        jobname_folders (Dict[str, str]): A dictionary with the jobname as the key and the destination folder as the value
+
+    Returns:
+        moved_files (Dict[str, List[str]]): A dictionary with the jobname as the key and the list of files moved into its folder as the value
+    """
+    moved_files = {jobname: [] for jobname in jobname_folders}
+    # we'll match the longest jobnames first so that one jobname being a prefix of another can't send files to the wrong folder
+    jobnames = sorted(jobname_folders, key=len, reverse=True)
+    for folder in jobname_folders.values():
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    for filename in sorted(os.listdir(batch_output_folder)):
+        filepath = f"{batch_output_folder}/{filename}"
+        if filename in SHARED_OUTPUT_FILES:
+            continue
+        for jobname in jobnames:
+            if filename.startswith(f"{jobname}_") or filename.startswith(f"{jobname}."):
+                os.replace(filepath, f"{jobname_folders[jobname]}/{filename}")
+                moved_files[jobname].append(filename)
+                break
+    for filename in SHARED_OUTPUT_FILES:
+        filepath = f"{batch_output_folder}/{filename}"
+        if os.path.exists(filepath):
+            for jobname, folder in jobname_folders.items():
+                shutil.copyfile(filepath, f"{folder}/{filename}")
+                moved_files[jobname].append(filename)
+    return moved_files
@@ -0,0 +1,219 @@
+from typing import Dict, List, Tuple
+
+import json
+import os
+import random
+import shutil
+import statistics
+import time
+import datetime
+import click
+from rich.console import Console
+from rich.table import Table
+
+from functions import journal_filepath
+from run_msa_predictions import run_experiment_grid
+from telemetry import load_spans
+
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def random_sequence(rng:random.Random, length:int) -> str:
+    return ''.join(rng.choice(AMINO_ACIDS) for position in range(length))
+
+
+def write_synthetic_inputs(project_folder:str, experiment_count:int, structure_count:int, msa_depth:int, seed:int) -> Tuple[List[str], List[Dict], Dict, str]:
+    """
+    This function will write a synthetic sweep into a scratch project folder, an experiment a3m file per experiment and the structures, allele and B2M sequences to predict.
+
+    Args:
+        project_folder (str): The scratch project folder
+        experiment_count (int): The number of experiments
+        structure_count (int): The number of structures predicted in each experiment
+        msa_depth (int): The number of sequences in each experiment a3m
+        seed (int): The seed for the random sequences
+
+    Returns:
+        experiment_numbers (List[str]): The experiment numbers
+        structures_to_predict (List[Dict]): The structures to predict, in the same form as load_prediction_list
+        allele_sequences (Dict): A dictionary with the allele as the key and the sequence as the value
+        b2m_seq (str): The B2M sequence
+    """
+    rng = random.Random(seed)
+    allele_slugs = [f"hla_{locus}_{number:02d}_01" for locus in ['a', 'b', 'c'] for number in range(1, 5)]
+    allele_sequences = {allele_slug: random_sequence(rng, 275) for allele_slug in allele_slugs}
+    b2m_seq = random_sequence(rng, 99)
+
+    structures_to_predict = []
+    for index in range(structure_count):
+        allele_slug = allele_slugs[index % len(allele_slugs)]
+        structures_to_predict.append({'pdb_code': f"s{index:05d}", 'locus': allele_slug[:5].replace('_', '-'), 'allele_slug': allele_slug, 'peptide_sequence': random_sequence(rng, rng.randint(8, 11)), 'resolution': '2.00'})
+
+    # every experiment gets its own body, so they don't share predictions through the cache
+    experiments_folder = f"{project_folder}/inputs/experiments"
+    os.makedirs(experiments_folder, exist_ok=True)
+    experiment_numbers = [str(number) for number in range(1, experiment_count + 1)]
+    for experiment_number in experiment_numbers:
+        with open(f"{experiments_folder}/experiment{experiment_number}.a3m", 'w') as f:
+            f.write("#274,99,9\t1,1,1\n###\n")
+            for row in range(msa_depth):
+                allele_slug = rng.choice(allele_slugs)
+                f.write(f">{allele_slug}\tbeta2m\t{random_sequence(rng, 9).lower()}\n{allele_sequences[allele_slug][:274]}{b2m_seq}{random_sequence(rng, 9)}\n")
+    return experiment_numbers, structures_to_predict, allele_sequences, b2m_seq
+
+
+def folder_bytes(folder:str) -> int:
+    total = 0
+    for root, folders, filenames in os.walk(folder):
+        for filename in filenames:
+            try:
+                total += os.lstat(f"{root}/{filename}").st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def percentile(values:List[float], fraction:float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def measure_sweep(config:Dict, experiment_numbers:List[str], structures_to_predict:List[Dict], allele_sequences:Dict, b2m_seq:str, workers:int, max_retries:int, batch_size:int, share_a3m:bool, use_cache:bool) -> Dict:
+    """
+    This function will run a synthetic sweep through the orchestration with the stub backend, then run it again to time the resume.
+
+    Args:
+        config (Dict): The config for the scratch project folder, with COLABFOLD_BACKEND set to 'stub'
+        experiment_numbers (List[str]): The experiment numbers returned by write_synthetic_inputs
+        structures_to_predict (List[Dict]): The structures returned by write_synthetic_inputs
+        allele_sequences (Dict): The allele sequences returned by write_synthetic_inputs
+        b2m_seq (str): The B2M sequence returned by write_synthetic_inputs
+        workers (int): The number of scheduler workers, each standing in for a GPU
+        max_retries (int): The number of times a failed job is retried
+        batch_size (int): The batch size passed to run_experiment_grid
+        share_a3m (bool): Whether to share identical a3m files
+        use_cache (bool): Whether to use the prediction cache
+
+    Returns:
+        results (Dict): A dictionary with the job counts, jobs_per_second, the prep and container latency percentiles, the bytes written per output folder and the resume time
+    """
+    console = Console(quiet=True)
+    gpus = [str(worker) for worker in range(workers)]
+    job_count = len(experiment_numbers) * len(structures_to_predict)
+
+    run_start = time.time()
+    job_status = run_experiment_grid(config, experiment_numbers, structures_to_predict, allele_sequences, b2m_seq, gpus, max_retries, None, False, console, batch_size=batch_size, share_a3m=share_a3m, use_cache=use_cache)
+    run_seconds = time.time() - run_start
+
+    # the prep latency is how long the a3m file of each job took to write, and how long the run took to start its first container
+    spans = load_spans(journal_filepath(config))
+    prep_seconds = [span['duration'] for span in spans if span['stage'] == 'a3m_build']
+    container_seconds = [span['duration'] for span in spans if span['stage'] == 'container']
+    container_starts = [datetime.datetime.fromisoformat(span['start_time']).timestamp() for span in spans if span['stage'] == 'container' and span['start_time']]
+
+    output_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}"
+    disk_bytes = {folder: folder_bytes(f"{output_folder}/{folder}") for folder in sorted(os.listdir(output_folder))}
+
+    resume_start = time.time()
+    run_experiment_grid(config, experiment_numbers, structures_to_predict, allele_sequences, b2m_seq, gpus, max_retries, None, False, console, batch_size=batch_size, share_a3m=share_a3m, use_cache=use_cache)
+    resume_seconds = time.time() - resume_start
+
+    done = len([status for status in job_status.values() if status['status'] == 'done'])
+    return {
+        'jobs': job_count,
+        'scheduled': len(job_status),
+        'done': done,
+        'run_seconds': run_seconds,
+        'jobs_per_second': job_count / run_seconds if run_seconds > 0 else 0.0,
+        'time_to_first_container': min(container_starts) - run_start if container_starts else None,
+        'prep_seconds': {'p50': percentile(prep_seconds, 0.5), 'p95': percentile(prep_seconds, 0.95), 'total': sum(prep_seconds)},
+        'container_seconds': {'p50': percentile(container_seconds, 0.5), 'p95': percentile(container_seconds, 0.95), 'mean': statistics.mean(container_seconds) if container_seconds else 0.0},
+        'disk_bytes': disk_bytes,
+        'disk_bytes_per_job': sum(disk_bytes.values()) / job_count if job_count else 0.0,
+        'resume_seconds': resume_seconds
+    }
+
+
+def print_results(results:Dict, console:Console) -> None:
+    table = Table(title=f"Orchestration benchmark: {results['settings']['experiments']} experiments x {results['settings']['structures']} structures")
+    table.add_column("Measure")
+    table.add_column("Value", justify="right")
+    table.add_row("Jobs", f"{results['jobs']:,}")
+    table.add_row("Jobs done", f"{results['done']:,}")
+    table.add_row("Run time", f"{results['run_seconds']:.1f}s")
+    table.add_row("Jobs per second", f"{results['jobs_per_second']:.2f}")
+    if results['time_to_first_container'] is not None:
+        table.add_row("Time to first container", f"{results['time_to_first_container']:.2f}s")
+    table.add_row("Prep per job p50 / p95", f"{results['prep_seconds']['p50'] * 1000:.1f}ms / {results['prep_seconds']['p95'] * 1000:.1f}ms")
+    table.add_row("Container per job p50 / p95", f"{results['container_seconds']['p50']:.2f}s / {results['container_seconds']['p95']:.2f}s")
+    for folder, size in results['disk_bytes'].items():
+        table.add_row(f"Disk written to outputs/{folder}", f"{size / 1024 ** 2:,.1f}MB")
+    table.add_row("Disk written per job", f"{results['disk_bytes_per_job'] / 1024:,.1f}KB")
+    table.add_row("Resume time", f"{results['resume_seconds']:.2f}s")
+    console.print(table)
+
+
+@click.command()
+@click.option("--experiments", default=20, help="The number of synthetic experiments.")
+@click.option("--structures", default=500, help="The number of synthetic structures predicted in each experiment.")
+@click.option("--msa_depth", default=64, help="The number of sequences in each synthetic experiment a3m.")
+@click.option("--workers", default=8, help="The number of scheduler workers, each standing in for a GPU.")
+@click.option("--batch_size", default=1, help="The batch size, as for run_msa_predictions.py.")
+@click.option("--share_a3m", is_flag=True, default=False, help="Share identical a3m files, as for run_msa_predictions.py.")
+@click.option("--no_cache", is_flag=True, default=False, help="Don't use the prediction cache.")
+@click.option("--latency", default=0.0, help="The number of seconds each stub prediction takes.")
+@click.option("--failure_rate", default=0.0, help="The fraction of stub predictions which fail.")
+@click.option("--max_retries", default=1, help="The number of times a failed prediction is retried.")
+@click.option("--outputs", default='minimal', type=click.Choice(['full', 'minimal']), help="Whether the stub writes full size outputs, or placeholders with the same names.")
+@click.option("--seed", default=42, help="The seed for the synthetic sequences.")
+@click.option("--label", default=None, help="A label for the results file, e.g. the change being measured.")
+@click.option("--keep", is_flag=True, default=False, help="Keep the scratch project folder afterwards.")
+def benchmark_orchestration(experiments, structures, msa_depth, workers, batch_size, share_a3m, no_cache, latency, failure_rate, max_retries, outputs, seed, label, keep):
+    console = Console()
+
+    # the results are kept alongside the other outputs of the project, the sweep itself runs in a scratch project folder
+    benchmarks_folder = os.path.abspath('outputs/benchmarks')
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    scratch_folder = f"{benchmarks_folder}/scratch_{timestamp}"
+    os.makedirs(scratch_folder)
+
+    config = {
+        'PROJECT_FOLDER': scratch_folder,
+        'INPUT_FOLDER': 'inputs',
+        'OUTPUT_FOLDER': 'outputs',
+        'AF_WEIGHTS_FOLDER': scratch_folder,
+        'CONTAINER_IMAGE': 'stub',
+        'COLABFOLD_OPTIONS': '--num-recycle 3 --random-seed 42 --num-models 5 --amber --use-gpu-relax',
+        'COLABFOLD_BACKEND': 'stub',
+        'STUB_LATENCY': latency,
+        'STUB_FAILURE_RATE': failure_rate,
+        'STUB_OUTPUTS': outputs
+    }
+
+    with console.status("Writing the synthetic sweep...", spinner="dots"):
+        experiment_numbers, structures_to_predict, allele_sequences, b2m_seq = write_synthetic_inputs(scratch_folder, experiments, structures, msa_depth, seed)
+
+    try:
+        with console.status(f"Running {experiments * structures:,} jobs...", spinner="dots"):
+            results = measure_sweep(config, experiment_numbers, structures_to_predict, allele_sequences, b2m_seq, workers, max_retries, batch_size, share_a3m, not no_cache)
+    finally:
+        if not keep:
+            shutil.rmtree(scratch_folder, ignore_errors=True)
+
+    results['settings'] = {'experiments': experiments, 'structures': structures, 'msa_depth': msa_depth, 'workers': workers, 'batch_size': batch_size, 'share_a3m': share_a3m, 'use_cache': not no_cache, 'latency': latency, 'failure_rate': failure_rate, 'max_retries': max_retries, 'outputs': outputs, 'seed': seed, 'label': label}
+    results_filepath = f"{benchmarks_folder}/benchmark_{timestamp}{'_' + label if label else ''}.json"
+    with open(results_filepath, 'w') as f:
+        json.dump(results, f, indent=4)
+
+    print_results(results, console)
+    console.print(f"Results written to {results_filepath}")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    benchmark_orchestration()
@@ -0,0 +1,425 @@
+from typing import Dict, List, Optional, Tuple
+
+import datetime
+import json
+import os
+import re
+import time
+import click
+import numpy as np
+from rich.console import Console
+
+from functions import load_config, make_filepath
+from a3m_template import PLACEHOLDER, parse_a3m_template
+
+
+GAP = ord('-')
+
+# the number of candidate rows compared against the kept rows at a time, which bounds the size of the comparison arrays
+CLUSTER_BLOCK_SIZE = 256
+
+
+def read_a3m_rows(template:Dict) -> Tuple[List[str], List[bytes], np.ndarray]:
+    """
+    This function will read the body of an experiment a3m file into a matrix of aligned residues.
+
+    Lowercase letters (insertions relative to the query) aren't part of the alignment, so they're left out of the matrix but kept in the rows written out.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+
+    Returns:
+        headers (List[str]): The header line of each sequence, without the '>'
+        rows (List[bytes]): The sequence of each row as it appears in the file
+        aligned (np.ndarray): The aligned residues of each row as a uint8 matrix, shape (rows, columns)
+    """
+    with open(template['filepath'], 'rb') as a3m_file:
+        a3m_file.seek(template['body_offset'])
+        body = a3m_file.read()
+
+    headers = []
+    rows = []
+    for record in body.split(b'\n>'):
+        lines = record.lstrip(b'>').split(b'\n')
+        if not lines[0].strip():
+            continue
+        headers.append(lines[0].rstrip(b'\r').decode())
+        rows.append(b''.join(line.rstrip(b'\r') for line in lines[1:]))
+
+    if len(rows) == 0:
+        return headers, rows, np.zeros((0, 0), dtype=np.uint8)
+    aligned_rows = [re.sub(rb'[a-z.]', b'', row) for row in rows]
+    width = len(aligned_rows[0])
+    if any(len(row) != width for row in aligned_rows):
+        raise ValueError(f"The aligned rows of {template['filepath']} are not all the same length")
+    aligned = np.frombuffer(b''.join(aligned_rows), dtype=np.uint8).reshape(len(rows), width)
+    return headers, rows, aligned
+
+
+def chain_blocks(template:Dict, width:int) -> List[Tuple[int, int]]:
+    """
+    This function will find the columns of each chain in the aligned rows, from the chain lengths in the a3m header.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        width (int): The number of aligned columns
+
+    Returns:
+        blocks (List[Tuple[int, int]]): The start and end column of each chain, or a single block of every column if the header doesn't match the alignment
+    """
+    if not template['chain_lengths'] or sum(template['chain_lengths']) != width:
+        return [(0, width)]
+    ends = np.cumsum(template['chain_lengths']).tolist()
+    return list(zip([0] + ends[:-1], ends))
+
+
+def block_depths(aligned:np.ndarray, blocks:List[Tuple[int, int]], rows:np.ndarray) -> Dict[str, int]:
+    """
+    This function will count the rows of each kind, by which chain blocks they have residues in, e.g. '001' is a row with only the peptide and '111' a paired row.
+
+    Args:
+        aligned (np.ndarray): The aligned residues returned by read_a3m_rows
+        blocks (List[Tuple[int, int]]): The chain blocks returned by chain_blocks
+        rows (np.ndarray): The indices of the rows to count
+
+    Returns:
+        depths (Dict[str, int]): The number of rows of each kind
+    """
+    filled = aligned[rows] != GAP
+    kinds = [''.join('1' if row_filled[start:end].any() else '0' for start, end in blocks) for row_filled in filled]
+    return {kind: kinds.count(kind) for kind in sorted(set(kinds))}
+
+
+def block_peptides(aligned:np.ndarray, blocks:List[Tuple[int, int]], rows:np.ndarray) -> Dict[str, int]:
+    """
+    This function will count the distinct peptides in the rows of each kind that have one, the peptide being the last chain.
+
+    Args:
+        aligned (np.ndarray): The aligned residues returned by read_a3m_rows
+        blocks (List[Tuple[int, int]]): The chain blocks returned by chain_blocks
+        rows (np.ndarray): The indices of the rows to count
+
+    Returns:
+        peptides (Dict[str, int]): The number of distinct peptides in the rows of each kind, see block_depths
+    """
+    peptides = {}
+    for index in rows:
+        row_filled = aligned[index] != GAP
+        if len(blocks) < 2 or not row_filled[blocks[-1][0]:blocks[-1][1]].any():
+            continue
+        kind = ''.join('1' if row_filled[start:end].any() else '0' for start, end in blocks)
+        peptides.setdefault(kind, set()).add(aligned[index, blocks[-1][0]:blocks[-1][1]].tobytes())
+    return {kind: len(peptides[kind]) for kind in sorted(peptides)}
+
+
+def block_identity_matches(candidates:np.ndarray, others:np.ndarray, blocks:List[Tuple[int, int]], max_identity:float) -> np.ndarray:
+    """
+    This function will find which pairs of rows are near duplicates, more than max_identity identical in every chain block.
+
+    Within a block the identity is only over the columns where at least one of the two rows has a residue, as the columns where both have gaps say nothing about whether they're the same sequence. So a row with a chain that the other row doesn't have is never a near duplicate of it.
+
+    The counts for every pair are worked out as matrix products rather than by comparing each pair of rows column by column. The identical residues are the product of the rows one hot encoded by (column, residue), and the columns where both rows have a residue are the product of their filled columns.
+
+    Args:
+        candidates (np.ndarray): The aligned residues of the rows to match, shape (candidates, columns)
+        others (np.ndarray): The aligned residues of the rows to match them against, shape (others, columns)
+        blocks (List[Tuple[int, int]]): The chain blocks returned by chain_blocks
+        max_identity (float): The identity above which rows are near duplicates
+
+    Returns:
+        matches (np.ndarray): A boolean matrix, shape (candidates, others), True where the two rows are near duplicates
+    """
+    matches = np.ones((len(candidates), len(others)), dtype=bool)
+    for start, end in blocks:
+        candidate_block = candidates[:, start:end]
+        other_block = others[:, start:end]
+        candidate_filled = (candidate_block != GAP).astype(np.float32)
+        other_filled = (other_block != GAP).astype(np.float32)
+
+        # only the (column, residue) pairs the candidates have can be identical, which is far fewer than every residue in every column
+        present = np.zeros((end - start, 256), dtype=bool)
+        filled_rows, filled_columns = np.nonzero(candidate_filled)
+        present[filled_columns, candidate_block[filled_rows, filled_columns]] = True
+        pair_columns, pair_residues = np.nonzero(present)
+        pair_residues = pair_residues.astype(np.uint8)
+        identical = (candidate_block[:, pair_columns] == pair_residues).astype(np.float32) @ (other_block[:, pair_columns] == pair_residues).astype(np.float32).T
+
+        # the columns compared are those where either row has a residue, and every one of them that isn't identical is a mismatch
+        compared = candidate_filled.sum(axis=1)[:, np.newaxis] + other_filled.sum(axis=1)[np.newaxis, :] - candidate_filled @ other_filled.T
+        mismatches = compared - identical
+        # a block where both rows are all gaps has nothing compared, and doesn't stop them matching
+        matches &= mismatches <= (1.0 - max_identity) * compared
+    return matches
+
+
+def cluster_near_duplicates(aligned:np.ndarray, order:np.ndarray, max_identity:float, weights:np.ndarray, blocks:List[Tuple[int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    This function will greedily cluster rows which are more than max_identity identical in every chain block, in the order given.
+
+    Each row in turn either joins the first representative it's a near duplicate of, or becomes a new representative. The matches are worked out a block of candidates at a time against every representative kept so far.
+
+    Args:
+        aligned (np.ndarray): The aligned residues returned by read_a3m_rows
+        order (np.ndarray): The row indices in the order they should be considered, e.g. best coverage first
+        max_identity (float): The identity above which rows are near duplicates, see block_identity_matches
+        weights (np.ndarray): The number of rows each row stands for, e.g. its exact copies
+        blocks (List[Tuple[int, int]]): The chain blocks returned by chain_blocks
+
+    Returns:
+        representatives (np.ndarray): The row indices of the representatives, in the order they were chosen
+        cluster_sizes (np.ndarray): The total weight of the rows in each representative's cluster
+    """
+    representatives = []
+    cluster_sizes = []
+    representative_rows = np.zeros((0, aligned.shape[1]), dtype=np.uint8)
+    for start in range(0, len(order), CLUSTER_BLOCK_SIZE):
+        block = order[start:start + CLUSTER_BLOCK_SIZE]
+        candidates = aligned[block]
+
+        # first we'll match the block against the representatives from earlier blocks
+        assigned = np.full(len(block), -1)
+        if len(representative_rows) > 0:
+            for representative_start in range(0, len(representative_rows), CLUSTER_BLOCK_SIZE):
+                chunk = representative_rows[representative_start:representative_start + CLUSTER_BLOCK_SIZE]
+                matches = block_identity_matches(candidates, chunk, blocks, max_identity)
+                first = matches.argmax(axis=1)
+                # only the first matching representative counts, so a later chunk can't take a row that's already assigned
+                matched = matches.any(axis=1) & (assigned < 0)
+                assigned[matched] = representative_start + first[matched]
+            for position in np.flatnonzero(assigned >= 0):
+                cluster_sizes[assigned[position]] += int(weights[block[position]])
+
+        # then the rows left over are clustered among themselves, in order
+        unassigned = np.flatnonzero(assigned < 0)
+        if len(unassigned) > 0:
+            matches = block_identity_matches(candidates[unassigned], candidates[unassigned], blocks, max_identity)
+            taken = np.zeros(len(unassigned), dtype=bool)
+            new_representatives = []
+            for position in range(len(unassigned)):
+                if taken[position]:
+                    continue
+                members = matches[position] & ~taken
+                members[:position] = False
+                members[position] = True
+                taken |= members
+                new_representatives.append(unassigned[position])
+                representatives.append(int(block[unassigned[position]]))
+                cluster_sizes.append(int(weights[block[unassigned[members]]].sum()))
+            representative_rows = np.concatenate([representative_rows, candidates[new_representatives]])
+    return np.array(representatives, dtype=np.int64), np.array(cluster_sizes, dtype=np.int64)
+
+
+def compact_a3m(template:Dict, max_identity:float=1.0, min_coverage:float=0.0, min_identity:float=0.0, max_depth:Optional[int]=None) -> Dict:
+    """
+    This function will compact the body of an experiment a3m, removing duplicate rows, rows which fail the coverage or identity filters and (optionally) capping the depth.
+
+    The steps are:
+        exact duplicates: only the first copy of identical aligned rows is kept
+        coverage: rows with fewer than min_coverage of their columns filled (not gaps) are removed
+        identity: rows less than min_identity identical to the column consensus, in any chain they have residues in, are removed
+        near duplicates: rows are clustered greedily, best coverage first, and only one row is kept from each cluster of rows over max_identity identical in every chain
+
+    Identities are worked out per chain, from the chain lengths in the a3m header, over the columns where at least one of the two sequences has a residue. Otherwise the columns where both have gaps count as matches, and e.g. every peptide only row would be a near duplicate of every other.
+        depth: if there are more than max_depth rows left, the rows from the largest clusters are kept
+
+    The rows that are kept stay in their original order.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        max_identity (float): The identity above which rows are near duplicates, 1.0 only removes exact duplicates
+        min_coverage (float): The minimum fraction of filled columns in a row
+        min_identity (float): The minimum identity of a row to the column consensus
+        max_depth (int): The maximum number of rows to keep, or None for no cap
+
+    Returns:
+        compacted (Dict): A dictionary with the headers, rows and cluster_sizes kept, and the stats of each step
+    """
+    headers, rows, aligned = read_a3m_rows(template)
+    stats = {'input_depth': len(rows), 'columns': int(aligned.shape[1])}
+    if len(rows) == 0:
+        return {'headers': [], 'rows': [], 'cluster_sizes': [], 'stats': {**stats, 'output_depth': 0}}
+    blocks = chain_blocks(template, aligned.shape[1])
+    stats['chains'] = len(blocks)
+    stats['input_block_depths'] = block_depths(aligned, blocks, np.arange(len(rows)))
+    stats['input_block_peptides'] = block_peptides(aligned, blocks, np.arange(len(rows)))
+
+    # exact duplicates are found by viewing each row as a single opaque value
+    row_values = np.ascontiguousarray(aligned).view(np.dtype((np.void, aligned.shape[1]))).ravel()
+    unique_values, first_indices, inverse = np.unique(row_values, return_index=True, return_inverse=True)
+    duplicate_counts = np.bincount(inverse.ravel())
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[first_indices] = True
+    stats['exact_duplicates'] = int(len(rows) - keep.sum())
+    copies = np.zeros(len(rows), dtype=np.int64)
+    copies[first_indices] = duplicate_counts
+
+    filled = aligned != GAP
+    coverage = filled.mean(axis=1)
+    low_coverage = keep & (coverage < min_coverage)
+    stats['low_coverage'] = int(low_coverage.sum())
+    keep &= ~low_coverage
+
+    # the consensus is the most common residue in each column, ignoring gaps
+    counts = np.zeros((256, aligned.shape[1]), dtype=np.int64)
+    np.add.at(counts, (aligned[keep], np.arange(aligned.shape[1])[np.newaxis, :]), 1)
+    counts[GAP] = 0
+    consensus = counts.argmax(axis=0).astype(np.uint8)
+    consensus[counts.sum(axis=0) == 0] = GAP
+    # a row is only compared with the consensus in the chains it has, and has to pass in each of them
+    consensus_identity = np.ones(len(rows))
+    for start, end in blocks:
+        row_filled = filled[:, start:end]
+        compared = (row_filled | (consensus[start:end] != GAP)).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_identity = ((aligned[:, start:end] == consensus[start:end]) & row_filled).sum(axis=1) / compared
+        consensus_identity = np.where(row_filled.any(axis=1), np.minimum(consensus_identity, block_identity), consensus_identity)
+    low_identity = keep & (consensus_identity < min_identity)
+    stats['low_identity'] = int(low_identity.sum())
+    keep &= ~low_identity
+
+    # the near duplicate clustering starts from the best covered rows, so they become the representatives
+    candidates = np.flatnonzero(keep)
+    order = candidates[np.argsort(-coverage[candidates], kind='stable')]
+    if max_identity < 1.0:
+        # each cluster also stands for the exact copies of its members, which were removed first
+        representatives, cluster_weights = cluster_near_duplicates(aligned, order, max_identity, copies, blocks)
+    else:
+        representatives, cluster_weights = order, copies[order]
+    stats['near_duplicates'] = int(len(order) - len(representatives))
+
+    if max_depth is not None and len(representatives) > max_depth:
+        largest = np.argsort(-cluster_weights, kind='stable')[:max_depth]
+        stats['depth_capped'] = int(len(representatives) - max_depth)
+        representatives, cluster_weights = representatives[largest], cluster_weights[largest]
+    else:
+        stats['depth_capped'] = 0
+
+    kept_order = np.argsort(representatives, kind='stable')
+    representatives, cluster_weights = representatives[kept_order], cluster_weights[kept_order]
+    stats['output_depth'] = int(len(representatives))
+    stats['output_block_depths'] = block_depths(aligned, blocks, representatives)
+    stats['output_block_peptides'] = block_peptides(aligned, blocks, representatives)
+    stats['mean_coverage'] = round(float(coverage[representatives].mean()), 4) if len(representatives) else 0.0
+    stats['depth_ratio'] = round(stats['output_depth'] / stats['input_depth'], 4)
+    return {
+        'headers': [headers[index] for index in representatives],
+        'rows': [rows[index] for index in representatives],
+        'cluster_sizes': cluster_weights.tolist(),
+        'stats': stats
+    }
+
+
+def check_compacted_blocks(stats:Dict) -> List[str]:
+    """
+    This function will check that compaction kept the peptide MSA, which is what the experiments vary.
+
+    Every peptide only row has to be kept, and every distinct peptide in the rows of each kind, e.g. the paired rows. Paired rows for closely related alleles with the same peptide can be removed as near duplicates.
+
+    Args:
+        stats (Dict): The stats returned by compact_a3m
+
+    Returns:
+        problems (List[str]): A description of each block which lost rows it should have kept, empty if there are none
+    """
+    problems = []
+    if stats.get('chains', 0) < 2:
+        return problems
+    peptide_only = '0' * (stats['chains'] - 1) + '1'
+    if peptide_only in stats['input_block_depths'] and stats['output_block_depths'].get(peptide_only, 0) != stats['input_block_depths'][peptide_only]:
+        problems.append(f"the peptide only rows went from {stats['input_block_depths'][peptide_only]} to {stats['output_block_depths'].get(peptide_only, 0)}")
+    for kind, peptides in stats['input_block_peptides'].items():
+        if stats['output_block_peptides'].get(kind, 0) != peptides:
+            problems.append(f"the distinct peptides in the {kind} rows went from {peptides} to {stats['output_block_peptides'].get(kind, 0)}")
+    return problems
+
+
+def write_compact_a3m(template:Dict, compacted:Dict, filepath:str) -> None:
+    """
+    This function will write a compacted a3m with the same header and query placeholder as the original, so it can be used as an experiment a3m.
+
+    Args:
+        template (Dict): The template dictionary returned by parse_a3m_template
+        compacted (Dict): The compacted rows returned by compact_a3m
+        filepath (str): The path to write the compacted a3m to
+    """
+    tmp_filepath = f"{filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, 'wb') as f:
+        if template['header'] is not None:
+            f.write(f"{template['header']}\n".encode())
+        f.write(f"{PLACEHOLDER}\n".encode())
+        for header, row in zip(compacted['headers'], compacted['rows']):
+            f.write(f">{header}\n".encode())
+            f.write(row + b'\n')
+    os.replace(tmp_filepath, filepath)
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="The experiment(s) to compact, separated by commas e.g. 31,32,33.")
+@click.option("--max_identity", default=0.95, help="Rows more than this identical to a kept row, in every chain, are removed as near duplicates, 1.0 only removes exact duplicates.")
+@click.option("--min_coverage", default=0.0, help="The minimum fraction of a row's columns which aren't gaps.")
+@click.option("--min_identity", default=0.0, help="The minimum identity of a row to the consensus of the alignment, in each chain it has.")
+@click.option("--max_depth", default=None, type=int, help="The maximum number of rows to keep, the rows representing the largest clusters are kept.")
+@click.option("--suffix", default='compact', help="The suffix of the compacted experiment, experiment31.a3m becomes experiment31_compact.a3m, run as experiment 31_compact.")
+@click.option("--check", is_flag=True, default=False, help="Check that compaction keeps the peptide MSA of the experiments (or every experiment a3m file if none are given), without writing anything.")
+def compact_msa(environment, experiment_number, max_identity, min_coverage, min_identity, max_depth, suffix, check):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        if experiment_number:
+            numbers = [number.strip() for number in experiment_number.split(',') if number.strip()]
+        elif check:
+            # the compacted experiments have a suffix, so only the experiment a3m files as shipped are checked
+            numbers = sorted(filename[len('experiment'):-len('.a3m')] for filename in os.listdir(f"{config['PROJECT_FOLDER']}/{config['INPUT_FOLDER']}/experiments") if re.fullmatch(r"experiment\d+\.a3m", filename))
+        else:
+            console.print("[bold red]Give the experiment(s) to compact with --experiment_number[/bold red]")
+            numbers = []
+        failed = []
+        for number in numbers:
+            # the experiment a3m files are found in the project folder, the same as in run_msa_predictions.py
+            a3m_filepath = make_filepath(config, 'input', 'experiments', f"experiment{number}.a3m")
+            if not os.path.exists(a3m_filepath):
+                console.print(f"[bold red]Experiment a3m file does not exist at {a3m_filepath}[/bold red]")
+                continue
+            start = time.perf_counter()
+            template = parse_a3m_template(a3m_filepath)
+            compacted = compact_a3m(template, max_identity=max_identity, min_coverage=min_coverage, min_identity=min_identity, max_depth=max_depth)
+
+            if check:
+                problems = check_compacted_blocks(compacted['stats'])
+                if problems:
+                    failed.append(number)
+                    console.print(f"[bold red]Experiment {number}: {', '.join(problems)}[/bold red]")
+                else:
+                    console.print(f"[bold green]Experiment {number}: {compacted['stats']['input_block_depths']} -> {compacted['stats']['output_block_depths']} rows of each kind, every peptide kept[/bold green]")
+                continue
+
+            compact_number = f"{number}_{suffix}"
+            compact_filepath = make_filepath(config, 'input', 'experiments', f"experiment{compact_number}.a3m")
+            write_compact_a3m(template, compacted, compact_filepath)
+
+            stats = {
+                'experiment_number': number,
+                'compact_experiment_number': compact_number,
+                'source': a3m_filepath,
+                'source_body_digest': template['body_digest'],
+                'parameters': {'max_identity': max_identity, 'min_coverage': min_coverage, 'min_identity': min_identity, 'max_depth': max_depth},
+                **compacted['stats'],
+                'seconds': round(time.perf_counter() - start, 3),
+                'created': datetime.datetime.now().isoformat()
+            }
+            with open(make_filepath(config, 'input', 'experiments', f"experiment{compact_number}_stats.json"), 'w') as f:
+                json.dump(stats, f, indent=4)
+            console.print(f"Experiment {number}: {stats['input_depth']} -> {stats['output_depth']} rows ({stats['exact_duplicates']} exact duplicates, {stats['near_duplicates']} near duplicates, {stats['low_coverage']} low coverage, {stats['low_identity']} low identity, {stats['depth_capped']} over the depth cap), written to {compact_filepath}")
+        if check and failed:
+            raise SystemExit(1)
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    compact_msa()
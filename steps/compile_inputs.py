@@ -0,0 +1,36 @@
+import time
+import click
+from rich.console import Console
+
+from functions import load_config, input_bundle_sources, input_bundle_filepath, load_input_bundle
+from input_bundle import compile_input_bundle
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--force", is_flag=True, default=False, help="Compile the bundle even if the one there is up to date.")
+def compile_inputs(environment, force):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        bundle_filepath = input_bundle_filepath(config)
+        if not force and load_input_bundle(config) is not None:
+            console.print(f"The input bundle at {bundle_filepath} is up to date")
+        else:
+            start = time.perf_counter()
+            try:
+                stats = compile_input_bundle(input_bundle_sources(config), bundle_filepath)
+            except FileNotFoundError as error:
+                console.print(f"[bold red]Cannot compile the input bundle, {error.filename} does not exist[/bold red]")
+            else:
+                console.print(f"Compiled {stats['predictions']} predictions and {stats['alleles']} allele sequences into {bundle_filepath} ({stats['bytes'] / 1024:.0f} KB) in {time.perf_counter() - start:.2f}s")
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    compile_inputs()
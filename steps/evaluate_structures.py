@@ -0,0 +1,320 @@
+from typing import List, Dict, Tuple, Optional
+
+import concurrent.futures
+import csv
+import hashlib
+import os
+import re
+import click
+import numpy as np
+from rich.console import Console
+
+from functions import load_config, load_prediction_list, make_filepath
+from manifest import load_completion_index
+from prediction_archive import list_result_files, read_result_file, result_file_identity
+
+
+# colabfold writes the heavy chain, B2M and peptide as chains A, B and C, the groove is the alpha1/alpha2 domain of the heavy chain
+GROOVE_RESIDUES = (1, 180)
+PEPTIDE_CHAIN = 'C'
+HEAVY_CHAIN = 'A'
+BACKBONE_ATOMS = ['N', 'CA', 'C', 'O']
+
+MODEL_FILENAME_PATTERN = re.compile(r"_(relaxed|unrelaxed)_rank_(\d+)_(.+)\.pdb$")
+
+
+def parse_pdb_coordinates(pdb_data:bytes) -> Dict[str, np.ndarray]:
+    """
+    This function will parse the atoms of the first model in a PDB file into NumPy arrays, slicing the fixed width columns of every line at once.
+
+    Waters, hydrogens and alternate locations other than the first are left out.
+
+    Args:
+        pdb_data (bytes): The contents of the PDB file
+
+    Returns:
+        coordinates (Dict[str, np.ndarray]): A dictionary of arrays with one entry per atom, 'chain', 'residue_number', 'atom_name', 'residue_name' and 'xyz' (atoms x 3)
+    """
+    atom_lines = []
+    for line in pdb_data.split(b'\n'):
+        if line.startswith(b'ATOM  ') or line.startswith(b'HETATM'):
+            atom_lines.append(line.rstrip(b'\r'))
+        elif line.startswith(b'ENDMDL'):
+            break
+    characters = np.array(atom_lines, dtype='S80').view('S1').reshape(len(atom_lines), 80)
+
+    def column(start:int, end:int) -> np.ndarray:
+        return np.char.strip(np.ascontiguousarray(characters[:, start:end]).view(f"S{end - start}").ravel().astype(f"U{end - start}"))
+
+    atom_name = column(12, 16)
+    alternate_location = column(16, 17)
+    residue_name = column(17, 20)
+    element = column(76, 78)
+    # older files don't always fill in the element column, so we'll fall back to the first letter of the atom name
+    element = np.where(element == '', np.char.lstrip(atom_name, '0123456789').astype('U1'), element)
+    keep = (residue_name != 'HOH') & (element != 'H') & ((alternate_location == '') | (alternate_location == 'A'))
+
+    xyz = np.ascontiguousarray(characters[:, 30:54]).view('S8').reshape(len(atom_lines), 3).astype(np.float32)
+    return {
+        'chain': column(21, 22)[keep],
+        'residue_number': column(22, 26)[keep].astype(np.int32),
+        'atom_name': atom_name[keep],
+        'residue_name': residue_name[keep],
+        'xyz': xyz[keep]
+    }
+
+
+def load_coordinates(filepath:str, cache_folder:Optional[str]=None) -> Dict[str, np.ndarray]:
+    """
+    This function will load the coordinates of a PDB file, from the coordinate cache if the file has been parsed before.
+
+    The cache is keyed on the path, size and modification time of the file (or of the archive holding it), so a changed file is parsed again.
+
+    Args:
+        filepath (str): The path to the PDB file, which may be in an archived prediction folder
+        cache_folder (str): The folder holding the cached coordinates, or None to always parse the file
+
+    Returns:
+        coordinates (Dict[str, np.ndarray]): The coordinates returned by parse_pdb_coordinates
+    """
+    cache_filepath = None
+    if cache_folder is not None:
+        absolute_filepath, size, mtime_ns = result_file_identity(filepath)
+        cache_key = hashlib.sha1(f"{absolute_filepath}:{size}:{mtime_ns}".encode()).hexdigest()
+        cache_filepath = f"{cache_folder}/{cache_key[:2]}/{cache_key}.npz"
+        if os.path.exists(cache_filepath):
+            with np.load(cache_filepath) as cached:
+                return {name: cached[name] for name in cached.files}
+    coordinates = parse_pdb_coordinates(read_result_file(filepath))
+    if cache_filepath is not None:
+        os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+        tmp_filepath = f"{cache_filepath[:-4]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_filepath, **coordinates)
+        os.replace(tmp_filepath, cache_filepath)
+    return coordinates
+
+
+def atom_keys(coordinates:Dict[str, np.ndarray], chain_map:Optional[Dict[str, str]]=None) -> np.ndarray:
+    """
+    This function will build a 'chain:residue_number:atom_name' key for each atom, used to match atoms between a model and the crystal structure.
+
+    Args:
+        coordinates (Dict[str, np.ndarray]): The coordinates returned by parse_pdb_coordinates
+        chain_map (Dict[str, str]): An optional mapping from the file's chain ids to the model's chain ids
+
+    Returns:
+        keys (np.ndarray): The key for each atom
+    """
+    chains = coordinates['chain']
+    if chain_map:
+        chains = np.array([chain_map.get(chain, f"_{chain}") for chain in chains])
+    return np.char.add(np.char.add(np.char.add(np.char.add(chains, ':'), coordinates['residue_number'].astype(str)), ':'), coordinates['atom_name'])
+
+
+def atom_selections(coordinates:Dict[str, np.ndarray], keys:np.ndarray) -> Dict[str, np.ndarray]:
+    # the groove CA atoms are used for the superposition, the peptide atoms for the RMSD
+    chain = np.char.partition(keys, ':')[:, 0]
+    groove = (chain == HEAVY_CHAIN) & (coordinates['atom_name'] == 'CA') & (coordinates['residue_number'] >= GROOVE_RESIDUES[0]) & (coordinates['residue_number'] <= GROOVE_RESIDUES[1])
+    peptide = chain == PEPTIDE_CHAIN
+    return {
+        'groove': groove,
+        'peptide_backbone': peptide & np.isin(coordinates['atom_name'], BACKBONE_ATOMS),
+        'peptide_all_atom': peptide
+    }
+
+
+def superpose_batch(mobile:np.ndarray, target:np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    This function will find the least squares superposition (Kabsch) of a stack of coordinate sets onto a single target.
+
+    Args:
+        mobile (np.ndarray): The coordinates to move, shape (models, atoms, 3)
+        target (np.ndarray): The coordinates to superpose onto, shape (atoms, 3)
+
+    Returns:
+        rotations (np.ndarray): The rotation matrices, shape (models, 3, 3), applied as xyz @ rotation.T
+        mobile_centres (np.ndarray): The centroid of each mobile set, shape (models, 3)
+        target_centre (np.ndarray): The centroid of the target, shape (3,)
+    """
+    mobile_centres = mobile.mean(axis=1)
+    target_centre = target.mean(axis=0)
+    covariance = np.einsum('mai,aj->mij', mobile - mobile_centres[:, None, :], target - target_centre)
+    u, s, vt = np.linalg.svd(covariance)
+    # we'll flip the last axis where needed so that we always get a proper rotation rather than a reflection
+    sign = np.sign(np.linalg.det(np.einsum('mji,mkj->mik', vt, u)))
+    correction = np.tile(np.eye(3), (len(mobile), 1, 1))
+    correction[:, 2, 2] = sign
+    rotations = np.einsum('mji,mjk,mlk->mil', vt, correction, u)
+    return rotations, mobile_centres, target_centre
+
+
+def rmsd_after_superposition(mobile:np.ndarray, target:np.ndarray, rotations:np.ndarray, mobile_centres:np.ndarray, target_centre:np.ndarray) -> np.ndarray:
+    if mobile.shape[1] == 0:
+        return np.full(len(mobile), np.nan)
+    moved = np.einsum('mai,mji->maj', mobile - mobile_centres[:, None, :], rotations) + target_centre
+    return np.sqrt(((moved - target) ** 2).sum(axis=2).mean(axis=1))
+
+
+def find_crystal_structure(crystal_folder:str, pdb_code:str) -> Optional[str]:
+    for filename in [f"{pdb_code}.pdb", f"{pdb_code.upper()}.pdb", f"pdb{pdb_code}.ent"]:
+        filepath = f"{crystal_folder}/{filename}"
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+
+def find_model_files(folder:str, jobname:str) -> List[Tuple[str, int, str, str]]:
+    """
+    This function will find the ranked relaxed and unrelaxed model PDB files in a prediction folder, which may be archived.
+
+    Args:
+        folder (str): The prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+
+    Returns:
+        model_files (List[Tuple[str, int, str, str]]): A list of (kind, rank, model, filepath) tuples, kind being 'relaxed' or 'unrelaxed'
+    """
+    model_files = []
+    for filename in list_result_files(folder):
+        match = MODEL_FILENAME_PATTERN.search(filename)
+        if filename.startswith(f"{jobname}_") and match:
+            model_files.append((match.group(1), int(match.group(2)), match.group(3), f"{folder}/{filename}"))
+    return sorted(model_files)
+
+
+def evaluate_pdb_code(task:Dict) -> List[Dict]:
+    """
+    This function will evaluate every predicted model of one pdb_code against its crystal structure, run in a worker process.
+
+    Models with the same atoms are stacked so the superpositions and RMSDs for them are calculated together.
+
+    Args:
+        task (Dict): A dictionary with the pdb_code, crystal_filepath, crystal_chain_map, cache_folder and predictions (a list of dictionaries with the experiment_number, folder and jobname)
+
+    Returns:
+        rows (List[Dict]): One row per model with the groove CA RMSD after superposition and the peptide backbone and all atom RMSDs
+    """
+    crystal = load_coordinates(task['crystal_filepath'], task['cache_folder'])
+    crystal_keys = atom_keys(crystal, task['crystal_chain_map'])
+
+    # we'll group the models by their atom keys, so that the atom matching is only done once per group
+    groups = {}
+    for prediction in task['predictions']:
+        for kind, rank, model, filepath in find_model_files(prediction['folder'], prediction['jobname']):
+            coordinates = load_coordinates(filepath, task['cache_folder'])
+            keys = atom_keys(coordinates)
+            signature = hashlib.sha1(keys.tobytes()).hexdigest()
+            if signature not in groups:
+                groups[signature] = {'keys': keys, 'coordinates': coordinates, 'xyz': [], 'rows': []}
+            groups[signature]['xyz'].append(coordinates['xyz'])
+            groups[signature]['rows'].append({'experiment_number': prediction['experiment_number'], 'pdb_code': task['pdb_code'], 'kind': kind, 'rank': rank, 'model': model})
+
+    rows = []
+    for group in groups.values():
+        shared_keys, model_indices, crystal_indices = np.intersect1d(group['keys'], crystal_keys, return_indices=True)
+        selections = atom_selections(group['coordinates'], group['keys'])
+        models_xyz = np.stack(group['xyz']).astype(np.float64)
+        crystal_xyz = crystal['xyz'].astype(np.float64)
+
+        matched = {name: (model_indices[selection[model_indices]], crystal_indices[selection[model_indices]]) for name, selection in selections.items()}
+        groove_model, groove_crystal = matched['groove']
+        if len(groove_model) < 3:
+            continue
+        rotations, model_centres, crystal_centre = superpose_batch(models_xyz[:, groove_model], crystal_xyz[groove_crystal])
+
+        rmsds = {name: rmsd_after_superposition(models_xyz[:, model_atoms], crystal_xyz[crystal_atoms], rotations, model_centres, crystal_centre) for name, (model_atoms, crystal_atoms) in matched.items()}
+        for index, row in enumerate(group['rows']):
+            row['groove_ca_rmsd'] = round(float(rmsds['groove'][index]), 3)
+            row['peptide_backbone_rmsd'] = round(float(rmsds['peptide_backbone'][index]), 3)
+            row['peptide_all_atom_rmsd'] = round(float(rmsds['peptide_all_atom'][index]), 3)
+            row['peptide_backbone_atoms'] = len(matched['peptide_backbone'][0])
+            row['peptide_all_atoms'] = len(matched['peptide_all_atom'][0])
+            rows.append(row)
+    return rows
+
+
+def build_evaluation_tasks(config:Dict, crystal_folder:str, crystal_chain_map:Dict[str, str], cache_folder:str, experiment_numbers:Optional[List[str]]=None) -> Tuple[List[Dict], List[str]]:
+    """
+    This function will group the finished experiment predictions by pdb_code, one evaluation task per crystal structure.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        crystal_folder (str): The folder holding the crystal structure PDB files
+        crystal_chain_map (Dict[str, str]): A mapping from the crystal structure chain ids to the model chain ids
+        cache_folder (str): The folder holding the cached coordinates
+        experiment_numbers (List[str]): Only evaluate these experiments, or None for every experiment
+
+    Returns:
+        tasks (List[Dict]): The evaluation tasks
+        missing (List[str]): The pdb_codes with predictions but no crystal structure
+    """
+    completed = load_completion_index(make_filepath(config, 'output', 'experiments', 'completion_index.jsonl'))
+    predictions_by_pdb_code = {}
+    for index_key, entry in completed.items():
+        experiment_number, pdb_code = index_key.split('/')[-2:]
+        if experiment_numbers is not None and experiment_number not in experiment_numbers:
+            continue
+        predictions_by_pdb_code.setdefault(pdb_code, []).append({'experiment_number': experiment_number, 'folder': f"{config['PROJECT_FOLDER']}/{index_key}", 'jobname': entry['jobname']})
+
+    tasks = []
+    missing = []
+    for pdb_code, predictions in sorted(predictions_by_pdb_code.items()):
+        crystal_filepath = find_crystal_structure(crystal_folder, pdb_code)
+        if crystal_filepath is None:
+            missing.append(pdb_code)
+            continue
+        tasks.append({'pdb_code': pdb_code, 'crystal_filepath': crystal_filepath, 'crystal_chain_map': crystal_chain_map, 'cache_folder': cache_folder, 'predictions': predictions})
+    return tasks, missing
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="Only evaluate these experiments, separated by commas e.g. 31,32,33.")
+@click.option("--crystal_folder", default=None, help="The folder of crystal structure PDB files named by pdb_code, defaults to inputs/crystal_structures.")
+@click.option("--crystal_chains", default='A,B,C', help="The crystal structure chain ids of the heavy chain, B2M and peptide, in that order.")
+@click.option("--workers", default=None, type=int, help="The number of worker processes, defaults to the number of CPUs.")
+def evaluate_structures(environment, experiment_number, crystal_folder, crystal_chains, workers):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        if crystal_folder is None:
+            crystal_folder = f"{config['PROJECT_FOLDER']}/{config['INPUT_FOLDER']}/crystal_structures"
+        crystal_chain_map = dict(zip(crystal_chains.split(','), ['A', 'B', 'C']))
+        cache_folder = make_filepath(config, 'output', 'cache', 'coordinates')
+        evaluation_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}/evaluation"
+        if not os.path.exists(evaluation_folder):
+            os.makedirs(evaluation_folder)
+
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        tasks, missing = build_evaluation_tasks(config, crystal_folder, crystal_chain_map, cache_folder, experiment_numbers)
+        if missing:
+            console.print(f"[bold yellow]No crystal structure in {crystal_folder} for {len(missing)} pdb_codes: {', '.join(missing)}[/bold yellow]")
+
+        # we'll add the crystal structure resolution to each row, so the RMSDs can be judged against it
+        resolutions = {structure['pdb_code']: structure['resolution'] for structure in load_prediction_list(config)}
+
+        rows = []
+        with console.status(f"Evaluating {len(tasks)} structures...", spinner="dots"):
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                for task_rows in executor.map(evaluate_pdb_code, tasks):
+                    rows += task_rows
+
+        evaluation_filepath = f"{evaluation_folder}/peptide_rmsd.csv"
+        fieldnames = ['experiment_number', 'pdb_code', 'resolution', 'kind', 'rank', 'model', 'groove_ca_rmsd', 'peptide_backbone_rmsd', 'peptide_all_atom_rmsd', 'peptide_backbone_atoms', 'peptide_all_atoms']
+        with open(evaluation_filepath, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                row['resolution'] = resolutions.get(row['pdb_code'])
+                writer.writerow(row)
+        console.print(f"Wrote {len(rows)} model evaluations to {evaluation_filepath}")
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    evaluate_structures()
@@ -1,10 +1,14 @@
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import toml
 import csv
+import glob
 import json
 
 import os
+import sys
+
+from input_bundle import open_input_bundle, bundle_predictions, bundle_allele_sequence, bundle_b2m_sequence
 
 
 def make_filepath(config:Dict, in_or_out:str, foldername:str, filename:str) -> str:
@@ -89,6 +93,60 @@ def load_config(environment:str) -> Dict:
     return config
 
 
+def input_bundle_sources(config:Dict) -> Dict[str, str]:
+    """
+    This function will list the source files compiled into the input bundle.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+
+    Returns:
+        sources (Dict[str, str]): A dictionary with the source name as the key and its filepath as the value
+    """
+    sources = {'predictions': make_filepath(config, 'input', 'complexes', 'hla_class_i.csv')}
+    for locus in ['hla_a', 'hla_b', 'hla_c']:
+        sources[locus] = make_filepath(config, 'input', 'sequences', f"{locus}.json")
+    sources['b2m'] = make_filepath(config, 'input', 'sequences', 'human_b2m.json')
+    return sources
+
+
+def input_bundle_filepath(config:Dict) -> str:
+    return make_filepath(config, 'output', 'cache', 'input_bundle.bin')
+
+
+def journal_filepath(config:Dict, node:Optional[str]=None) -> str:
+    # nodes sharing the project folder each keep a journal of their own, as SQLite's file locking can't be relied on over a network filesystem
+    if node is not None:
+        return make_filepath(config, 'output', 'experiments', f"journals/{node}.sqlite")
+    return make_filepath(config, 'output', 'experiments', 'journal.sqlite')
+
+
+def journal_filepaths(config:Dict) -> List[str]:
+    """
+    This function will list every journal in the project folder, the journal of runs on a single node followed by the journal of each node of runs across several nodes.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+
+    Returns:
+        filepaths (List[str]): The paths of the journals which exist
+    """
+    filepaths = [journal_filepath(config)] + sorted(glob.glob(journal_filepath(config, '*')))
+    return [filepath for filepath in filepaths if os.path.exists(filepath)]
+
+
+def completion_index_filepath(config:Dict) -> str:
+    return make_filepath(config, 'output', 'experiments', 'completion_index.jsonl')
+
+
+def load_input_bundle(config:Dict) -> Optional[Dict]:
+    # there's no need for a bundle, the loaders read the source files if there isn't an up to date one, or it can't be read for any reason
+    try:
+        return open_input_bundle(input_bundle_sources(config), input_bundle_filepath(config))
+    except Exception:
+        return None
+
+
 def load_prediction_list(config:Dict) -> List:
     """
     This function will load the prediction list from the hla_class_i.csv file which is either hand generated or from a datasette query.
@@ -104,6 +162,9 @@ def load_prediction_list(config:Dict) -> List:
             pdb_code (str): The PDB code to predict
             resolution (str): The resolution of the PDB structure
     """
+    bundle = load_input_bundle(config)
+    if bundle is not None:
+        return bundle_predictions(bundle)
     with open(make_filepath(config, 'input', 'complexes', 'hla_class_i.csv'), "r") as allele_list_file:
         structures_to_predict = list(csv.DictReader(allele_list_file))
     return structures_to_predict
@@ -124,6 +185,13 @@ def load_allele_sequences(predictions_to_run:List[Dict], config:Dict) -> dict:
         allele_seq_dict (dict): A dictionary with the allele as the key and the sequence as the value
     """
     allele_list = sorted(list(set([prediction['allele_slug'] for prediction in predictions_to_run])))
+    bundle = load_input_bundle(config)
+    if bundle is not None:
+        try:
+            return {allele: bundle_allele_sequence(bundle, allele) for allele in allele_list}
+        except KeyError:
+            # the bundle only has the alleles with a canonical sequence, so for any other we'll read the source files as before
+            pass
     loci = ['hla_a', 'hla_b', 'hla_c']
     allele_seq_dict = {}
     locus_dict = {}
@@ -146,6 +214,9 @@ def load_b2m_sequence(config:Dict) -> str:
     Returns:
         b2m_seq (str): The canonical sequence of the B2M gene
     """
+    bundle = load_input_bundle(config)
+    if bundle is not None:
+        return bundle_b2m_sequence(bundle)
     with open(make_filepath(config, 'input', 'sequences', 'human_b2m.json'), "r") as b2m_file:
         b2m_seq = json.load(b2m_file)['canonical_sequence']
     return b2m_seq
@@ -174,6 +245,73 @@ def create_tmp_fasta_file(allele_sequences:Dict, prediction:Dict, b2m_seq:str, f
     return fasta_file
 
 
+def colabfold_jobname(name:str) -> str:
+    """
+    This function will turn a FASTA header or file stem into the jobname colabfold_batch uses to prefix its outputs.
+
+    Args:
+        name (str): The FASTA header (without the '>') or the input file stem
+
+    Returns:
+        jobname (str): The jobname, with anything other than letters, numbers, '_', '.' and '-' replaced by '_'
+    """
+    return "".join([character if character.isalnum() or character in ['_', '.', '-'] else '_' for character in name])
+
+
 def create_combined_sequence(allele_sequences:Dict, prediction:Dict, b2m_seq:str, length:int) -> str:
     prediction_sequence = f"{allele_sequences[prediction['allele_slug']][0:length]}{b2m_seq}{prediction['peptide_sequence']}"
-    return prediction_sequence
\ No newline at end of file
+    return prediction_sequence
+
+
+def build_colabfold_command(config:Dict, input_filepath:str, output_folder:str, gpu:str='all', container_name:str=None, interactive:bool=True, colabfold_options:str=None) -> str:
+    """
+    This function will build the docker command used to run colabfold_batch on a single input.
+
+    If the config sets COLABFOLD_BACKEND = 'stub' the command runs the stub colabfold_batch instead, which needs no GPU or docker.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        input_filepath (str): The in container filepath of the input (fasta/a3m file or folder)
+        output_folder (str): The in container filepath of the output folder
+        gpu (str): The GPU to run on, either 'all' or a device number
+        container_name (str): An optional name for the container, used so that it can be killed if it hangs
+        interactive (bool): Whether to attach a terminal to the container (-ti), only possible when run from a shell
+        colabfold_options (str): The colabfold_batch options to use instead of the COLABFOLD_OPTIONS in the config, e.g. without the relax options
+
+    Returns:
+        colabfold_command (str): The docker command to run
+    """
+    if colabfold_options is None:
+        colabfold_options = config['COLABFOLD_OPTIONS']
+    if config.get('COLABFOLD_BACKEND', 'docker') == 'stub':
+        return build_stub_colabfold_command(config, input_filepath, output_folder, colabfold_options)
+
+    if gpu == 'all':
+        gpu_field = "--gpus=all"
+    else:
+        gpu_field = f"--gpus=\"device={gpu}\""
+    terminal_field = "-ti " if interactive else ""
+    name_field = f"--name {container_name} " if container_name else ""
+    colabfold_command = f"docker run --user $(id -u) {terminal_field}--rm {name_field}{gpu_field} -v {config['AF_WEIGHTS_FOLDER']}:/cache:rw -v {config['PROJECT_FOLDER']}:/work:rw {config['CONTAINER_IMAGE']} colabfold_batch {colabfold_options} {input_filepath} {output_folder}"
+    return colabfold_command
+
+
+def build_stub_colabfold_command(config:Dict, input_filepath:str, output_folder:str, colabfold_options:str) -> str:
+    """
+    This function will build the command used to run the stub colabfold_batch, which writes the same output layout as colabfold without a GPU.
+
+    The stub takes the same in container paths as the docker command, and maps /work back to the project folder. Its latency and failures are set by the STUB_LATENCY, STUB_STARTUP, STUB_FAILURE_RATE, STUB_FAILURE_MODE and STUB_OUTPUTS config keys.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        input_filepath (str): The in container filepath of the input (fasta/a3m file or folder)
+        output_folder (str): The in container filepath of the output folder
+        colabfold_options (str): The colabfold_batch options
+
+    Returns:
+        colabfold_command (str): The stub command to run
+    """
+    stub_filepath = f"{os.path.dirname(os.path.abspath(__file__))}/stub_colabfold.py"
+    stub_options = f"--latency {config.get('STUB_LATENCY', 0)} --startup {config.get('STUB_STARTUP', 0)} --failure_rate {config.get('STUB_FAILURE_RATE', 0)} --failure_mode {config.get('STUB_FAILURE_MODE', 'crash')} --outputs {config.get('STUB_OUTPUTS', 'full')}"
+    colabfold_command = f"{sys.executable} {stub_filepath} --work_folder {config['PROJECT_FOLDER']} {stub_options} {colabfold_options} {input_filepath} {output_folder}"
+    return colabfold_command
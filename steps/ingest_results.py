@@ -0,0 +1,356 @@
+from typing import List, Dict, Tuple, Optional
+
+import datetime
+import glob
+import json
+import os
+import re
+import shutil
+import uuid
+import warnings
+import click
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from functions import load_config, load_b2m_sequence, make_filepath
+from manifest import load_completion_index
+from prediction_archive import list_result_files, load_result_json
+
+
+# the heavy chain is trimmed to 274 residues in create_combined_sequence, the first 180 of which are the alpha1/alpha2 peptide binding groove
+HEAVY_CHAIN_LENGTH = 274
+GROOVE_LENGTH = 180
+
+SCORES_FILENAME_PATTERN = re.compile(r"_scores_rank_(\d+)_(.+)\.json$")
+
+# the per prediction columns written to each shard, the residue level arrays are padded with NaN to the longest sequence in the shard
+METRIC_COLUMNS = ['experiment_number', 'pdb_code', 'rank', 'model', 'sequence_length', 'ptm', 'iptm', 'max_pae', 'mean_plddt', 'heavy_chain_plddt', 'peptide_plddt', 'peptide_groove_pae']
+
+
+def find_scores_files(folder:str, jobname:str) -> List[Tuple[int, str, str]]:
+    """
+    This function will find the per model scores files in a prediction folder, which may be archived.
+
+    Args:
+        folder (str): The prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+
+    Returns:
+        scores_files (List[Tuple[int, str, str]]): A list of (rank, model, filepath) tuples, ordered by rank
+    """
+    scores_files = []
+    for filename in list_result_files(folder):
+        match = SCORES_FILENAME_PATTERN.search(filename)
+        if filename.startswith(f"{jobname}_scores_rank_") and match:
+            scores_files.append((int(match.group(1)), match.group(2), f"{folder}/{filename}"))
+    return sorted(scores_files)
+
+
+def load_prediction_scores(folder:str, jobname:str) -> List[Dict]:
+    """
+    This function will load the scores of every ranked model in a prediction folder, which may be archived.
+
+    Args:
+        folder (str): The prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+
+    Returns:
+        records (List[Dict]): A list of dictionaries, one per model, with the rank, model, plddt and pae arrays and the ptm, iptm and max_pae scores
+    """
+    records = []
+    for rank, model, filepath in find_scores_files(folder, jobname):
+        scores = load_result_json(filepath, pae_as_array=True)
+        records.append({
+            'rank': rank,
+            'model': model,
+            'plddt': np.asarray(scores['plddt'], dtype=np.float32),
+            'pae': np.asarray(scores['pae'], dtype=np.float16),
+            'ptm': scores.get('ptm', np.nan),
+            'iptm': scores.get('iptm', np.nan),
+            'max_pae': scores.get('max_pae', np.nan)
+        })
+    return records
+
+
+def compute_segment_metrics(plddt:np.ndarray, pae:np.ndarray, b2m_length:int) -> Dict[str, np.ndarray]:
+    """
+    This function will compute the chain segment metrics for a stack of predictions in one go.
+
+    The sequences are the heavy chain (274 residues), then B2M, then the peptide, so the peptide is whatever follows the B2M. Residues past the end of a shorter sequence are NaN, so they drop out of the means.
+
+    Args:
+        plddt (np.ndarray): The per residue pLDDT, shape (predictions, residues), padded with NaN
+        pae (np.ndarray): The PAE matrices, shape (predictions, residues, residues), padded with NaN
+        b2m_length (int): The length of the B2M sequence
+
+    Returns:
+        metrics (Dict[str, np.ndarray]): The mean_plddt, heavy_chain_plddt, peptide_plddt and peptide_groove_pae for each prediction
+    """
+    peptide_start = HEAVY_CHAIN_LENGTH + b2m_length
+    # the interface PAE is the mean of the peptide->groove and groove->peptide blocks of the PAE matrix
+    interface_pae = np.concatenate([
+        pae[:, peptide_start:, :GROOVE_LENGTH].astype(np.float32).reshape(len(pae), -1),
+        pae[:, :GROOVE_LENGTH, peptide_start:].astype(np.float32).reshape(len(pae), -1)
+    ], axis=1)
+    with warnings.catch_warnings():
+        # a prediction without a peptide has an empty slice, which we're happy to leave as NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        return {
+            'mean_plddt': np.nanmean(plddt, axis=1),
+            'heavy_chain_plddt': np.nanmean(plddt[:, :HEAVY_CHAIN_LENGTH], axis=1),
+            'peptide_plddt': np.nanmean(plddt[:, peptide_start:], axis=1),
+            'peptide_groove_pae': np.nanmean(interface_pae, axis=1)
+        }
+
+
+def write_shard(shard_folder:str, arrays:Dict[str, np.ndarray]) -> None:
+    """
+    This function will write a shard of results as one .npy file per column, so each column can be memory mapped on its own.
+
+    The shard is written to a temporary folder and renamed into place, so a crash never leaves a partial shard.
+
+    Args:
+        shard_folder (str): The folder to write the shard to
+        arrays (Dict[str, np.ndarray]): The columns of the shard
+    """
+    tmp_shard_folder = f"{shard_folder}.tmp"
+    if os.path.exists(tmp_shard_folder):
+        shutil.rmtree(tmp_shard_folder)
+    os.makedirs(tmp_shard_folder)
+    for name, array in arrays.items():
+        np.save(f"{tmp_shard_folder}/{name}.npy", array)
+    os.rename(tmp_shard_folder, shard_folder)
+
+
+def build_shard(folders:List[Dict], b2m_length:int) -> Optional[Dict[str, np.ndarray]]:
+    """
+    This function will load the scores of a list of prediction folders and stack them into the columns of a shard.
+
+    Args:
+        folders (List[Dict]): A list of dictionaries with the experiment_number, pdb_code, folder and jobname of each prediction
+        b2m_length (int): The length of the B2M sequence
+
+    Returns:
+        arrays (Dict[str, np.ndarray]): The columns of the shard, or None if none of the folders had any scores
+    """
+    rows = []
+    for prediction in folders:
+        for record in load_prediction_scores(prediction['folder'], prediction['jobname']):
+            record['experiment_number'] = prediction['experiment_number']
+            record['pdb_code'] = prediction['pdb_code']
+            rows.append(record)
+    if len(rows) == 0:
+        return None
+
+    max_length = max(len(row['plddt']) for row in rows)
+    plddt = np.full((len(rows), max_length), np.nan, dtype=np.float32)
+    pae = np.full((len(rows), max_length, max_length), np.nan, dtype=np.float16)
+    for index, row in enumerate(rows):
+        length = len(row['plddt'])
+        plddt[index, :length] = row['plddt']
+        pae[index, :length, :length] = row['pae']
+
+    arrays = {
+        'experiment_number': np.array([row['experiment_number'] for row in rows]),
+        'pdb_code': np.array([row['pdb_code'] for row in rows]),
+        'rank': np.array([row['rank'] for row in rows], dtype=np.int16),
+        'model': np.array([row['model'] for row in rows]),
+        'sequence_length': np.array([len(row['plddt']) for row in rows], dtype=np.int32),
+        'ptm': np.array([row['ptm'] for row in rows], dtype=np.float32),
+        'iptm': np.array([row['iptm'] for row in rows], dtype=np.float32),
+        'max_pae': np.array([row['max_pae'] for row in rows], dtype=np.float32),
+        'plddt': plddt,
+        'pae': pae
+    }
+    arrays.update({name: values.astype(np.float32) for name, values in compute_segment_metrics(plddt, pae, b2m_length).items()})
+    return arrays
+
+
+def load_ingested(results_folder:str) -> Dict[str, Optional[str]]:
+    # a folder's latest line wins, so a prediction ingested again after it was run again is keyed on its new manifest
+    ingested = {}
+    ingested_filepath = f"{results_folder}/ingested.jsonl"
+    if os.path.exists(ingested_filepath):
+        with open(ingested_filepath, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                ingested[entry['folder']] = entry.get('manifest_sha256')
+    return ingested
+
+
+def find_new_predictions(config:Dict, results_folder:str, experiment_numbers:Optional[List[str]]=None) -> List[Dict]:
+    """
+    This function will find the finished experiment predictions which haven't been ingested yet, or have been run again since they were ingested, from the completion index.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        results_folder (str): The folder holding the ingested results
+        experiment_numbers (List[str]): Only look at these experiments, or None for every experiment
+
+    Returns:
+        predictions (List[Dict]): A list of dictionaries with the experiment_number, pdb_code, folder, index_key, jobname and manifest_sha256 of each new prediction
+    """
+    ingested = load_ingested(results_folder)
+    completed = load_completion_index(make_filepath(config, 'output', 'experiments', 'completion_index.jsonl'))
+    predictions = []
+    for index_key, entry in completed.items():
+        # the manifest changes when a prediction is run again, as it does in the results database
+        if index_key in ingested and ingested[index_key] == entry.get('manifest_sha256'):
+            continue
+        experiment_number, pdb_code = index_key.split('/')[-2:]
+        if experiment_numbers is not None and experiment_number not in experiment_numbers:
+            continue
+        predictions.append({
+            'experiment_number': experiment_number,
+            'pdb_code': pdb_code,
+            'folder': f"{config['PROJECT_FOLDER']}/{index_key}",
+            'index_key': index_key,
+            'jobname': entry['jobname'],
+            'manifest_sha256': entry.get('manifest_sha256')
+        })
+    return predictions
+
+
+def ingest_predictions(config:Dict, results_folder:str, predictions:List[Dict], shard_size:int, b2m_length:int) -> int:
+    """
+    This function will stream a list of prediction folders into shards of the columnar results store, a shard at a time.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        results_folder (str): The folder holding the ingested results
+        predictions (List[Dict]): The predictions returned by find_new_predictions
+        shard_size (int): The number of prediction folders per shard
+        b2m_length (int): The length of the B2M sequence
+
+    Returns:
+        rows (int): The number of ranked models ingested
+    """
+    shards_folder = f"{results_folder}/shards"
+    if not os.path.exists(shards_folder):
+        os.makedirs(shards_folder)
+    # the random suffix keeps the shards of two ingests started in the same second apart
+    shard_prefix = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    rows = 0
+    for shard_number, start in enumerate(range(0, len(predictions), shard_size)):
+        shard_predictions = predictions[start:start + shard_size]
+        arrays = build_shard(shard_predictions, b2m_length)
+        if arrays is not None:
+            write_shard(f"{shards_folder}/{shard_prefix}_{shard_number:05d}", arrays)
+            rows += len(arrays['rank'])
+        # we'll only record the folders as ingested once their shard is safely written
+        with open(f"{results_folder}/ingested.jsonl", 'a') as f:
+            for prediction in shard_predictions:
+                f.write(json.dumps({'folder': prediction['index_key'], 'manifest_sha256': prediction['manifest_sha256']}) + '\n')
+    return rows
+
+
+def find_current_rows(shard_folders:List[str]) -> List[Optional[np.ndarray]]:
+    """
+    This function will find the rows of each shard which are still current, as a prediction run again after it was ingested is ingested again into a later shard.
+
+    Args:
+        shard_folders (List[str]): The shard folders, oldest first
+
+    Returns:
+        current (List[Optional[np.ndarray]]): A boolean mask of the current rows for each shard, or None if every row of the shard is current
+    """
+    seen = set()
+    current = [None] * len(shard_folders)
+    # the shards are named after the time they were written, so we'll work back from the latest
+    for position in reversed(range(len(shard_folders))):
+        experiment_numbers = np.load(f"{shard_folders[position]}/experiment_number.npy")
+        pdb_codes = np.load(f"{shard_folders[position]}/pdb_code.npy")
+        keys = [f"{experiment_number}/{pdb_code}" for experiment_number, pdb_code in zip(experiment_numbers, pdb_codes)]
+        mask = np.array([key not in seen for key in keys], dtype=bool)
+        seen.update(keys)
+        current[position] = None if mask.all() else mask
+    return current
+
+
+def load_results(results_folder:str, columns:Optional[List[str]]=None, mmap:bool=True) -> Dict[str, np.ndarray]:
+    """
+    This function will load columns from every shard of the results store.
+
+    The per prediction columns are small and are concatenated, the residue level columns (plddt and pae) are returned as a list of memory mapped arrays, one per shard, as the shards may be padded to different lengths. Rows superseded by a prediction ingested again are left out, which reads those shards' arrays into memory.
+
+    Args:
+        results_folder (str): The folder holding the ingested results
+        columns (List[str]): The columns to load, or None for the per prediction metric columns
+        mmap (bool): Whether to memory map the arrays rather than read them into memory
+
+    Returns:
+        results (Dict[str, np.ndarray]): A dictionary with the column name as the key and the values as the value
+    """
+    columns = columns or METRIC_COLUMNS
+    shard_folders = sorted(glob.glob(f"{results_folder}/shards/*[0-9]"))
+    current = find_current_rows(shard_folders)
+    results = {}
+    for column in columns:
+        arrays = [np.load(f"{shard_folder}/{column}.npy", mmap_mode='r' if mmap else None) for shard_folder in shard_folders]
+        arrays = [array if mask is None else array[mask] for array, mask in zip(arrays, current)]
+        if column in ['plddt', 'pae']:
+            results[column] = arrays
+        else:
+            results[column] = np.concatenate(arrays) if arrays else np.array([])
+    return results
+
+
+def print_summary(results:Dict[str, np.ndarray], console:Console) -> None:
+    """
+    This function will print a summary of the top ranked model for each experiment.
+
+    Args:
+        results (Dict[str, np.ndarray]): The metric columns returned by load_results
+        console (Console): The rich console to print to
+    """
+    table = Table(title="Top ranked model by experiment")
+    for heading in ['Experiment', 'Structures', 'Peptide pLDDT', 'Peptide:groove PAE', 'pTM', 'ipTM']:
+        table.add_column(heading)
+    top_ranked = results['rank'] == 1
+    experiments = np.unique(results['experiment_number'][top_ranked])
+    for experiment_number in sorted(experiments, key=lambda number: (len(number), number)):
+        selected = top_ranked & (results['experiment_number'] == experiment_number)
+        table.add_row(experiment_number, str(int(selected.sum())), f"{np.nanmean(results['peptide_plddt'][selected]):.1f}", f"{np.nanmean(results['peptide_groove_pae'][selected]):.2f}", f"{np.nanmean(results['ptm'][selected]):.3f}", f"{np.nanmean(results['iptm'][selected]):.3f}")
+    console.print(table)
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="Only ingest these experiments, separated by commas e.g. 31,32,33.")
+@click.option("--shard_size", default=50, help="The number of prediction folders written to each shard.")
+def ingest_results(environment, experiment_number, shard_size):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        results_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}/results"
+        if not os.path.exists(results_folder):
+            os.makedirs(results_folder)
+
+        # we'll need the B2M length to find where the peptide starts in each sequence
+        b2m_length = len(load_b2m_sequence(config))
+
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        predictions = find_new_predictions(config, results_folder, experiment_numbers)
+        console.print(f"Found {len(predictions)} new predictions to ingest")
+
+        with console.status("Ingesting results...", spinner="dots"):
+            rows = ingest_predictions(config, results_folder, predictions, shard_size, b2m_length)
+        console.print(f"Ingested {rows} ranked models")
+
+        results = load_results(results_folder)
+        if len(results['rank']) > 0:
+            print_summary(results, console)
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    ingest_results()
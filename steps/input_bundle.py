@@ -0,0 +1,180 @@
+from typing import Dict, List, Optional
+
+import csv
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+
+# the bundle is a header, a JSON index and then every sequence, back to back, which is memory mapped when the bundle is opened
+BUNDLE_MAGIC = b'HLABNDL1'
+BUNDLE_VERSION = 1
+HEADER_FORMAT = '<8sQ'
+
+# bundles opened by this process, keyed by filepath, so loaders called again don't re-read the index
+open_bundles = {}
+open_bundles_lock = threading.Lock()
+
+
+def file_checksum(filepath:str) -> str:
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def describe_source(filepath:str) -> Dict:
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': file_checksum(filepath)}
+
+
+def compile_input_bundle(sources:Dict[str, str], bundle_filepath:str) -> Dict:
+    """
+    This function will compile the prediction list, the locus files and the B2M sequence into one indexed bundle.
+
+    Every canonical sequence in the locus files is stored, not only those in the prediction list, so the bundle stays valid whichever structures are run. The bundle is written to a temporary file and renamed into place, so processes reading it never see half of one.
+
+    Args:
+        sources (Dict[str, str]): A dictionary with the source name as the key and its filepath as the value, from input_bundle_sources
+        bundle_filepath (str): The path to write the bundle to
+
+    Returns:
+        stats (Dict): A dictionary with the number of predictions, the number of alleles and the size of the bundle in bytes
+    """
+    # we'll describe the sources before reading them, so a source changed while compiling makes the bundle stale rather than wrong
+    described_sources = {name: describe_source(filepath) for name, filepath in sources.items()}
+
+    with open(sources['predictions'], 'r') as allele_list_file:
+        predictions = list(csv.DictReader(allele_list_file))
+
+    sequences = bytearray()
+    alleles = {}
+    for name in sorted(sources):
+        if not name.startswith('hla_'):
+            continue
+        with open(sources[name], 'r') as locus_file:
+            locus_dict = json.load(locus_file)
+        for allele_slug, allele in locus_dict.items():
+            if isinstance(allele, dict) and allele.get('canonical_sequence'):
+                encoded = allele['canonical_sequence'].encode()
+                alleles[allele_slug] = [len(sequences), len(encoded)]
+                sequences.extend(encoded)
+
+    with open(sources['b2m'], 'r') as b2m_file:
+        encoded = json.load(b2m_file)['canonical_sequence'].encode()
+    b2m = [len(sequences), len(encoded)]
+    sequences.extend(encoded)
+
+    index = {
+        'version': BUNDLE_VERSION,
+        'sources': described_sources,
+        'predictions': predictions,
+        'alleles': alleles,
+        'b2m': b2m
+    }
+    encoded_index = json.dumps(index, separators=(',', ':')).encode()
+
+    bundle_folder = os.path.dirname(bundle_filepath)
+    if bundle_folder and not os.path.exists(bundle_folder):
+        os.makedirs(bundle_folder, exist_ok=True)
+    tmp_filepath = f"{bundle_filepath}.{os.getpid()}_{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, BUNDLE_MAGIC, len(encoded_index)))
+        f.write(encoded_index)
+        f.write(sequences)
+    os.replace(tmp_filepath, bundle_filepath)
+    return {'predictions': len(predictions), 'alleles': len(alleles), 'bytes': os.path.getsize(bundle_filepath)}
+
+
+def read_bundle(bundle_filepath:str) -> Dict:
+    with open(bundle_filepath, 'rb') as f:
+        magic, index_length = struct.unpack(HEADER_FORMAT, f.read(struct.calcsize(HEADER_FORMAT)))
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f"{bundle_filepath} is not an input bundle")
+        index = json.loads(f.read(index_length))
+        # the sequences are read through the page cache, so every process on the node shares one copy of them
+        sequences = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    stat = os.stat(bundle_filepath)
+    return {
+        'filepath': bundle_filepath,
+        'identity': (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+        'index': index,
+        'sequences': sequences,
+        'offset': struct.calcsize(HEADER_FORMAT) + index_length,
+        # sources whose stat changed but whose checksum still matched, so we don't hash them on every call
+        'verified': {}
+    }
+
+
+def source_unchanged(bundle:Dict, name:str, filepath:str) -> bool:
+    described = bundle['index']['sources'].get(name)
+    if described is None:
+        return False
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    if stat.st_size != described['size']:
+        return False
+    if stat.st_mtime_ns == described['mtime_ns']:
+        return True
+    # the file was touched (or copied) since the bundle was compiled, so we'll check whether its contents changed
+    identity = (stat.st_size, stat.st_mtime_ns)
+    if identity not in bundle['verified']:
+        bundle['verified'][identity] = file_checksum(filepath) == described['sha1']
+    return bundle['verified'][identity]
+
+
+def open_input_bundle(sources:Dict[str, str], bundle_filepath:str) -> Optional[Dict]:
+    """
+    This function will open the input bundle, as long as it was compiled from the current source files.
+
+    A source file is treated as unchanged if its size and modification time match those recorded when the bundle was compiled, or failing that if its checksum does. The bundle is only read once per process, unless it is recompiled.
+
+    Args:
+        sources (Dict[str, str]): A dictionary with the source name as the key and its filepath as the value, from input_bundle_sources
+        bundle_filepath (str): The path of the bundle
+
+    Returns:
+        bundle (Dict): The opened bundle, or None if there is no bundle or it is stale, in which case the source files should be read instead
+    """
+    try:
+        stat = os.stat(bundle_filepath)
+    except FileNotFoundError:
+        return None
+    with open_bundles_lock:
+        bundle = open_bundles.get(bundle_filepath)
+        if bundle is None or bundle['identity'] != (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            try:
+                bundle = read_bundle(bundle_filepath)
+            except (OSError, ValueError, struct.error):
+                return None
+            open_bundles[bundle_filepath] = bundle
+        if bundle['index'].get('version') != BUNDLE_VERSION or set(bundle['index']['sources']) != set(sources):
+            return None
+        for name, filepath in sources.items():
+            if not source_unchanged(bundle, name, filepath):
+                return None
+    return bundle
+
+
+def bundle_sequence(bundle:Dict, location:List[int]) -> str:
+    start = bundle['offset'] + location[0]
+    return bundle['sequences'][start:start + location[1]].decode()
+
+
+def bundle_predictions(bundle:Dict) -> List[Dict]:
+    # the callers are free to change the dictionaries they get back, so we'll give them copies
+    return [dict(prediction) for prediction in bundle['index']['predictions']]
+
+
+def bundle_allele_sequence(bundle:Dict, allele_slug:str) -> str:
+    return bundle_sequence(bundle, bundle['index']['alleles'][allele_slug])
+
+
+def bundle_b2m_sequence(bundle:Dict) -> str:
+    return bundle_sequence(bundle, bundle['index']['b2m'])
@@ -0,0 +1,241 @@
+from typing import Dict, List, Optional
+
+import contextlib
+import datetime
+import json
+import os
+import socket
+import sqlite3
+import threading
+
+
+# the log fields that get their own columns, anything else is kept in the details column
+JOB_COLUMNS = ['status', 'start_time', 'end_time', 'elapsed_time', 'gpu']
+
+# WAL needs shared memory between the processes using the journal, which nodes sharing a network filesystem don't have,
+# so the journals of runs spread across nodes use the rollback journal. File locks can't be relied on over a network filesystem either,
+# so each node only writes to a journal of its own, and other nodes only read it
+LOCAL_JOURNAL_MODE = 'WAL'
+SHARED_JOURNAL_MODE = 'DELETE'
+
+# the journals this process has created the tables of, so each status change and span only has to connect
+initialised_journals = set()
+initialised_journals_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def open_journal(filepath:str, journal_mode:Optional[str]=LOCAL_JOURNAL_MODE):
+    """
+    This function will open the experiment journal, a SQLite database of job status shared by every worker and process working on the experiments.
+
+    The journal mode is set and the tables created the first time each process opens a journal, or if the file has gone since.
+
+    Args:
+        filepath (str): The path to the journal database
+        journal_mode (str): The SQLite journal mode, LOCAL_JOURNAL_MODE or SHARED_JOURNAL_MODE for the journal of a node sharing the project folder with others, or None to read a journal as it is e.g. another node's
+
+    Yields:
+        connection (sqlite3.Connection): A connection to the journal, which is closed afterwards
+    """
+    folder = os.path.dirname(filepath)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    journal_key = (os.path.abspath(filepath), journal_mode)
+    initialised = journal_key in initialised_journals and os.path.exists(filepath)
+    # a generous timeout lets writers from other workers wait their turn rather than fail
+    connection = sqlite3.connect(filepath, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        connection.execute("PRAGMA synchronous=NORMAL")
+        if not initialised and journal_mode is not None:
+            create_journal_tables(connection, journal_mode)
+            with initialised_journals_lock:
+                initialised_journals.add(journal_key)
+        yield connection
+    finally:
+        connection.close()
+
+
+def create_journal_tables(connection:sqlite3.Connection, journal_mode:str) -> None:
+    # these only have to run once per process, see open_journal, rather than for every connection
+    connection.execute(f"PRAGMA journal_mode={journal_mode}")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            experiment_number TEXT NOT NULL,
+            pdb_code TEXT NOT NULL,
+            status TEXT NOT NULL,
+            start_time TEXT,
+            end_time TEXT,
+            elapsed_time REAL,
+            gpu TEXT,
+            details TEXT NOT NULL DEFAULT '{}',
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (experiment_number, pdb_code)
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (experiment_number, status)")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS transitions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            experiment_number TEXT NOT NULL,
+            pdb_code TEXT NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            at TEXT NOT NULL
+        )
+    """)
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS spans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            experiment_number TEXT NOT NULL,
+            pdb_code TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            source TEXT NOT NULL,
+            start_time TEXT,
+            end_time TEXT,
+            duration REAL NOT NULL,
+            attributes TEXT NOT NULL DEFAULT '{}'
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS spans_experiment ON spans (experiment_number, stage)")
+
+
+def row_to_log_entry(row:sqlite3.Row) -> Dict:
+    # we'll rebuild the same shape of entry as the old log.json files, leaving out the empty columns
+    entry = {column: row[column] for column in JOB_COLUMNS if row[column] is not None}
+    entry.update(json.loads(row['details']))
+    return entry
+
+
+def get_job(filepath:str, experiment_number:str, pdb_code:str, journal_mode:str=LOCAL_JOURNAL_MODE) -> Optional[Dict]:
+    """
+    This function will get the journal entry for a single job.
+
+    Args:
+        filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        pdb_code (str): The PDB code
+        journal_mode (str): The SQLite journal mode, see open_journal
+
+    Returns:
+        entry (Dict): The log entry for the job, or None if the job isn't in the journal
+    """
+    with open_journal(filepath, journal_mode) as connection:
+        row = connection.execute("SELECT * FROM jobs WHERE experiment_number = ? AND pdb_code = ?", (experiment_number, pdb_code)).fetchone()
+    return row_to_log_entry(row) if row is not None else None
+
+
+def list_jobs(filepath:str, experiment_number:str, statuses:Optional[List[str]]=None, journal_mode:Optional[str]=LOCAL_JOURNAL_MODE) -> Dict[str, Dict]:
+    """
+    This function will get the journal entries for an experiment, optionally only those with the given statuses.
+
+    Args:
+        filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        statuses (List[str]): The statuses to return, or None for every job
+        journal_mode (str): The SQLite journal mode, see open_journal
+
+    Returns:
+        log (Dict[str, Dict]): A dictionary with the pdb_code as the key and the log entry as the value
+    """
+    query = "SELECT * FROM jobs WHERE experiment_number = ?"
+    parameters = [experiment_number]
+    if statuses is not None:
+        query += f" AND status IN ({','.join('?' for status in statuses)})"
+        parameters += statuses
+    with open_journal(filepath, journal_mode) as connection:
+        rows = connection.execute(query, parameters).fetchall()
+    return {row['pdb_code']: row_to_log_entry(row) for row in rows}
+
+
+def transition_job(filepath:str, experiment_number:str, pdb_code:str, changes:Dict, unless_status:Optional[List[str]]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> bool:
+    """
+    This function will atomically update the journal entry for a job, creating it if it doesn't exist.
+
+    Args:
+        filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        pdb_code (str): The PDB code
+        changes (Dict): The keys and values to set on the entry, usually including a new 'status'
+        unless_status (List[str]): If the job currently has one of these statuses it is left alone, e.g. ['done'] stops a job being restarted once another worker has finished it
+        journal_mode (str): The SQLite journal mode, see open_journal
+
+    Returns:
+        updated (bool): True if the entry was updated, False if it was left alone because of unless_status
+    """
+    now = datetime.datetime.now().isoformat()
+    with open_journal(filepath, journal_mode) as connection:
+        # BEGIN IMMEDIATE takes the write lock up front, so the read and the write below can't be interleaved with another writer
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT * FROM jobs WHERE experiment_number = ? AND pdb_code = ?", (experiment_number, pdb_code)).fetchone()
+            current = row_to_log_entry(row) if row is not None else {}
+            from_status = current.get('status')
+            if unless_status is not None and from_status in unless_status:
+                connection.execute("ROLLBACK")
+                return False
+            current.update(changes)
+            columns = {column: current.pop(column, None) for column in JOB_COLUMNS}
+            if columns['status'] is None:
+                columns['status'] = 'preparing'
+            connection.execute("""
+                INSERT OR REPLACE INTO jobs (experiment_number, pdb_code, status, start_time, end_time, elapsed_time, gpu, details, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (experiment_number, pdb_code, columns['status'], columns['start_time'], columns['end_time'], columns['elapsed_time'], columns['gpu'], json.dumps(current), now))
+            if columns['status'] != from_status:
+                connection.execute("INSERT INTO transitions (experiment_number, pdb_code, from_status, to_status, at) VALUES (?, ?, ?, ?, ?)", (experiment_number, pdb_code, from_status, columns['status'], now))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+    return True
+
+
+def import_log_json(filepath:str, experiment_number:str, log_filepath:str, journal_mode:str=LOCAL_JOURNAL_MODE) -> int:
+    """
+    This function will import an old style log.json file into the journal, so past experiments carry over.
+
+    Args:
+        filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        log_filepath (str): The path to the log.json file
+        journal_mode (str): The SQLite journal mode, see open_journal
+
+    Returns:
+        imported (int): The number of entries imported
+    """
+    with open(log_filepath, 'r') as f:
+        experiment_log = json.load(f)
+    for pdb_code, entry in experiment_log.items():
+        transition_job(filepath, experiment_number, pdb_code, entry, journal_mode=journal_mode)
+    return len(experiment_log)
+
+
+def export_log_json(filepath:str, experiment_number:str, log_filepath:str, journal_mode:str=LOCAL_JOURNAL_MODE, other_filepaths:Optional[List[str]]=None) -> Dict[str, Dict]:
+    """
+    This function will export the journal entries for an experiment as an old style log.json file, written atomically.
+
+    Args:
+        filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        log_filepath (str): The path to write the log.json file to
+        journal_mode (str): The SQLite journal mode, see open_journal
+        other_filepaths (List[str]): The journals of the other nodes sharing the project folder, a job done on any of them is exported as done
+
+    Returns:
+        experiment_log (Dict[str, Dict]): The exported log
+    """
+    experiment_log = list_jobs(filepath, experiment_number, journal_mode=journal_mode)
+    for other_filepath in other_filepaths or []:
+        if os.path.abspath(other_filepath) == os.path.abspath(filepath):
+            continue
+        try:
+            experiment_log.update(list_jobs(other_filepath, experiment_number, ['done'], journal_mode=None))
+        except sqlite3.Error:
+            # a node part of the way through writing its journal is left out, its jobs are in the next export
+            continue
+    tmp_filepath = f"{log_filepath}.{socket.gethostname()}_{os.getpid()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(experiment_log, f, indent=4)
+    os.replace(tmp_filepath, log_filepath)
+    return experiment_log
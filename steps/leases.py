@@ -0,0 +1,317 @@
+from typing import Callable, Dict, Optional, Set, Tuple
+
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+
+def create_lease_owner() -> str:
+    """
+    This function will create an identifier for this process, unique across every node sharing the project folder.
+
+    Returns:
+        owner (str): The owner identifier e.g. gpu-node-2:41872:1c9e0a
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+def read_lease(lease_filepath:str) -> Optional[Dict]:
+    try:
+        with open(lease_filepath, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        # a lease being written by another node may be empty for a moment, which we'll treat as held
+        return None if not os.path.exists(lease_filepath) else {}
+
+
+def lease_age(lease_filepath:str) -> Optional[float]:
+    # the heartbeat touches the lease file, so its age is the time since the holder last showed it was alive
+    try:
+        return time.time() - os.stat(lease_filepath).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def acquire_lease(lease_filepath:str, owner:str, ttl:float) -> bool:
+    """
+    This function will try to claim a job by creating its lease file, taking over the lease if its holder has stopped heartbeating for longer than the ttl.
+
+    Creating the file with O_EXCL is atomic, so only one process can create it. An expired lease is never removed, only replaced by take_over_lease, so the lease file always exists while anyone holds or is taking over the lease.
+
+    Args:
+        lease_filepath (str): The path of the lease file
+        owner (str): The owner identifier returned by create_lease_owner
+        ttl (float): The number of seconds without a heartbeat after which a lease has expired
+
+    Returns:
+        acquired (bool): True if this process now holds the lease
+    """
+    lease_folder = os.path.dirname(lease_filepath)
+    if lease_folder and not os.path.exists(lease_folder):
+        os.makedirs(lease_folder, exist_ok=True)
+    lease = {'owner': owner, 'host': socket.gethostname(), 'pid': os.getpid(), 'acquired': time.time()}
+
+    for attempt in range(2):
+        try:
+            lease_file = os.open(lease_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            if attempt > 0:
+                return False
+            try:
+                expired_stat = os.stat(lease_filepath)
+            except FileNotFoundError:
+                # the holder released the lease after we tried, we'll have one more go at creating it
+                continue
+            if time.time() - expired_stat.st_mtime <= ttl:
+                return False
+            return take_over_lease(lease_filepath, lease, expired_stat, ttl)
+        with os.fdopen(lease_file, 'w') as f:
+            json.dump(lease, f)
+        return True
+    return False
+
+
+def take_over_lease(lease_filepath:str, lease:Dict, expired_stat:os.stat_result, ttl:float) -> bool:
+    """
+    This function will replace an expired lease with a new one, as long as the lease file is still the one which was found to have expired.
+
+    Only one process at a time takes over a lease, by creating a takeover file next to it with O_EXCL. The new lease is written to a file of its own and moved over the expired one with os.replace, so the lease file is never missing and no other process can create a lease of its own in the meantime.
+
+    Args:
+        lease_filepath (str): The path of the lease file
+        lease (Dict): The new lease, with the owner identifier of this process
+        expired_stat (os.stat_result): The os.stat of the lease file when it was found to have expired
+        ttl (float): The number of seconds without a heartbeat after which a lease has expired
+
+    Returns:
+        acquired (bool): True if this process now holds the lease
+    """
+    takeover_filepath = f"{lease_filepath}.takeover"
+    try:
+        os.close(os.open(takeover_filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+    except FileExistsError:
+        # a process which died part way through a takeover leaves its takeover file behind, we'll clear it so the next attempt can go ahead
+        age = lease_age(takeover_filepath)
+        if age is not None and age > ttl:
+            try:
+                os.remove(takeover_filepath)
+            except FileNotFoundError:
+                pass
+        return False
+
+    try:
+        # if the lease was renewed, released or replaced since we found it had expired, it isn't ours to take
+        try:
+            lease_stat = os.stat(lease_filepath)
+        except FileNotFoundError:
+            return False
+        if (lease_stat.st_ino, lease_stat.st_mtime_ns) != (expired_stat.st_ino, expired_stat.st_mtime_ns):
+            return False
+        new_lease_filepath = f"{lease_filepath}.{lease['owner'].replace(':', '_')}.new"
+        with open(new_lease_filepath, 'w') as f:
+            json.dump(lease, f)
+        os.replace(new_lease_filepath, lease_filepath)
+    finally:
+        os.remove(takeover_filepath)
+
+    # a takeover file cleared while we held it could let another process replace the lease too, so we'll check whose it is now
+    current_lease = read_lease(lease_filepath)
+    return bool(current_lease) and current_lease.get('owner') == lease['owner']
+
+
+def renew_lease(lease_filepath:str, owner:str) -> bool:
+    """
+    This function will heartbeat a lease by touching its file, as long as it is still held by the owner.
+
+    Args:
+        lease_filepath (str): The path of the lease file
+        owner (str): The owner identifier returned by create_lease_owner
+
+    Returns:
+        renewed (bool): False if the lease has been lost, e.g. it expired and another node took it over
+    """
+    lease = read_lease(lease_filepath)
+    if not lease or lease.get('owner') != owner:
+        return False
+    try:
+        os.utime(lease_filepath)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def release_lease(lease_filepath:str, owner:str) -> None:
+    lease = read_lease(lease_filepath)
+    if lease and lease.get('owner') == owner:
+        try:
+            os.remove(lease_filepath)
+        except FileNotFoundError:
+            pass
+
+
+def start_lease_heartbeat(held_leases:Dict[str, str], lock:threading.Lock, interval:float, on_lost:Optional[Callable[[str], None]]=None) -> threading.Event:
+    """
+    This function will start a background thread which renews every lease held by this process every interval seconds.
+
+    Args:
+        held_leases (Dict[str, str]): A dictionary with the lease filepath as the key and the owner as the value, updated by the caller as leases are acquired and released
+        lock (threading.Lock): The lock guarding held_leases
+        interval (float): The number of seconds between heartbeats, well under the lease ttl
+        on_lost (Callable): An optional function called with the lease filepath when a lease is found to have been lost, so the job it covers can be stopped
+
+    Returns:
+        stop (threading.Event): Set this to stop the heartbeat thread
+    """
+    stop = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop.wait(interval):
+            with lock:
+                leases = list(held_leases.items())
+            for lease_filepath, owner in leases:
+                if not renew_lease(lease_filepath, owner):
+                    # the job's new holder will run it, so we'll stop renewing the lease and let the job's worker know to stop
+                    with lock:
+                        held_leases.pop(lease_filepath, None)
+                    if on_lost is not None:
+                        on_lost(lease_filepath)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    return stop
+
+
+def create_job_claims(lease_ttl:Optional[float]) -> Optional[Dict]:
+    """
+    This function will create the record of the jobs this process has claimed through leases, shared by all of its workers.
+
+    Args:
+        lease_ttl (float): The number of seconds without a heartbeat after which a lease has expired, or None if jobs aren't claimed through leases
+
+    Returns:
+        claims (Dict): A dictionary with the owner, the ttl, the held leases (the lease filepath as the key and the owner as the value), the filepaths of the leases lost while held, the ids of the jobs found claimed by another process and a lock guarding them, or None if leases aren't used
+    """
+    if lease_ttl is None:
+        return None
+    return {'owner': create_lease_owner(), 'ttl': lease_ttl, 'held': {}, 'lost': set(), 'elsewhere': set(), 'lock': threading.Lock()}
+
+
+def claim_job_lease(claims:Optional[Dict], lease_filepath:str, job_id:str) -> bool:
+    """
+    This function will claim a job through its lease, noting the job if another process holds it.
+
+    Args:
+        claims (Dict): The claims returned by create_job_claims, if None every job is claimed
+        lease_filepath (str): The path of the job's lease file
+        job_id (str): The id of the job
+
+    Returns:
+        claimed (bool): True if this process now holds the job's lease
+    """
+    if claims is None:
+        return True
+    if not acquire_lease(lease_filepath, claims['owner'], claims['ttl']):
+        note_claimed_elsewhere(claims, job_id)
+        return False
+    with claims['lock']:
+        claims['held'][lease_filepath] = claims['owner']
+        claims['lost'].discard(lease_filepath)
+    return True
+
+
+def holds_job_lease(claims:Optional[Dict], lease_filepath:str) -> bool:
+    """
+    This function will check that this process still holds a job's lease, reading the lease file rather than trusting the heartbeat, e.g. before the job's outputs are recorded as done.
+
+    Args:
+        claims (Dict): The claims returned by create_job_claims, if None every job is held
+        lease_filepath (str): The path of the job's lease file
+
+    Returns:
+        held (bool): False if the lease has been lost, e.g. it expired and another process took it over
+    """
+    if claims is None:
+        return True
+    if is_lease_lost(claims, lease_filepath):
+        return False
+    lease = read_lease(lease_filepath)
+    return bool(lease) and lease.get('owner') == claims['owner']
+
+
+def mark_lease_lost(claims:Dict, lease_filepath:str) -> None:
+    with claims['lock']:
+        claims['lost'].add(lease_filepath)
+
+
+def is_lease_lost(claims:Optional[Dict], lease_filepath:str) -> bool:
+    if claims is None:
+        return False
+    with claims['lock']:
+        return lease_filepath in claims['lost']
+
+
+def note_claimed_elsewhere(claims:Optional[Dict], job_id:str) -> None:
+    if claims is None:
+        return
+    with claims['lock']:
+        claims['elsewhere'].add(job_id)
+
+
+def release_job_lease(claims:Optional[Dict], lease_filepath:str) -> None:
+    if claims is None:
+        return
+    with claims['lock']:
+        claims['held'].pop(lease_filepath, None)
+    release_lease(lease_filepath, claims['owner'])
+
+
+def is_claimed_elsewhere(claims:Optional[Dict], job_id:str) -> bool:
+    if claims is None:
+        return False
+    with claims['lock']:
+        return job_id in claims['elsewhere']
+
+
+def take_claimed_elsewhere(claims:Optional[Dict]) -> Set[str]:
+    # the jobs are handed over once, so a job found claimed again while it's checked is noted afresh
+    if claims is None:
+        return set()
+    with claims['lock']:
+        claimed_elsewhere = set(claims['elsewhere'])
+        claims['elsewhere'].clear()
+    return claimed_elsewhere
+
+
+def start_claims_heartbeat(claims:Optional[Dict]) -> Optional[threading.Event]:
+    # a quarter of the ttl leaves room for a few missed heartbeats before another node takes a lease over
+    if claims is None:
+        return None
+    return start_lease_heartbeat(claims['held'], claims['lock'], claims['ttl'] / 4, on_lost=lambda lease_filepath: mark_lease_lost(claims, lease_filepath))
+
+
+def parse_shard(shard:str) -> Tuple[int, int]:
+    """
+    This function will parse the --shard CLI option.
+
+    Args:
+        shard (str): The shard of this node and the number of shards, e.g. 2/4 for the second of four nodes
+
+    Returns:
+        shard_index (int): The shard of this node, counting from 1
+        shard_count (int): The number of shards
+    """
+    try:
+        shard_index, shard_count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise ValueError(f"The shard should look like i/N e.g. 2/4, not {shard}")
+    if shard_count < 1 or not 1 <= shard_index <= shard_count:
+        raise ValueError(f"The shard index should be between 1 and {shard_count}, not {shard_index}")
+    return shard_index, shard_count
+
+
+def in_shard(job_id:str, shard_index:int, shard_count:int) -> bool:
+    # crc32 is the same on every node and every run, unlike Python's hash of a string
+    return zlib.crc32(job_id.encode()) % shard_count == shard_index - 1
@@ -0,0 +1,240 @@
+from typing import Dict, Optional
+
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+from prediction_archive import is_archived, load_result_json
+
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def file_checksum(filepath:str) -> str:
+    """
+    This function will calculate the sha256 checksum of a file.
+
+    Args:
+        filepath (str): The path to the file
+
+    Returns:
+        checksum (str): The hex digest of the file contents
+    """
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def write_completion_manifest(folder:str, jobname:str) -> Dict:
+    """
+    This function will write the completion manifest for a finished prediction folder, listing every file with its size and checksum.
+
+    The manifest is written via a temporary file and a rename, so a folder only ever has a complete manifest or none at all.
+
+    Args:
+        folder (str): The prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+
+    Returns:
+        manifest (Dict): The manifest that was written
+
+    Raises:
+        FileNotFoundError: If colabfold didn't write its '<jobname>.done.txt' file, i.e. the prediction didn't finish
+    """
+    if not os.path.exists(f"{folder}/{jobname}.done.txt"):
+        raise FileNotFoundError(f"{folder}/{jobname}.done.txt does not exist, the prediction has not finished")
+    files = []
+    for filename in sorted(os.listdir(folder)):
+        filepath = f"{folder}/{filename}"
+        if filename == MANIFEST_FILENAME or filename.endswith('.tmp') or not os.path.isfile(filepath):
+            continue
+        files.append({'name': filename, 'size': os.path.getsize(filepath), 'sha256': file_checksum(filepath)})
+    manifest = {
+        'jobname': jobname,
+        'completed': datetime.datetime.now().isoformat(),
+        'files': files
+    }
+    tmp_filepath = f"{folder}/{MANIFEST_FILENAME}.{os.getpid()}_{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_filepath, f"{folder}/{MANIFEST_FILENAME}")
+    return manifest
+
+
+def manifest_digest(manifest:Dict) -> str:
+    # a prediction which is run again gets a new manifest, and so a new digest, which is how the results database knows to read it again
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def load_completion_manifest(folder:str) -> Optional[Dict]:
+    manifest_filepath = f"{folder}/{MANIFEST_FILENAME}"
+    if not os.path.exists(manifest_filepath):
+        return None
+    with open(manifest_filepath, 'r') as f:
+        return json.load(f)
+
+
+def verify_completion_manifest(folder:str, check_checksums:bool=False) -> bool:
+    """
+    This function will check that every file listed in a folder's completion manifest is present with the right size (and optionally checksum).
+
+    Args:
+        folder (str): The prediction output folder
+        check_checksums (bool): Whether to recalculate the checksum of each file as well, which reads every file
+
+    Returns:
+        verified (bool): True if the manifest exists and matches the files in the folder
+    """
+    manifest = load_completion_manifest(folder)
+    if manifest is None:
+        return False
+    for manifest_file in manifest['files']:
+        filepath = f"{folder}/{manifest_file['name']}"
+        if not os.path.exists(filepath) or os.path.getsize(filepath) != manifest_file['size']:
+            return False
+        if check_checksums and file_checksum(filepath) != manifest_file['sha256']:
+            return False
+    return True
+
+
+def load_completion_index(index_filepath:str) -> Dict[str, Dict]:
+    """
+    This function will load the completion index, a single file listing every finished prediction folder, so a resume needs one read rather than a directory scan per structure.
+
+    A folder's latest line wins, so a folder dropped by drop_from_completion_index is left out until it's added again.
+
+    Args:
+        index_filepath (str): The path to the completion index
+
+    Returns:
+        completed (Dict[str, Dict]): A dictionary with the prediction folder as the key and its index entry as the value
+    """
+    completed = {}
+    if not os.path.exists(index_filepath):
+        return completed
+    with open(index_filepath, 'r') as f:
+        for line in f:
+            # a line being written when a process died will be incomplete, so we'll skip anything that isn't valid JSON
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get('dropped'):
+                completed.pop(entry['folder'], None)
+                continue
+            completed[entry['folder']] = entry
+    return completed
+
+
+def append_index_line(index_filepath:str, entry:Dict) -> None:
+    # each entry is a single line appended with one write, so several workers and processes can add to the index at once
+    index_folder = os.path.dirname(index_filepath)
+    if index_folder and not os.path.exists(index_folder):
+        os.makedirs(index_folder, exist_ok=True)
+    line = (json.dumps(entry) + '\n').encode()
+    index_file = os.open(index_filepath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(index_file, line)
+    finally:
+        os.close(index_file)
+
+
+def append_to_completion_index(index_filepath:str, folder:str, manifest:Dict) -> Dict:
+    """
+    This function will add a finished prediction folder to the completion index.
+
+    Args:
+        index_filepath (str): The path to the completion index
+        folder (str): The prediction output folder, as used as the key when the index is loaded
+        manifest (Dict): The completion manifest of the folder
+
+    Returns:
+        entry (Dict): The index entry that was added
+    """
+    entry = {
+        'folder': folder,
+        'jobname': manifest['jobname'],
+        'completed': manifest['completed'],
+        'files': len(manifest['files']),
+        'size': sum(manifest_file['size'] for manifest_file in manifest['files']),
+        'manifest_sha256': manifest_digest(manifest)
+    }
+    append_index_line(index_filepath, entry)
+    return entry
+
+
+def drop_from_completion_index(index_filepath:str, folder:str, reason:str) -> None:
+    """
+    This function will drop a prediction folder from the completion index, so the prediction is run again, e.g. when its folder has gone or no longer matches its manifest.
+
+    The index is only ever appended to, so the folder is dropped by a line of its own which load_completion_index applies over the folder's earlier entries.
+
+    Args:
+        index_filepath (str): The path to the completion index
+        folder (str): The prediction output folder, as used as the key when the index is loaded
+        reason (str): Why the folder was dropped, kept in the index for reference
+    """
+    append_index_line(index_filepath, {'folder': folder, 'dropped': datetime.datetime.now().isoformat(), 'reason': reason})
+
+
+def record_completed_prediction(index_filepath:str, folder:str, index_key:str, jobname:str) -> Dict:
+    """
+    This function will write the completion manifest for a finished prediction and add it to the completion index.
+
+    Args:
+        index_filepath (str): The path to the completion index
+        folder (str): The local prediction output folder
+        index_key (str): The key for the folder in the completion index, e.g. outputs/experiments/31/1k5n
+        jobname (str): The jobname colabfold used to prefix the outputs
+
+    Returns:
+        manifest (Dict): The manifest that was written
+    """
+    manifest = write_completion_manifest(folder, jobname)
+    append_to_completion_index(index_filepath, index_key, manifest)
+    return manifest
+
+
+def is_prediction_complete(folder:str, index_key:str, jobname:str, completed:Dict[str, Dict], index_filepath:Optional[str]=None) -> bool:
+    """
+    This function will decide whether a prediction has finished, from the completion index first, then the folder's manifest.
+
+    Folders from before manifests were written are accepted if colabfold's '<jobname>.done.txt' is there, and are given a manifest (and index entry) so the next check is quick. Archived folders are complete, as only finished folders are archived. An index entry whose folder and archive have both gone, e.g. a prediction deleted to be run again, is dropped from the index.
+
+    Args:
+        folder (str): The local prediction output folder
+        index_key (str): The key for the folder in the completion index, e.g. outputs/experiments/31/1k5n
+        jobname (str): The jobname colabfold used to prefix the outputs
+        completed (Dict[str, Dict]): The completion index returned by load_completion_index
+        index_filepath (str): The path to the completion index, if given folders found complete are added to it (and given a manifest if they don't have one) and missing folders are dropped from it
+
+    Returns:
+        complete (bool): True if the prediction has finished
+    """
+    if index_key in completed:
+        # the index is only one read, so this is the one check of the folder itself on a resume
+        if os.path.exists(folder) or is_archived(folder):
+            return True
+        del completed[index_key]
+        if index_filepath is not None:
+            drop_from_completion_index(index_filepath, index_key, 'the folder and its archive are missing')
+        return False
+    if is_archived(folder):
+        manifest = load_result_json(f"{folder}/{MANIFEST_FILENAME}")
+    elif not os.path.exists(folder):
+        return False
+    elif verify_completion_manifest(folder):
+        manifest = load_completion_manifest(folder)
+    elif os.path.exists(f"{folder}/{jobname}.done.txt"):
+        if index_filepath is None:
+            return True
+        manifest = write_completion_manifest(folder, jobname)
+    else:
+        return False
+    if index_filepath is not None:
+        completed[index_key] = append_to_completion_index(index_filepath, index_key, manifest)
+    return True
@@ -0,0 +1,255 @@
+from typing import Dict, List, Optional, Tuple
+
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+import zipfile
+import numpy as np
+
+
+# an archived prediction folder '<folder>' is the single file '<folder>.zip', with an index of its members in ARCHIVE_INDEX_FILENAME
+ARCHIVE_SUFFIX = '.zip'
+ARCHIVE_INDEX_FILENAME = 'archive.json'
+ARCHIVE_VERSION = 1
+
+PAE_FILENAME_PATTERN = re.compile(r"_predicted_aligned_error_v1\.json$")
+SCORES_FILENAME_PATTERN = re.compile(r"_scores_rank_(\d+)_.+\.json$")
+RANKED_FILENAME_PATTERN = re.compile(r"_rank_(\d+)_.+\.pdb$")
+
+# these are compressed already, so deflating them again would only cost time
+STORED_EXTENSIONS = ['.png']
+
+
+def archive_filepath(folder:str) -> str:
+    return f"{folder.rstrip('/')}{ARCHIVE_SUFFIX}"
+
+
+def is_archived(folder:str) -> bool:
+    # if a prediction is run again after it was archived, the new folder is what we'll read
+    return not os.path.exists(folder) and os.path.exists(archive_filepath(folder))
+
+
+def array_to_npy(array:np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def npy_to_array(data:bytes) -> np.ndarray:
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def retained(filename:str, drop_pngs:bool, keep_ranks:Optional[int]) -> bool:
+    if drop_pngs and filename.endswith('.png'):
+        return False
+    rank_match = RANKED_FILENAME_PATTERN.search(filename)
+    if keep_ranks is not None and rank_match and int(rank_match.group(1)) > keep_ranks:
+        return False
+    return True
+
+
+def write_prediction_archive(folder:str, manifest:Dict, drop_pngs:bool=False, keep_ranks:Optional[int]=None) -> Dict:
+    """
+    This function will pack a finished prediction folder into a single compressed archive next to it, '<folder>.zip'.
+
+    The PAE matrices, in the PAE JSON file and in each scores file, are stored as float16 arrays rather than JSON text, which is most of the size of a folder. The archive is written to a temporary file and renamed into place, and the folder itself is left alone.
+
+    Args:
+        folder (str): The prediction output folder, which should have a verified completion manifest
+        manifest (Dict): The completion manifest of the folder, the files it lists are the ones archived
+        drop_pngs (bool): Whether to leave the plots out of the archive
+        keep_ranks (int): Only archive the PDB files of the top ranked models, or None to keep all of them
+
+    Returns:
+        index (Dict): The archive index, with the stored member(s) of each file and the files which were dropped
+    """
+    tmp_filepath = f"{archive_filepath(folder)}.{os.getpid()}_{threading.get_ident()}.tmp"
+    members = {}
+    dropped = []
+    with zipfile.ZipFile(tmp_filepath, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+
+        def write_member(name:str, data:bytes) -> None:
+            compression = zipfile.ZIP_STORED if os.path.splitext(name)[1] in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            archive.writestr(name, data, compress_type=compression)
+
+        for manifest_file in manifest['files']:
+            filename = manifest_file['name']
+            if not retained(filename, drop_pngs, keep_ranks):
+                dropped.append(filename)
+                continue
+            with open(f"{folder}/{filename}", 'rb') as f:
+                data = f.read()
+            member = {'size': manifest_file['size'], 'sha256': manifest_file['sha256'], 'stored': filename, 'pae': None}
+            if PAE_FILENAME_PATTERN.search(filename):
+                pae_json = json.loads(data)
+                member['pae'] = f"{filename}.pae.npy"
+                member['stored'] = None
+                member['fields'] = {key: value for key, value in pae_json.items() if key != 'predicted_aligned_error'}
+                write_member(member['pae'], array_to_npy(np.asarray(pae_json['predicted_aligned_error'], dtype=np.float16)))
+            elif SCORES_FILENAME_PATTERN.search(filename):
+                scores = json.loads(data)
+                if 'pae' in scores:
+                    member['pae'] = f"{filename}.pae.npy"
+                    write_member(member['pae'], array_to_npy(np.asarray(scores.pop('pae'), dtype=np.float16)))
+                write_member(filename, json.dumps(scores).encode())
+            else:
+                write_member(filename, data)
+            members[filename] = member
+
+        index = {
+            'version': ARCHIVE_VERSION,
+            'jobname': manifest['jobname'],
+            'completed': manifest['completed'],
+            'archived': datetime.datetime.now().isoformat(),
+            'retention': {'drop_pngs': drop_pngs, 'keep_ranks': keep_ranks},
+            'members': members,
+            'dropped': dropped
+        }
+        # the manifest goes in unchanged, so an archived folder still shows everything the prediction made
+        write_member('manifest.json', json.dumps(manifest, indent=4).encode())
+        members['manifest.json'] = {'size': None, 'sha256': None, 'stored': 'manifest.json', 'pae': None}
+        write_member(ARCHIVE_INDEX_FILENAME, json.dumps(index, indent=4).encode())
+    os.replace(tmp_filepath, archive_filepath(folder))
+    return index
+
+
+def load_archive_index(archive:zipfile.ZipFile) -> Dict:
+    return json.loads(archive.read(ARCHIVE_INDEX_FILENAME))
+
+
+def split_result_filepath(filepath:str) -> Tuple[str, str]:
+    return os.path.dirname(filepath), os.path.basename(filepath)
+
+
+def list_result_files(folder:str) -> List[str]:
+    """
+    This function will list the files of a prediction, whether its folder is archived or not.
+
+    Args:
+        folder (str): The prediction output folder
+
+    Returns:
+        filenames (List[str]): The names of the files, as colabfold wrote them, or an empty list if the prediction doesn't exist
+    """
+    if os.path.isdir(folder):
+        return sorted(filename for filename in os.listdir(folder) if os.path.isfile(f"{folder}/{filename}"))
+    if os.path.exists(archive_filepath(folder)):
+        with zipfile.ZipFile(archive_filepath(folder), 'r') as archive:
+            return sorted(load_archive_index(archive)['members'])
+    return []
+
+
+def result_file_identity(filepath:str) -> Tuple[str, int, int]:
+    """
+    This function will identify the version of a prediction file, for use in cache keys, whether its folder is archived or not.
+
+    Args:
+        filepath (str): The path of the file as if its folder wasn't archived, e.g. outputs/experiments/31/1k5n/1k5n_31_scores_rank_001_alphafold2_multimer_v3_model_1_seed_000.json
+
+    Returns:
+        identity (Tuple[str, int, int]): The absolute path of the file, its size and the modification time (in ns) of the file or of the archive holding it
+    """
+    folder, filename = split_result_filepath(filepath)
+    if is_archived(folder):
+        stat = os.stat(archive_filepath(folder))
+        with zipfile.ZipFile(archive_filepath(folder), 'r') as archive:
+            member = load_archive_index(archive)['members'][filename]
+        return os.path.abspath(filepath), member['size'] or 0, stat.st_mtime_ns
+    stat = os.stat(filepath)
+    return os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns
+
+
+def read_archived_json(archive:zipfile.ZipFile, member:Dict, pae_as_array:bool) -> Dict:
+    data = json.loads(archive.read(member['stored'])) if member['stored'] is not None else dict(member['fields'])
+    if member['pae'] is not None:
+        pae = npy_to_array(archive.read(member['pae']))
+        # colabfold rounds the PAE to two decimal places when it writes it
+        pae = pae if pae_as_array else np.round(pae.astype(np.float64), 2).tolist()
+        data['predicted_aligned_error' if member['stored'] is None else 'pae'] = pae
+    return data
+
+
+def load_result_json(filepath:str, pae_as_array:bool=False) -> Dict:
+    """
+    This function will load a JSON file of a prediction, whether its folder is archived or not.
+
+    Args:
+        filepath (str): The path of the file as if its folder wasn't archived
+        pae_as_array (bool): Whether to return the PAE matrix of a scores or PAE file as a numpy array rather than nested lists, which is much quicker for an archived file
+
+    Returns:
+        data (Dict): The contents of the file
+
+    Raises:
+        FileNotFoundError: If the file doesn't exist, or was dropped from the archive
+    """
+    folder, filename = split_result_filepath(filepath)
+    if not is_archived(folder):
+        with open(filepath, 'r') as f:
+            data = json.load(f)
+        for key in ['pae', 'predicted_aligned_error']:
+            if pae_as_array and key in data:
+                data[key] = np.asarray(data[key], dtype=np.float16)
+        return data
+    with zipfile.ZipFile(archive_filepath(folder), 'r') as archive:
+        members = load_archive_index(archive)['members']
+        if filename not in members:
+            raise FileNotFoundError(f"{filename} is not in {archive_filepath(folder)}")
+        return read_archived_json(archive, members[filename], pae_as_array)
+
+
+def read_result_file(filepath:str) -> bytes:
+    """
+    This function will read a file of a prediction, whether its folder is archived or not.
+
+    A PAE or scores file read from an archive is written out as JSON again from the float16 PAE, so it isn't byte for byte the file colabfold wrote.
+
+    Args:
+        filepath (str): The path of the file as if its folder wasn't archived
+
+    Returns:
+        data (bytes): The contents of the file
+
+    Raises:
+        FileNotFoundError: If the file doesn't exist, or was dropped from the archive
+    """
+    folder, filename = split_result_filepath(filepath)
+    if not is_archived(folder):
+        with open(filepath, 'rb') as f:
+            return f.read()
+    with zipfile.ZipFile(archive_filepath(folder), 'r') as archive:
+        members = load_archive_index(archive)['members']
+        if filename not in members:
+            raise FileNotFoundError(f"{filename} is not in {archive_filepath(folder)}")
+        member = members[filename]
+        if member['pae'] is None:
+            return archive.read(member['stored'])
+        return json.dumps(read_archived_json(archive, member, False)).encode()
+
+
+def verify_prediction_archive(folder:str) -> bool:
+    """
+    This function will check that an archive holds every file it should, reading each member back and comparing the files stored unchanged with their checksums.
+
+    Args:
+        folder (str): The prediction output folder the archive was made from
+
+    Returns:
+        verified (bool): True if every member could be read and matched
+    """
+    try:
+        with zipfile.ZipFile(archive_filepath(folder), 'r') as archive:
+            if archive.testzip() is not None:
+                return False
+            for filename, member in load_archive_index(archive)['members'].items():
+                if member['pae'] is not None:
+                    read_archived_json(archive, member, True)
+                elif member['sha256'] is not None and hashlib.sha256(archive.read(member['stored'])).hexdigest() != member['sha256']:
+                    return False
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return False
+    return True
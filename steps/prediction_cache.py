@@ -0,0 +1,235 @@
+from typing import Dict, List, Optional
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+def compute_prediction_key(sequence:str, msa_digest:str, colabfold_options:str, container_image:str) -> str:
+    """
+    This function will compute the cache key for a prediction from the inputs which determine its outputs.
+
+    Args:
+        sequence (str): The sequence being predicted, including any chain separators or chain lengths
+        msa_digest (str): A digest of the MSA used for the prediction, or the name of the MSA server for server generated MSAs
+        colabfold_options (str): The options string passed to colabfold_batch
+        container_image (str): The colabfold container image
+
+    Returns:
+        key (str): The sha256 digest used as the cache key
+    """
+    key_fields = {
+        'sequence': sequence,
+        'msa_digest': msa_digest,
+        # we'll normalise the whitespace so that a trailing space in the config doesn't change the key
+        'colabfold_options': ' '.join(colabfold_options.split()),
+        'container_image': container_image
+    }
+    return hashlib.sha256(json.dumps(key_fields, sort_keys=True).encode()).hexdigest()
+
+
+def cache_entry_folder(cache_folder:str, key:str) -> str:
+    return f"{cache_folder}/{key[:2]}/{key}"
+
+
+def write_json_atomically(data:Dict, filepath:str) -> None:
+    """
+    This function will write a JSON file via a temporary file and a rename, so readers never see a partly written file.
+
+    Args:
+        data (Dict): The data to write
+        filepath (str): The path to write the JSON file to
+    """
+    tmp_filepath = f"{filepath}.{os.getpid()}_{threading.get_ident()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_filepath, filepath)
+
+
+def link_or_copy(source:str, destination:str) -> None:
+    """
+    This function will hard link a file, falling back to a copy where hard links aren't possible (e.g. across filesystems).
+
+    Args:
+        source (str): The existing file
+        destination (str): The new file
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def rename_for_jobname(filename:str, from_jobname:str, to_jobname:str) -> str:
+    # colabfold prefixes every per query file with the jobname, the run level files (log.txt, config.json, cite.bibtex) keep their names
+    if filename.startswith(f"{from_jobname}_") or filename.startswith(f"{from_jobname}."):
+        return f"{to_jobname}{filename[len(from_jobname):]}"
+    return filename
+
+
+def lookup_cached_prediction(cache_folder:str, key:str, output_folder:str, jobname:str) -> bool:
+    """
+    This function will resolve a prediction from the cache, linking the cached outputs into the output folder under the new jobname.
+
+    Args:
+        cache_folder (str): The folder holding the prediction cache
+        key (str): The cache key returned by compute_prediction_key
+        output_folder (str): The folder the outputs should appear in
+        jobname (str): The jobname the outputs should be named for
+
+    Returns:
+        found (bool): True if the prediction was in the cache and has been linked into the output folder
+    """
+    entry_folder = cache_entry_folder(cache_folder, key)
+    manifest_filepath = f"{entry_folder}/manifest.json"
+    if not os.path.exists(manifest_filepath):
+        return False
+    with open(manifest_filepath, 'r') as f:
+        manifest = json.load(f)
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    for cached_file in manifest['files']:
+        link_or_copy(f"{entry_folder}/{cached_file['name']}", f"{output_folder}/{rename_for_jobname(cached_file['name'], manifest['jobname'], jobname)}")
+
+    # we'll record when the entry was last used, so that the least recently used entries are evicted first
+    manifest['last_used'] = datetime.datetime.now().isoformat()
+    manifest['hits'] = manifest.get('hits', 0) + 1
+    write_json_atomically(manifest, manifest_filepath)
+    return True
+
+
+def store_prediction(cache_folder:str, key:str, output_folder:str, jobname:str, metadata:Optional[Dict]=None) -> bool:
+    """
+    This function will add the outputs of a finished prediction to the cache, hard linking them so they don't take up any more space.
+
+    Args:
+        cache_folder (str): The folder holding the prediction cache
+        key (str): The cache key returned by compute_prediction_key
+        output_folder (str): The folder holding the finished prediction
+        jobname (str): The jobname the outputs are named for
+        metadata (Dict): Any extra details to record in the manifest, e.g. the experiment and pdb_code
+
+    Returns:
+        stored (bool): True if the prediction was added, False if it was already in the cache
+    """
+    entry_folder = cache_entry_folder(cache_folder, key)
+    if os.path.exists(f"{entry_folder}/manifest.json"):
+        return False
+
+    # we'll build the entry in a temporary folder and rename it into place, so a partial entry is never visible
+    tmp_entry_folder = f"{entry_folder}.{os.getpid()}_{threading.get_ident()}.tmp"
+    if os.path.exists(tmp_entry_folder):
+        shutil.rmtree(tmp_entry_folder)
+    os.makedirs(tmp_entry_folder)
+
+    files = []
+    for filename in sorted(os.listdir(output_folder)):
+        filepath = f"{output_folder}/{filename}"
+        # the folder's completion manifest is written for its own jobname, so it is left out of the cache
+        if os.path.isfile(filepath) and filename != 'manifest.json':
+            link_or_copy(filepath, f"{tmp_entry_folder}/{filename}")
+            files.append({'name': filename, 'size': os.path.getsize(filepath)})
+
+    now = datetime.datetime.now().isoformat()
+    manifest = {
+        'key': key,
+        'jobname': jobname,
+        'files': files,
+        'size': sum(cached_file['size'] for cached_file in files),
+        'created': now,
+        'last_used': now,
+        'hits': 0,
+        'metadata': metadata or {}
+    }
+    write_json_atomically(manifest, f"{tmp_entry_folder}/manifest.json")
+    try:
+        os.rename(tmp_entry_folder, entry_folder)
+    except OSError:
+        # another worker stored the same prediction first
+        shutil.rmtree(tmp_entry_folder)
+        return False
+    return True
+
+
+def list_cache_entries(cache_folder:str) -> List[Dict]:
+    """
+    This function will list the manifests of every entry in the cache.
+
+    Args:
+        cache_folder (str): The folder holding the prediction cache
+
+    Returns:
+        manifests (List[Dict]): A list of manifest dictionaries, each with an extra 'folder' key
+    """
+    manifests = []
+    if not os.path.exists(cache_folder):
+        return manifests
+    for prefix in sorted(os.listdir(cache_folder)):
+        prefix_folder = f"{cache_folder}/{prefix}"
+        if not os.path.isdir(prefix_folder):
+            continue
+        for key in sorted(os.listdir(prefix_folder)):
+            manifest_filepath = f"{prefix_folder}/{key}/manifest.json"
+            if os.path.exists(manifest_filepath):
+                with open(manifest_filepath, 'r') as f:
+                    manifest = json.load(f)
+                manifest['folder'] = f"{prefix_folder}/{key}"
+                manifests.append(manifest)
+    return manifests
+
+
+def entry_unshared_bytes(manifest:Dict) -> int:
+    """
+    This function will work out how much space removing a cache entry would free.
+
+    The cached files are hard links to the outputs of the predictions, so a file only takes up space of its own once the output folders linking to it have been removed, which we can tell from its link count.
+
+    Args:
+        manifest (Dict): A manifest returned by list_cache_entries
+
+    Returns:
+        unshared_bytes (int): The size in bytes of the entry's files which have no other hard links
+    """
+    unshared_bytes = 0
+    for cached_file in manifest['files']:
+        try:
+            file_stat = os.stat(f"{manifest['folder']}/{cached_file['name']}")
+        except FileNotFoundError:
+            continue
+        if file_stat.st_nlink == 1:
+            unshared_bytes += file_stat.st_size
+    return unshared_bytes
+
+
+def evict_predictions(cache_folder:str, max_bytes:int) -> List[str]:
+    """
+    This function will remove the least recently used entries from the cache until the space it takes up of its own is no larger than max_bytes.
+
+    Only files which aren't hard linked from an output folder count towards the size, as removing the others frees nothing, so entries whose files are all still linked are kept.
+
+    Args:
+        cache_folder (str): The folder holding the prediction cache
+        max_bytes (int): The maximum size of the cache in bytes, not counting files shared with the output folders
+
+    Returns:
+        evicted (List[str]): The keys of the entries which were removed
+    """
+    manifests = sorted(list_cache_entries(cache_folder), key=lambda manifest: manifest['last_used'])
+    unshared_bytes = {manifest['folder']: entry_unshared_bytes(manifest) for manifest in manifests}
+    total_bytes = sum(unshared_bytes.values())
+    evicted = []
+    for manifest in manifests:
+        if total_bytes <= max_bytes:
+            break
+        if not unshared_bytes[manifest['folder']]:
+            continue
+        shutil.rmtree(manifest['folder'])
+        total_bytes -= unshared_bytes[manifest['folder']]
+        evicted.append(manifest['key'])
+    return evicted
@@ -0,0 +1,158 @@
+from typing import Callable, Dict, List, Optional
+
+import concurrent.futures
+import glob
+import os
+import re
+import subprocess
+import threading
+import time
+
+
+# the colabfold_batch options which make it relax the models itself, the relax stage takes these over
+RELAX_OPTIONS_PATTERN = re.compile(r"\s--(amber|use-gpu-relax)(?=\s|$)|\s--num-relax[ =]\d+")
+
+
+def strip_relax_options(colabfold_options:str) -> str:
+    """
+    This function will remove the relaxation options from the colabfold options, so that the GPU container only runs inference.
+
+    Args:
+        colabfold_options (str): The colabfold_batch options e.g. '--num-recycle 3 --amber --use-gpu-relax'
+
+    Returns:
+        colabfold_options (str): The options without --amber, --use-gpu-relax or --num-relax e.g. '--num-recycle 3'
+    """
+    return RELAX_OPTIONS_PATTERN.sub('', f" {colabfold_options}").strip() + ' '
+
+
+def relaxed_filepath(unrelaxed_filepath:str) -> str:
+    # colabfold names the relaxed model the same as the unrelaxed one, e.g. 1k5n_31_relaxed_rank_001_alphafold2_multimer_v3_model_1_seed_042.pdb
+    folder, filename = os.path.split(unrelaxed_filepath)
+    return f"{folder}/{filename.replace('_unrelaxed_rank_', '_relaxed_rank_', 1)}"
+
+
+def find_models_to_relax(folder:str, jobname:str, top_k:int) -> List[str]:
+    """
+    This function will find the unrelaxed models of the top ranks of a prediction which haven't been relaxed yet.
+
+    Args:
+        folder (str): The prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+        top_k (int): The number of ranks to relax, e.g. 1 for only the top ranked model
+
+    Returns:
+        unrelaxed_filepaths (List[str]): The unrelaxed models to relax, best rank first
+    """
+    unrelaxed_filepaths = sorted(glob.glob(f"{folder}/{glob.escape(jobname)}_unrelaxed_rank_*.pdb"))[:top_k]
+    return [filepath for filepath in unrelaxed_filepaths if not os.path.exists(relaxed_filepath(filepath))]
+
+
+def build_relax_command(config:Dict, unrelaxed_filepath:str, relaxed_filepath:str) -> str:
+    """
+    This function will build the docker command used to relax a single model on the CPU with colabfold's relax_me, for when colabfold isn't installed locally.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        unrelaxed_filepath (str): The in container filepath of the unrelaxed model
+        relaxed_filepath (str): The in container filepath to write the relaxed model to
+
+    Returns:
+        relax_command (str): The docker command to run
+    """
+    relax_script = "import sys; from colabfold.relax import relax_me; open(sys.argv[2], 'w').write(relax_me(pdb_filename=sys.argv[1], use_gpu=False))"
+    return f"docker run --user $(id -u) --rm -v {config['PROJECT_FOLDER']}:/work:rw {config['CONTAINER_IMAGE']} python -c \"{relax_script}\" {unrelaxed_filepath} {relaxed_filepath}"
+
+
+def relax_model(unrelaxed_filepath:str, backend:str, config:Optional[Dict]=None, docker_folder:Optional[str]=None) -> float:
+    """
+    This function will relax a single model with Amber on the CPU, writing it alongside the unrelaxed model in colabfold's relaxed_rank_* layout.
+
+    It runs in a worker process of the relax pool. The relaxed model is written to a temporary file and renamed into place, as find_models_to_relax takes any relaxed model that exists to be finished.
+
+    Args:
+        unrelaxed_filepath (str): The local filepath of the unrelaxed model
+        backend (str): Either 'local' to use colabfold's relax_me (and OpenMM) installed in this environment, or 'container' to run the command built by build_relax_command
+        config (Dict): A dictionary details of input/ouput paths and project location, needed for the container backend
+        docker_folder (str): The in container filepath of the prediction output folder, needed for the container backend
+
+    Returns:
+        seconds (float): The time the relaxation took
+    """
+    start = time.perf_counter()
+    output_filepath = relaxed_filepath(unrelaxed_filepath)
+    tmp_filepath = f"{output_filepath}.{os.getpid()}.tmp"
+    if backend == 'local':
+        from colabfold.relax import relax_me
+        relaxed_pdb = relax_me(pdb_filename=unrelaxed_filepath, use_gpu=False)
+        with open(tmp_filepath, 'w') as f:
+            f.write(relaxed_pdb)
+        os.replace(tmp_filepath, output_filepath)
+    elif backend == 'container':
+        # the container writes to the temporary file too, so a container killed part way through never leaves a partial relaxed model
+        docker_unrelaxed_filepath = f"{docker_folder}/{os.path.basename(unrelaxed_filepath)}"
+        result = subprocess.run(build_relax_command(config, docker_unrelaxed_filepath, f"{docker_folder}/{os.path.basename(tmp_filepath)}"), shell=True)
+        if result.returncode != 0 or not os.path.exists(tmp_filepath):
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise RuntimeError(f"Relaxing {unrelaxed_filepath} failed with exit code {result.returncode}")
+        os.replace(tmp_filepath, output_filepath)
+    else:
+        raise ValueError("backend must be either 'local' or 'container'")
+    return time.perf_counter() - start
+
+
+def detect_relax_backend() -> str:
+    # if colabfold and OpenMM are installed locally we can skip starting a container for each model
+    try:
+        import colabfold.relax
+        return 'local'
+    except ImportError:
+        return 'container'
+
+
+def submit_relaxation(pool:concurrent.futures.Executor, config:Dict, folder:str, docker_folder:str, jobname:str, top_k:int, backend:str, on_complete:Callable[[float, Optional[Exception]], None]) -> int:
+    """
+    This function will submit the top ranked models of a finished inference to the relax pool, and call on_complete once they have all been relaxed.
+
+    Args:
+        pool (concurrent.futures.Executor): The pool of CPU worker processes
+        config (Dict): A dictionary details of input/ouput paths and project location
+        folder (str): The local prediction output folder
+        docker_folder (str): The in container filepath of the prediction output folder
+        jobname (str): The jobname colabfold used to prefix the outputs
+        top_k (int): The number of ranks to relax
+        backend (str): Either 'local' or 'container', see relax_model
+        on_complete (Callable): Called with the total relax seconds and the first error (or None), from a pool thread. The error is a concurrent.futures.CancelledError if the pool was shut down before the models were relaxed
+
+    Returns:
+        submitted (int): The number of models submitted, on_complete is called straight away if there are none
+    """
+    unrelaxed_filepaths = find_models_to_relax(folder, jobname, top_k)
+    if len(unrelaxed_filepaths) == 0:
+        on_complete(0.0, None)
+        return 0
+
+    lock = threading.Lock()
+    outcome = {'remaining': len(unrelaxed_filepaths), 'seconds': 0.0, 'error': None}
+
+    def model_relaxed(future:concurrent.futures.Future) -> None:
+        with lock:
+            # a future cancelled by the pool shutting down has no exception to ask for, future.exception() would raise
+            if future.cancelled():
+                outcome['error'] = outcome['error'] or concurrent.futures.CancelledError(f"{future_filepaths[future]} was not relaxed before the relax pool was shut down")
+            elif future.exception() is not None:
+                outcome['error'] = outcome['error'] or future.exception()
+            else:
+                outcome['seconds'] += future.result()
+            outcome['remaining'] -= 1
+            finished = outcome['remaining'] == 0
+        if finished:
+            on_complete(outcome['seconds'], outcome['error'])
+
+    future_filepaths = {}
+    for unrelaxed_filepath in unrelaxed_filepaths:
+        future = pool.submit(relax_model, unrelaxed_filepath, backend, config, docker_folder)
+        future_filepaths[future] = unrelaxed_filepath
+        future.add_done_callback(model_relaxed)
+    return len(unrelaxed_filepaths)
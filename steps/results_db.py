@@ -0,0 +1,599 @@
+from typing import Dict, List, Optional, Tuple
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import sqlite3
+import time
+import click
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from functions import load_config, load_prediction_list, load_b2m_sequence, make_filepath, journal_filepaths, completion_index_filepath, deslugify_allele_slug
+from ingest_results import load_prediction_scores, compute_segment_metrics
+from journal import LOCAL_JOURNAL_MODE, open_journal
+from manifest import load_completion_index
+from prediction_archive import is_archived
+
+EXPERIMENT_LOG_FILENAME = 'netmhcba_experiment_log.json'
+
+# the columns of the results table copied from the structures, experiments and predictions tables, so every query reads a single table
+STRUCTURE_COLUMNS = ['allele_slug', 'allele', 'locus', 'peptide_length', 'resolution']
+EXPERIMENT_COLUMNS = ['binding_cutoff', 'hamming_cutoff', 'allele_cutoff']
+TIMING_COLUMNS = ['elapsed_time', 'gpu', 'cached', 'container_seconds', 'inference_seconds', 'relax_seconds']
+SCORE_COLUMNS = ['experiment_number', 'pdb_code', 'rank', 'model', 'sequence_length', 'ptm', 'iptm', 'max_pae', 'mean_plddt', 'heavy_chain_plddt', 'peptide_plddt', 'peptide_groove_pae']
+
+# the columns of the results table which queries can be grouped by, and the ones which can be averaged
+GROUP_COLUMNS = ['experiment_number', 'pdb_code', 'allele', 'allele_slug', 'locus', 'peptide_length', 'model', 'binding_cutoff', 'hamming_cutoff', 'allele_cutoff', 'gpu']
+METRIC_COLUMNS = ['peptide_plddt', 'mean_plddt', 'heavy_chain_plddt', 'peptide_groove_pae', 'ptm', 'iptm', 'max_pae', 'elapsed_time', 'container_seconds', 'inference_seconds', 'relax_seconds']
+# the leaderboards put the lowest of these first, and the highest of everything else
+LOWER_IS_BETTER = ['peptide_groove_pae', 'max_pae', 'elapsed_time', 'container_seconds', 'inference_seconds', 'relax_seconds']
+
+# the number of predictions written to the database in each transaction when indexing
+INDEX_BATCH_SIZE = 200
+
+
+def results_db_filepath(config:Dict) -> str:
+    # the results database sits alongside the journal and completion index it is built from
+    return make_filepath(config, 'output', 'results', 'results.sqlite')
+
+
+@contextlib.contextmanager
+def open_results_db(filepath:str, journal_mode:Optional[str]=LOCAL_JOURNAL_MODE):
+    """
+    This function will open the results database, creating its tables and indexes if they don't exist yet.
+
+    The results table has one row per ranked model, with the structure, experiment and timing columns copied in from their own tables, which are the ones updated.
+
+    Args:
+        filepath (str): The path to the results database
+        journal_mode (str): The SQLite journal mode, see journal.open_journal, or None to leave the database in the mode it's in e.g. for queries
+
+    Yields:
+        connection (sqlite3.Connection): A connection to the results database, which is closed afterwards
+    """
+    folder = os.path.dirname(filepath)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    connection = sqlite3.connect(filepath, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    try:
+        # the same journal mode as the journal, so runs across several nodes can index their jobs as they finish
+        if journal_mode is not None:
+            connection.execute(f"PRAGMA journal_mode={journal_mode}")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS experiments (
+                experiment_number TEXT PRIMARY KEY,
+                binding_cutoff NUMERIC,
+                hamming_cutoff NUMERIC,
+                allele_cutoff NUMERIC,
+                a3m_filename TEXT,
+                parameters TEXT NOT NULL DEFAULT '{}'
+            );
+            CREATE TABLE IF NOT EXISTS structures (
+                pdb_code TEXT PRIMARY KEY,
+                allele_slug TEXT NOT NULL,
+                allele TEXT NOT NULL,
+                locus TEXT NOT NULL,
+                peptide_sequence TEXT NOT NULL,
+                peptide_length INTEGER NOT NULL,
+                resolution REAL
+            );
+            CREATE TABLE IF NOT EXISTS predictions (
+                experiment_number TEXT NOT NULL,
+                pdb_code TEXT NOT NULL,
+                folder TEXT NOT NULL,
+                jobname TEXT NOT NULL,
+                completed TEXT,
+                manifest_sha256 TEXT,
+                archived INTEGER NOT NULL DEFAULT 0,
+                timings_version TEXT,
+                indexed_at TEXT NOT NULL,
+                PRIMARY KEY (experiment_number, pdb_code)
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                experiment_number TEXT NOT NULL,
+                pdb_code TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                sequence_length INTEGER,
+                ptm REAL,
+                iptm REAL,
+                max_pae REAL,
+                mean_plddt REAL,
+                heavy_chain_plddt REAL,
+                peptide_plddt REAL,
+                peptide_groove_pae REAL,
+                allele_slug TEXT,
+                allele TEXT,
+                locus TEXT,
+                peptide_length INTEGER,
+                resolution REAL,
+                binding_cutoff NUMERIC,
+                hamming_cutoff NUMERIC,
+                allele_cutoff NUMERIC,
+                elapsed_time REAL,
+                gpu TEXT,
+                cached INTEGER,
+                container_seconds REAL,
+                inference_seconds REAL,
+                relax_seconds REAL,
+                PRIMARY KEY (experiment_number, pdb_code, rank)
+            );
+            CREATE INDEX IF NOT EXISTS results_allele ON results (rank, allele, peptide_length);
+            CREATE INDEX IF NOT EXISTS results_locus ON results (rank, locus, peptide_length);
+            CREATE INDEX IF NOT EXISTS results_pdb_code ON results (pdb_code);
+        """)
+        yield connection
+    finally:
+        connection.close()
+
+
+def load_experiment_parameters(config:Dict) -> Dict[str, Dict]:
+    experiment_log_filepath = make_filepath(config, 'input', 'experiments', EXPERIMENT_LOG_FILENAME)
+    if not os.path.exists(experiment_log_filepath):
+        return {}
+    with open(experiment_log_filepath, 'r') as f:
+        return json.load(f)
+
+
+def copy_columns(connection:sqlite3.Connection, table:str, columns:List[str], key:str, keys:List[str]) -> None:
+    # we'll copy the columns into the results rows of the changed structures or experiments, in one pass over the table
+    for start in range(0, len(keys), 500):
+        chunk = keys[start:start + 500]
+        connection.execute(f"UPDATE results SET ({', '.join(columns)}) = (SELECT {', '.join(columns)} FROM {table} WHERE {table}.{key} = results.{key}) WHERE {key} IN ({', '.join('?' for chunk_key in chunk)})", chunk)
+
+
+def index_experiments(connection:sqlite3.Connection, experiment_parameters:Dict[str, Dict]) -> List[str]:
+    """
+    This function will add the experiment parameters to the results database, updating the results of any experiment whose parameters have changed.
+
+    Args:
+        connection (sqlite3.Connection): A connection from open_results_db, in a transaction
+        experiment_parameters (Dict[str, Dict]): The experiment log, with the experiment number as the key and its parameters as the value
+
+    Returns:
+        changed (List[str]): The experiment numbers which were added or changed
+    """
+    existing = {row['experiment_number']: row['parameters'] for row in connection.execute("SELECT experiment_number, parameters FROM experiments")}
+    rows = []
+    for experiment_number, parameters in experiment_parameters.items():
+        if existing.get(experiment_number) != json.dumps(parameters, sort_keys=True):
+            rows.append((experiment_number, parameters.get('binding_cutoff'), parameters.get('hamming_cutoff'), parameters.get('allele_cutoff'), parameters.get('filename'), json.dumps(parameters, sort_keys=True)))
+    connection.executemany("INSERT OR REPLACE INTO experiments (experiment_number, binding_cutoff, hamming_cutoff, allele_cutoff, a3m_filename, parameters) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    changed = [row[0] for row in rows]
+    copy_columns(connection, 'experiments', EXPERIMENT_COLUMNS, 'experiment_number', changed)
+    return changed
+
+
+def index_structures(connection:sqlite3.Connection, structures:List[Dict]) -> List[str]:
+    """
+    This function will add the structures from the prediction list to the results database, updating the results of any structure whose details have changed.
+
+    Args:
+        connection (sqlite3.Connection): A connection from open_results_db, in a transaction
+        structures (List[Dict]): The structures returned by load_prediction_list
+
+    Returns:
+        changed (List[str]): The pdb_codes which were added or changed
+    """
+    existing = {row['pdb_code']: tuple(row) for row in connection.execute("SELECT pdb_code, allele_slug, allele, locus, peptide_sequence, peptide_length, resolution FROM structures")}
+    rows = []
+    for structure in structures:
+        resolution = float(structure['resolution']) if structure.get('resolution') not in [None, ''] else None
+        row = (structure['pdb_code'], structure['allele_slug'], deslugify_allele_slug(structure['allele_slug']), structure['locus'].lower(), structure['peptide_sequence'], len(structure['peptide_sequence']), resolution)
+        if existing.get(structure['pdb_code']) != row:
+            rows.append(row)
+    connection.executemany("INSERT OR REPLACE INTO structures (pdb_code, allele_slug, allele, locus, peptide_sequence, peptide_length, resolution) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    changed = [row[0] for row in rows]
+    copy_columns(connection, 'structures', STRUCTURE_COLUMNS, 'pdb_code', changed)
+    return changed
+
+
+def load_job_timings(journal_filepath:str, job_key:Optional[Tuple[str, str]]=None, journal_mode:Optional[str]=LOCAL_JOURNAL_MODE) -> Dict[Tuple[str, str], Dict]:
+    """
+    This function will load the timings of every finished job in the journal, its elapsed time and GPU and the total time in the container, inference and relax stages.
+
+    Args:
+        journal_filepath (str): The path to the journal database
+        job_key (Tuple[str, str]): Only load the timings of this (experiment_number, pdb_code), or None for every job
+        journal_mode (str): The SQLite journal mode, see journal.open_journal, or None to read the journal as it is e.g. another node's
+
+    Returns:
+        timings (Dict[Tuple[str, str], Dict]): A dictionary keyed by (experiment_number, pdb_code) with the TIMING_COLUMNS and a timings_version which changes whenever the job or its spans do
+    """
+    timings = {}
+    if not os.path.exists(journal_filepath):
+        return timings
+    # as a job finishes only its own timings are needed, so the spans of the rest of the journal aren't summed
+    span_filter = "WHERE experiment_number = ? AND pdb_code = ?" if job_key is not None else ''
+    job_filter = "AND jobs.experiment_number = ? AND jobs.pdb_code = ?" if job_key is not None else ''
+    with open_journal(journal_filepath, journal_mode) as connection:
+        rows = connection.execute(f"""
+            SELECT jobs.experiment_number, jobs.pdb_code, jobs.elapsed_time, jobs.gpu, jobs.details, jobs.updated_at, spans.last_span,
+                spans.container_seconds, spans.inference_seconds, spans.relax_seconds
+            FROM jobs
+            LEFT JOIN (
+                SELECT experiment_number, pdb_code, MAX(id) AS last_span,
+                    SUM(CASE WHEN source = 'orchestrator' AND stage = 'container' THEN duration END) AS container_seconds,
+                    SUM(CASE WHEN source = 'colabfold' AND stage = 'inference' THEN duration END) AS inference_seconds,
+                    SUM(CASE WHEN (source = 'colabfold' AND stage = 'relax') OR (source = 'orchestrator' AND stage = 'cpu_relax') THEN duration END) AS relax_seconds
+                FROM spans {span_filter} GROUP BY experiment_number, pdb_code
+            ) AS spans USING (experiment_number, pdb_code)
+            WHERE jobs.status = 'done' {job_filter}
+        """, [*job_key, *job_key] if job_key is not None else []).fetchall()
+    for row in rows:
+        timings[(row['experiment_number'], row['pdb_code'])] = {
+            'elapsed_time': row['elapsed_time'],
+            'gpu': row['gpu'],
+            'cached': int(bool(json.loads(row['details']).get('cached', False))),
+            'container_seconds': row['container_seconds'],
+            'inference_seconds': row['inference_seconds'],
+            'relax_seconds': row['relax_seconds'],
+            'timings_version': f"{row['updated_at']}:{row['last_span']}"
+        }
+    return timings
+
+
+def score_prediction(prediction:Dict, b2m_length:int) -> List[Tuple]:
+    """
+    This function will load the scores of every ranked model of one finished prediction, which may be archived.
+
+    Args:
+        prediction (Dict): A dictionary with the experiment_number, pdb_code, folder and jobname of the prediction
+        b2m_length (int): The length of the B2M sequence
+
+    Returns:
+        rows (List[Tuple]): One row per ranked model, with the SCORE_COLUMNS
+    """
+    rows = []
+    for record in load_prediction_scores(prediction['folder'], prediction['jobname']):
+        # the stub backend's minimal outputs have an empty PAE, which leaves the PAE metrics empty
+        pae = record['pae'] if record['pae'].ndim == 2 else np.full((len(record['plddt']), len(record['plddt'])), np.nan, dtype=np.float16)
+        metrics = compute_segment_metrics(record['plddt'][np.newaxis], pae[np.newaxis], b2m_length)
+        rows.append((prediction['experiment_number'], prediction['pdb_code'], record['rank'], record['model'], len(record['plddt']), record['ptm'], record['iptm'], record['max_pae'], *[float(metrics[metric][0]) for metric in ['mean_plddt', 'heavy_chain_plddt', 'peptide_plddt', 'peptide_groove_pae']]))
+    return rows
+
+
+def score_prediction_task(task:Tuple[Dict, int]) -> Optional[List[Tuple]]:
+    # run in a worker process, a folder removed (or half written) since it was found is skipped and tried again next time
+    try:
+        return score_prediction(*task)
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_prediction(connection:sqlite3.Connection, prediction:Dict, rows:List[Tuple], timings:Optional[Dict]=None) -> None:
+    # this is left to the caller to wrap in a transaction, so that several predictions can be written in one
+    timings = timings or {}
+    key = (prediction['experiment_number'], prediction['pdb_code'])
+    connection.execute("DELETE FROM results WHERE experiment_number = ? AND pdb_code = ?", key)
+    connection.executemany(f"INSERT INTO results ({', '.join(SCORE_COLUMNS + TIMING_COLUMNS)}) VALUES ({', '.join('?' for column in SCORE_COLUMNS + TIMING_COLUMNS)})", [(*row, *[timings.get(column) for column in TIMING_COLUMNS]) for row in rows])
+    # the structure and experiment columns come from their tables, which are indexed first
+    connection.execute(f"""
+        UPDATE results SET
+            ({', '.join(STRUCTURE_COLUMNS)}) = (SELECT {', '.join(STRUCTURE_COLUMNS)} FROM structures WHERE structures.pdb_code = results.pdb_code),
+            ({', '.join(EXPERIMENT_COLUMNS)}) = (SELECT {', '.join(EXPERIMENT_COLUMNS)} FROM experiments WHERE experiments.experiment_number = results.experiment_number)
+        WHERE experiment_number = ? AND pdb_code = ?
+    """, key)
+    connection.execute(
+        "INSERT OR REPLACE INTO predictions (experiment_number, pdb_code, folder, jobname, completed, manifest_sha256, archived, timings_version, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (*key, prediction['folder'], prediction['jobname'], prediction.get('completed'), prediction.get('manifest_sha256'), int(is_archived(prediction['folder'])), timings.get('timings_version'), datetime.datetime.now().isoformat())
+    )
+
+
+def index_prediction(db_filepath:str, prediction:Dict, b2m_length:int, structure:Dict, experiment_parameters:Optional[Dict]=None, timings:Optional[Dict]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> int:
+    """
+    This function will add (or replace) the scores of every ranked model of one finished prediction in the results database, as its job finishes.
+
+    Args:
+        db_filepath (str): The path to the results database
+        prediction (Dict): A dictionary with the experiment_number, pdb_code, folder, jobname and the completion index entry ('completed' and 'manifest_sha256')
+        b2m_length (int): The length of the B2M sequence
+        structure (Dict): The structure from the prediction list
+        experiment_parameters (Dict): The experiment's parameters from the experiment log, if it is in there
+        timings (Dict): The job timings, in the form returned by load_job_timings, if there are any
+        journal_mode (str): The SQLite journal mode, see journal.open_journal
+
+    Returns:
+        rows (int): The number of ranked models indexed
+    """
+    # the scores are read before the transaction starts, so the database is only locked for the writes
+    rows = score_prediction(prediction, b2m_length)
+    with open_results_db(db_filepath, journal_mode) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            index_structures(connection, [structure])
+            if experiment_parameters is not None:
+                index_experiments(connection, {prediction['experiment_number']: experiment_parameters})
+            write_prediction(connection, prediction, rows, timings)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+    return len(rows)
+
+
+def update_results_db(config:Dict, db_filepath:str, experiment_numbers:Optional[List[str]]=None, workers:Optional[int]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> Dict[str, int]:
+    """
+    This function will bring the results database up to date with the completion index, the journals, the prediction list and the experiment log.
+
+    Only predictions which are new, or whose completion manifest has changed since they were indexed (i.e. they were run again), have their scores read, by a pool of worker processes. The timings of the others are updated if their journal entry or spans have changed.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        db_filepath (str): The path to the results database
+        experiment_numbers (List[str]): Only index these experiments, or None for every experiment
+        workers (int): The number of worker processes reading scores, defaults to the number of CPUs
+        journal_mode (str): The SQLite journal mode of the results database, see journal.open_journal, the journals are read in the mode they're in
+
+    Returns:
+        counts (Dict[str, int]): The number of 'predictions' and 'models' indexed, 'timings' updated and predictions 'failed' to index
+    """
+    completed = load_completion_index(completion_index_filepath(config))
+    # the jobs of runs across several nodes are in the journal of the node which ran them
+    timings = {}
+    for filepath in journal_filepaths(config):
+        timings.update(load_job_timings(filepath, journal_mode=None))
+    b2m_length = len(load_b2m_sequence(config))
+    counts = {'predictions': 0, 'models': 0, 'timings': 0, 'failed': 0}
+
+    with open_results_db(db_filepath, journal_mode) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        index_experiments(connection, load_experiment_parameters(config))
+        index_structures(connection, load_prediction_list(config))
+        connection.execute("COMMIT")
+        indexed = {(row['experiment_number'], row['pdb_code']): row for row in connection.execute("SELECT experiment_number, pdb_code, manifest_sha256, timings_version FROM predictions")}
+
+        pending = []
+        timing_updates = []
+        for index_key, entry in completed.items():
+            experiment_number, pdb_code = index_key.split('/')[-2:]
+            if experiment_numbers is not None and experiment_number not in experiment_numbers:
+                continue
+            key = (experiment_number, pdb_code)
+            job_timings = timings.get(key, {})
+            if key in indexed and indexed[key]['manifest_sha256'] == entry.get('manifest_sha256'):
+                if job_timings.get('timings_version') != indexed[key]['timings_version']:
+                    timing_updates.append((job_timings, key))
+                continue
+            pending.append({
+                'experiment_number': experiment_number,
+                'pdb_code': pdb_code,
+                'folder': f"{config['PROJECT_FOLDER']}/{index_key}",
+                'jobname': entry['jobname'],
+                'completed': entry.get('completed'),
+                'manifest_sha256': entry.get('manifest_sha256')
+            })
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            scored = executor.map(score_prediction_task, [(prediction, b2m_length) for prediction in pending], chunksize=8)
+            # we'll write the predictions a batch at a time, so a run indexing its jobs meanwhile only waits for one batch
+            for start in range(0, len(pending), INDEX_BATCH_SIZE):
+                batch = [(prediction, next(scored)) for prediction in pending[start:start + INDEX_BATCH_SIZE]]
+                connection.execute("BEGIN IMMEDIATE")
+                for prediction, rows in batch:
+                    if rows is None:
+                        counts['failed'] += 1
+                        continue
+                    write_prediction(connection, prediction, rows, timings.get((prediction['experiment_number'], prediction['pdb_code'])))
+                    counts['predictions'] += 1
+                    counts['models'] += len(rows)
+                connection.execute("COMMIT")
+
+        if timing_updates:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.executemany(f"UPDATE results SET {', '.join(f'{column} = ?' for column in TIMING_COLUMNS)} WHERE experiment_number = ? AND pdb_code = ?", [(*[job_timings.get(column) for column in TIMING_COLUMNS], *key) for job_timings, key in timing_updates])
+            connection.executemany("UPDATE predictions SET timings_version = ? WHERE experiment_number = ? AND pdb_code = ?", [(job_timings.get('timings_version'), *key) for job_timings, key in timing_updates])
+            connection.execute("COMMIT")
+            counts['timings'] = len(timing_updates)
+    return counts
+
+
+def normalise_allele(allele:str) -> str:
+    # slugs of allele groups like hla_b_27 have no allele number for deslugify_allele_slug to put after the ':'
+    if '_' not in allele:
+        return allele.upper()
+    components = allele.split('_')
+    if len(components) == 4:
+        return deslugify_allele_slug(allele)
+    if len(components) == 3:
+        return f"{components[0]}-{components[1]}*{components[2]}".upper()
+    return allele.upper()
+
+
+def build_filters(experiment_numbers:Optional[List[str]]=None, allele:Optional[str]=None, locus:Optional[str]=None, peptide_length:Optional[int]=None, rank:Optional[int]=1, max_resolution:Optional[float]=None) -> Tuple[str, List]:
+    """
+    This function will build the WHERE clause of a results query.
+
+    Args:
+        experiment_numbers (List[str]): Only include these experiments
+        allele (str): An allele e.g. HLA-B*27:05 or hla_b_27_05, or an allele group e.g. HLA-B*27 or hla_b_27 for every HLA-B*27 allele
+        locus (str): The locus e.g. hla-b
+        peptide_length (int): The length of the peptide
+        rank (int): Only include the models of this rank, or None for every rank
+        max_resolution (float): Only include structures whose crystal structure resolution is at most this
+
+    Returns:
+        where (str): The WHERE clause, empty if there are no filters
+        parameters (List): The parameters for the clause
+    """
+    conditions = []
+    parameters = []
+    if experiment_numbers:
+        conditions.append(f"experiment_number IN ({', '.join('?' for number in experiment_numbers)})")
+        parameters += experiment_numbers
+    if allele:
+        allele = normalise_allele(allele)
+        # ';' is the character after ':', so this range is every allele in the group and can use the index
+        conditions.append("(allele = ? OR (allele >= ? AND allele < ?))")
+        parameters += [allele, f"{allele}:", f"{allele};"]
+    if locus:
+        conditions.append("locus = ?")
+        parameters.append(locus.lower().replace('_', '-'))
+    if peptide_length is not None:
+        conditions.append("peptide_length = ?")
+        parameters.append(peptide_length)
+    if rank is not None:
+        conditions.append("rank = ?")
+        parameters.append(rank)
+    if max_resolution is not None:
+        conditions.append("resolution <= ?")
+        parameters.append(max_resolution)
+    return (f"WHERE {' AND '.join(conditions)}" if conditions else ''), parameters
+
+
+def query_results(db_filepath:str, group_by:List[str], metric:str, filters:Tuple[str, List], order:Optional[str]=None, limit:Optional[int]=None, min_count:int=1) -> List[Dict]:
+    """
+    This function will run a grouped query over the results, giving the count, mean, min and max of a metric for each group.
+
+    Args:
+        db_filepath (str): The path to the results database
+        group_by (List[str]): The GROUP_COLUMNS to group by, or an empty list for a single row over everything
+        metric (str): One of the METRIC_COLUMNS
+        filters (Tuple[str, List]): The WHERE clause and parameters returned by build_filters
+        order (str): 'best' to put the best mean first, or None to order by the groups
+        limit (int): The maximum number of groups to return
+        min_count (int): Leave out groups with fewer structures than this, counting each PDB code once whichever ranks are included
+
+    Returns:
+        rows (List[Dict]): One dictionary per group with the group columns, count, mean, min and max
+
+    Raises:
+        ValueError: If a group column or the metric isn't one of those allowed, as they are put into the SQL
+    """
+    unknown = [column for column in group_by if column not in GROUP_COLUMNS] + ([metric] if metric not in METRIC_COLUMNS else [])
+    if unknown:
+        raise ValueError(f"Unknown columns {', '.join(unknown)}, the groups can be {', '.join(GROUP_COLUMNS)} and the metric {', '.join(METRIC_COLUMNS)}")
+    where, parameters = filters
+    group_columns = ', '.join(group_by)
+    query = f"SELECT {group_columns + ', ' if group_by else ''}COUNT({metric}) AS count, AVG({metric}) AS mean, MIN({metric}) AS min, MAX({metric}) AS max FROM results {where}"
+    if group_by:
+        query += f" GROUP BY {group_columns}"
+    query += " HAVING COUNT(DISTINCT pdb_code) >= ?"
+    parameters = parameters + [min_count]
+    if order == 'best':
+        query += f" ORDER BY mean {'ASC' if metric in LOWER_IS_BETTER else 'DESC'} NULLS LAST"
+    elif group_by:
+        query += f" ORDER BY {group_columns}"
+    if limit is not None:
+        query += " LIMIT ?"
+        parameters.append(limit)
+    with open_results_db(db_filepath, None) as connection:
+        return [dict(row) for row in connection.execute(query, parameters)]
+
+
+def format_value(value) -> str:
+    if value is None:
+        return 'n/a'
+    if isinstance(value, float):
+        return f"{value:.3f}" if abs(value) < 10 else f"{value:.1f}"
+    return str(value)
+
+
+def print_query_results(rows:List[Dict], group_by:List[str], metric:str, title:str, seconds:float, console:Console) -> None:
+    table = Table(title=title)
+    for heading in group_by + ['Count', f"Mean {metric}", 'Min', 'Max']:
+        table.add_column(heading)
+    for row in rows:
+        table.add_row(*[format_value(row[column]) for column in group_by + ['count', 'mean', 'min', 'max']])
+    console.print(table)
+    console.print(f"{len(rows)} groups in {seconds * 1000:.0f}ms")
+
+
+def filter_options(command):
+    # the query and leaderboard subcommands take the same filters
+    for option in reversed([
+        click.option("--environment", default='local', help="The name of the environment, can either be local or poc."),
+        click.option("--experiment_number", default=None, help="Only include these experiments, separated by commas e.g. 31,32,33."),
+        click.option("--allele", default=None, help="Only include this allele, e.g. HLA-B*27:05 or hla_b_27_05, or allele group, e.g. HLA-B*27."),
+        click.option("--locus", default=None, help="Only include this locus, e.g. hla-b."),
+        click.option("--peptide_length", default=None, type=int, help="Only include peptides of this length."),
+        click.option("--rank", default=1, type=int, help="Only include models of this rank, 0 includes every rank."),
+        click.option("--max_resolution", default=None, type=float, help="Only include structures whose crystal structure resolution is at most this."),
+        click.option("--metric", default='peptide_plddt', type=click.Choice(METRIC_COLUMNS), help="The metric to summarise.")
+    ]):
+        command = option(command)
+    return command
+
+
+@click.group()
+def results():
+    pass
+
+
+@results.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="Only index these experiments, separated by commas e.g. 31,32,33.")
+@click.option("--workers", default=None, type=int, help="The number of worker processes reading scores, defaults to the number of CPUs.")
+def index(environment, experiment_number, workers):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        start = time.perf_counter()
+        with console.status("Indexing results...", spinner="dots"):
+            counts = update_results_db(config, results_db_filepath(config), experiment_numbers, workers)
+        console.print(f"Indexed {counts['models']} ranked models from {counts['predictions']} predictions and updated the timings of {counts['timings']} in {time.perf_counter() - start:.1f}s")
+        if counts['failed']:
+            console.print(f"[bold yellow]{counts['failed']} predictions could not be read, they will be tried again next time[/bold yellow]")
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+@results.command()
+@filter_options
+@click.option("--group_by", default='experiment_number', help="The columns to group by, separated by commas e.g. experiment_number,peptide_length.")
+@click.option("--best", is_flag=True, default=False, help="Order the groups by their mean metric, best first, rather than by the groups.")
+@click.option("--limit", default=None, type=int, help="The maximum number of groups to show.")
+def query(environment, experiment_number, allele, locus, peptide_length, rank, max_resolution, metric, group_by, best, limit):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        group_columns = [column.strip() for column in group_by.split(',') if column.strip()]
+        filters = build_filters(experiment_numbers, allele, locus, peptide_length, rank or None, max_resolution)
+        start = time.perf_counter()
+        try:
+            rows = query_results(results_db_filepath(config), group_columns, metric, filters, order='best' if best else None, limit=limit)
+        except ValueError as error:
+            console.print(f"[bold red]{error}[/bold red]")
+        else:
+            print_query_results(rows, group_columns, metric, f"{metric} by {', '.join(group_columns) or 'everything'}", time.perf_counter() - start, console)
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+@results.command()
+@filter_options
+@click.option("--limit", default=10, help="The number of experiments to show.")
+@click.option("--min_structures", default=1, help="Leave out experiments with fewer structures than this, so experiments which are partly run don't top the board.")
+def leaderboard(environment, experiment_number, allele, locus, peptide_length, rank, max_resolution, metric, limit, min_structures):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+        filters = build_filters(experiment_numbers, allele, locus, peptide_length, rank or None, max_resolution)
+        group_columns = ['experiment_number', 'binding_cutoff', 'hamming_cutoff', 'allele_cutoff']
+        start = time.perf_counter()
+        rows = query_results(results_db_filepath(config), group_columns, metric, filters, order='best', limit=limit, min_count=min_structures)
+        described = ', '.join(part for part in [allele, locus, f"{peptide_length}-mers" if peptide_length else None] if part)
+        print_query_results(rows, group_columns, metric, f"Best experiments by {metric}{' for ' + described if described else ''}", time.perf_counter() - start, console)
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    results()
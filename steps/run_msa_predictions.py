@@ -1,28 +1,35 @@
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Tuple, Optional
 
+import asyncio
+import functools
 import json
 import os
+import queue
+import shutil
+import socket
+import subprocess
 import datetime
+import time
+import threading
+import concurrent.futures
+import multiprocessing
+import sqlite3
 import click
 from rich.console import Console
 
-from functions import load_config, load_prediction_list, load_allele_sequences, load_b2m_sequence, make_filepath, create_combined_sequence
-
-
-def write_log_file(log:Dict, filepath:str, testing:bool) -> None:
-    """ 
-    This function writes a log file to the specified filepath.
-
-    Args:
-        log (Dict): The log dictionary to write to the file.
-        filepath (str): The filepath to write the log file to.
-        testing (bool): Whether we are in testing mode or not.
-
-    """
-    if not testing:
-        with open(filepath, 'w') as f:
-            json.dump(log, f, indent=4)
-    pass
+from functions import load_config, load_prediction_list, load_allele_sequences, load_b2m_sequence, make_filepath, journal_filepath, journal_filepaths, completion_index_filepath, create_combined_sequence, build_colabfold_command
+from scheduler import parse_gpu_numbers
+from async_executor import run_command_async, run_jobs
+from batching import bucket_jobs_by_length, create_batch_id, reset_folder, split_batch_outputs
+from a3m_template import parse_a3m_template, write_a3m_from_template
+from prediction_cache import compute_prediction_key, lookup_cached_prediction, store_prediction, evict_predictions
+from journal import LOCAL_JOURNAL_MODE, SHARED_JOURNAL_MODE, list_jobs, transition_job, import_log_json, export_log_json
+from manifest import load_completion_index, is_prediction_complete, record_completed_prediction, manifest_digest, verify_completion_manifest
+from prediction_archive import is_archived
+from telemetry import timed_span, record_span, record_colabfold_log
+from relax import strip_relax_options, find_models_to_relax, detect_relax_backend, submit_relaxation
+from leases import create_job_claims, claim_job_lease, release_job_lease, holds_job_lease, is_lease_lost, note_claimed_elsewhere, is_claimed_elsewhere, take_claimed_elsewhere, start_claims_heartbeat, parse_shard, in_shard
+from results_db import results_db_filepath, load_experiment_parameters, load_job_timings, index_prediction
 
 
 def load_prediction_data(config:Dict, structure_set:str) -> Tuple[List[Dict], Dict, str]:
@@ -46,25 +53,1010 @@ def load_prediction_data(config:Dict, structure_set:str) -> Tuple[List[Dict], Di
     return structures_to_predict, allele_sequences, b2m_seq
 
 
+def node_journal_filepath(config:Dict, journal_mode:str) -> str:
+    # when nodes share the project folder each writes to a journal of its own, and the lease files and completion manifests decide which node runs a job and whether it's done
+    return journal_filepath(config, socket.gethostname() if journal_mode == SHARED_JOURNAL_MODE else None)
+
+
+def prepare_experiment(config:Dict, experiment_number:str, testing:bool, journal_mode:str=LOCAL_JOURNAL_MODE) -> Dict:
+    """
+    This function will create the output folders for an experiment and load its job status from the journal.
+
+    If the journal has nothing for the experiment but an old log.json file exists, the log file is imported into the journal first.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        experiment_number (str): The experiment number
+        testing (bool): Whether we are in testing mode or not
+        journal_mode (str): The SQLite journal mode of the journal, see journal.open_journal
+
+    Returns:
+        experiment (Dict): A dictionary with the experiment_number, a3m_filepath, the parsed a3m template, folder, log_filepath, journal_filepath, journal_mode, a snapshot of the log and a lock for the snapshot
+    """
+    # every experiment shares one journal of job status (one per node across several nodes), the per experiment log.json files are exported from it
+    experiment_journal_filepath = node_journal_filepath(config, journal_mode)
+
+    # We'll create the output folder structure if it doesn't exist
+    experiment_folder = make_filepath(config, 'output', 'experiments', experiment_number)
+    if not os.path.exists(experiment_folder):
+        os.makedirs(experiment_folder)
+
+    experiment_log_filepath = f"{experiment_folder}/log.json"
+    if testing:
+        # in testing mode nothing is written, so we'll just read the log file if there is one
+        experiment_log = {}
+        if os.path.exists(experiment_log_filepath):
+            with open(experiment_log_filepath, 'r') as f:
+                experiment_log = json.load(f)
+    else:
+        experiment_log = list_jobs(experiment_journal_filepath, experiment_number, journal_mode=journal_mode)
+        if not experiment_log and os.path.exists(experiment_log_filepath):
+            import_log_json(experiment_journal_filepath, experiment_number, experiment_log_filepath, journal_mode=journal_mode)
+            experiment_log = list_jobs(experiment_journal_filepath, experiment_number, journal_mode=journal_mode)
+
+    # we'll parse the experiment a3m once, the per structure a3m files are then streamed from it
+    experiment_a3m_filepath = make_filepath(config, 'input', 'experiments', f"experiment{experiment_number}.a3m")
+
+    return {
+        'experiment_number': experiment_number,
+        'a3m_filepath': experiment_a3m_filepath,
+        'a3m_template': parse_a3m_template(experiment_a3m_filepath),
+        'folder': experiment_folder,
+        'log_filepath': experiment_log_filepath,
+        'journal_filepath': experiment_journal_filepath,
+        'journal_mode': journal_mode,
+        'log': experiment_log,
+        'lock': threading.Lock()
+    }
+
+
+def update_experiment_log(experiment:Dict, pdb_code:str, changes:Dict, testing:bool, unless_status:Optional[List[str]]=None) -> bool:
+    """
+    This function will atomically update the journal entry for a PDB code, it is safe to call from several workers and processes at once.
+
+    Args:
+        experiment (Dict): The experiment dictionary returned by prepare_experiment
+        pdb_code (str): The PDB code to update
+        changes (Dict): The keys and values to set on the log entry
+        testing (bool): Whether we are in testing mode or not, in testing mode only the in memory snapshot is updated
+        unless_status (List[str]): If the job currently has one of these statuses in the journal it is left alone
+
+    Returns:
+        updated (bool): True if the entry was updated
+    """
+    if not testing:
+        if not transition_job(experiment['journal_filepath'], experiment['experiment_number'], pdb_code, changes, unless_status=unless_status, journal_mode=experiment['journal_mode']):
+            return False
+    with experiment['lock']:
+        experiment['log'].setdefault(pdb_code, {}).update(changes)
+    return True
+
+
+def export_experiment_logs(experiments:Dict[str, Dict], testing:bool, other_journal_filepaths:Optional[List[str]]=None) -> None:
+    """
+    This function will write the log.json file for each experiment from the journal, once at the end of a run.
+
+    Args:
+        experiments (Dict[str, Dict]): The experiment dictionaries returned by prepare_experiment, keyed by experiment number
+        testing (bool): Whether we are in testing mode or not, nothing is written in testing mode
+        other_journal_filepaths (List[str]): The journals of the other nodes sharing the project folder, whose finished jobs are included
+    """
+    if not testing:
+        for experiment_number, experiment in experiments.items():
+            export_log_json(experiment['journal_filepath'], experiment_number, experiment['log_filepath'], journal_mode=experiment['journal_mode'], other_filepaths=other_journal_filepaths)
+
+
+def create_grid_run(config:Dict, b2m_seq:str, testing:bool, console:Console, share_a3m:bool=False, use_cache:bool=True, relax_workers:int=0, relax_top_k:int=5, relax_backend:str='auto', lease_ttl:Optional[float]=None, on_progress:Optional[Callable[[str, Dict], None]]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> Dict:
+    """
+    This function will set up the state of a run over the experiment grid, which is passed to each stage of the run: job preparation, the single and batch runs, completion and the job claims.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        b2m_seq (str): The canonical sequence of the B2M gene
+        testing (bool): Whether we are in testing mode or not, in testing mode the commands are printed rather than run
+        console (Console): The rich console to print to
+        share_a3m (bool): Whether to hard link identical per structure a3m files from a content addressed store rather than writing a copy for each
+        use_cache (bool): Whether to resolve jobs from (and add finished jobs to) the prediction cache
+        relax_workers (int): The number of CPU processes relaxing models, see run_experiment_grid
+        relax_top_k (int): The number of top ranked models relaxed by the relax workers
+        relax_backend (str): How the relax workers relax each model, 'local', 'container' or 'auto'
+        lease_ttl (float): If set, each job is claimed through a lease file before it runs, see run_experiment_grid
+        on_progress (Callable): An optional function called with the job_id and each progress update parsed from the container output
+        journal_mode (str): The SQLite journal mode of the journal and the results database
+
+    Returns:
+        grid (Dict): A dictionary with the config and options of the run, the experiments once they're prepared, the completion index, the job claims, the relax pool and the relax failures
+    """
+    a3m_tmp_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}/tmp"
+    if not os.path.exists(a3m_tmp_folder):
+        os.makedirs(a3m_tmp_folder)
+
+    # when relaxation is pipelined the GPU containers only run inference, and the unrelaxed models are handed to a pool of CPU processes
+    pipelined_relax = relax_workers > 0
+    colabfold_options = strip_relax_options(config['COLABFOLD_OPTIONS']) if pipelined_relax else config['COLABFOLD_OPTIONS']
+    if pipelined_relax and relax_backend == 'auto':
+        relax_backend = detect_relax_backend()
+
+    return {
+        'config': config,
+        'b2m_seq': b2m_seq,
+        'testing': testing,
+        'console': console,
+        'journal_mode': journal_mode,
+        'journal_filepath': node_journal_filepath(config, journal_mode),
+        # the timing spans go in the journal alongside the job status, apart from in testing mode
+        'spans_filepath': None if testing else node_journal_filepath(config, journal_mode),
+        # and one index of finished prediction folders, so a resume needs a single read rather than a scan of every folder
+        'completion_index_filepath': completion_index_filepath(config),
+        'results_db_filepath': results_db_filepath(config),
+        # the results database can't be shared by nodes any more than the journal can, so runs across nodes are indexed afterwards with 'results_db.py index'
+        'index_results': not testing and journal_mode == LOCAL_JOURNAL_MODE,
+        'a3m_tmp_folder': a3m_tmp_folder,
+        'a3m_store_folder': f"{a3m_tmp_folder}/a3m_store" if share_a3m else None,
+        'use_cache': use_cache,
+        'prediction_cache_folder': make_filepath(config, 'output', 'cache', 'predictions'),
+        'colabfold_options': colabfold_options,
+        # the relaxed models depend on how many ranks are relaxed, so that's part of the cache key too
+        'cache_options': f"{colabfold_options}--cpu-relax-top-k {relax_top_k}" if pipelined_relax else colabfold_options,
+        'pipelined_relax': pipelined_relax,
+        'relax_workers': relax_workers,
+        'relax_top_k': relax_top_k,
+        'relax_backend': relax_backend,
+        'relax_pool': None,
+        'relax_completions': None,
+        'relax_completer': None,
+        'relax_failures': {},
+        'completed': load_completion_index(completion_index_filepath(config)),
+        # finished jobs are added to the results database with their experiment's cutoffs
+        'experiment_parameters': load_experiment_parameters(config),
+        'experiments': {},
+        # with leases, a job is only run by the node which holds its lease
+        'claims': create_job_claims(None if testing else lease_ttl),
+        'on_progress': on_progress
+    }
+
+
+def prepare_jobs(grid:Dict, experiment_numbers:List[str], structures_to_predict:List[Dict], allele_sequences:Dict) -> Tuple[List[Dict], List[Dict]]:
+    """
+    This function will prepare each experiment and make a job for each of its structures which hasn't been predicted yet.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run, the experiments are added to it
+        experiment_numbers (List[str]): The experiment numbers to run
+        structures_to_predict (List[Dict]): The structures to predict for each experiment
+        allele_sequences (Dict): A dictionary with the allele as the key and the sequence as the value
+
+    Returns:
+        jobs (List[Dict]): The jobs to run
+        relax_only_jobs (List[Dict]): The jobs whose inference finished but whose models weren't all relaxed (e.g. the run was stopped), which only need relaxing
+    """
+    jobs = []
+    relax_only_jobs = []
+    for experiment_number in experiment_numbers:
+        experiment = prepare_experiment(grid['config'], experiment_number, grid['testing'], grid['journal_mode'])
+        grid['experiments'][experiment_number] = experiment
+
+        for structure in structures_to_predict:
+            job = prepare_job(grid, experiment, structure, allele_sequences)
+            if job is not None:
+                (relax_only_jobs if job['relax_only'] else jobs).append(job)
+    return jobs, relax_only_jobs
+
+
+def prepare_job(grid:Dict, experiment:Dict, structure:Dict, allele_sequences:Dict) -> Optional[Dict]:
+    """
+    This function will make the job for a structure in an experiment, unless its predictions are already done or can be linked from the prediction cache.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        experiment (Dict): The experiment dictionary returned by prepare_experiment
+        structure (Dict): The structure to predict
+        allele_sequences (Dict): A dictionary with the allele as the key and the sequence as the value
+
+    Returns:
+        job (Dict): The job dictionary, with 'relax_only' set if only its relaxation is left, or None if there's nothing to run
+    """
+    config = grid['config']
+    testing = grid['testing']
+    console = grid['console']
+    b2m_seq = grid['b2m_seq']
+    experiment_number = experiment['experiment_number']
+    pdb_code = structure['pdb_code']
+
+    # we'll create the in container filepath for the output folder and the local output folder
+    item_path = f"{config['OUTPUT_FOLDER']}/experiments/{experiment_number}/{pdb_code}"
+    local_output_folder = f"{config['PROJECT_FOLDER']}/{item_path}"
+
+    # we'll check if the predictions have already been run for this PDB code, and haven't been deleted since so that they're run again
+    if pdb_code in experiment['log'] and experiment['log'][pdb_code]['status'] == 'done' and (os.path.exists(local_output_folder) or is_archived(local_output_folder)):
+        console.print(f"[bold green]Predictions already exist for {pdb_code} in experiment {experiment_number}[/bold green]")
+        return None
+    if pdb_code not in experiment['log'] or experiment['log'][pdb_code]['status'] == 'done':
+        update_experiment_log(experiment, pdb_code, {'status': 'preparing'}, testing)
+
+    # we'll check the completion index (and failing that the folder's manifest) to see if the predictions are done for that PDB code
+    jobname = f"{pdb_code}_{experiment_number}"
+    relax_pending = grid['pipelined_relax'] and item_path not in grid['completed'] and os.path.exists(f"{local_output_folder}/{jobname}.done.txt") and len(find_models_to_relax(local_output_folder, jobname, grid['relax_top_k'])) > 0
+    if not relax_pending and is_prediction_complete(local_output_folder, item_path, jobname, grid['completed'], None if testing else grid['completion_index_filepath']):
+        update_experiment_log(experiment, pdb_code, {'status': 'done'}, testing)
+        console.print(f"[bold green]Predictions already exist for {pdb_code} in experiment {experiment_number}[/bold green]")
+        return None
+
+    combined_sequence = create_combined_sequence(allele_sequences, structure, b2m_seq, 274)
+
+    # the cache key covers everything which determines the prediction, so experiments with the same MSA body share their predictions
+    chain_sequences = ':'.join([combined_sequence[:274], b2m_seq, structure['peptide_sequence']])
+    cache_key = compute_prediction_key(chain_sequences, experiment['a3m_template']['body_digest'], grid['cache_options'], config['CONTAINER_IMAGE'])
+    if grid['use_cache'] and not testing and not relax_pending and lookup_cached_prediction(grid['prediction_cache_folder'], cache_key, local_output_folder, jobname):
+        record_completed_prediction(grid['completion_index_filepath'], local_output_folder, item_path, jobname)
+        update_experiment_log(experiment, pdb_code, {'status': 'done', 'cache_key': cache_key, 'cached': True}, testing)
+        console.print(f"[bold green]Predictions for {pdb_code} in experiment {experiment_number} found in the cache[/bold green]")
+        return None
+
+    return {
+        'job_id': f"{experiment_number}/{pdb_code}",
+        'experiment_number': experiment_number,
+        'pdb_code': pdb_code,
+        'structure': structure,
+        'combined_sequence': combined_sequence,
+        'chain_lengths': [274, len(b2m_seq), len(structure['peptide_sequence'])],
+        'sequence_length': len(combined_sequence),
+        'jobname': jobname,
+        'index_key': item_path,
+        'cache_key': cache_key,
+        'relax_only': relax_pending,
+        'local_a3m_filepath': f"{grid['a3m_tmp_folder']}/{pdb_code}_{experiment_number}.a3m",
+        'docker_a3m_filepath': f"/work/{config['OUTPUT_FOLDER']}/tmp/{pdb_code}_{experiment_number}.a3m",
+        'local_output_folder': local_output_folder,
+        'docker_output_folder': f"/work/{item_path}"
+    }
+
+
+def span_attributes(grid:Dict, job:Dict, **attributes) -> Dict:
+    attributes.update({'sequence_length': job['sequence_length'], 'msa_depth': grid['experiments'][job['experiment_number']]['a3m_template']['depth']})
+    return attributes
+
+
+def write_job_a3m(grid:Dict, job:Dict, a3m_filepath:str) -> None:
+    # we need one a3m per prediction with the concatenated sequence as the first sequence in the alignment, followed by the experiment's shared alignment
+    template = grid['experiments'][job['experiment_number']]['a3m_template']
+    with timed_span(grid['spans_filepath'], job['experiment_number'], job['pdb_code'], 'a3m_build', span_attributes(grid, job), journal_mode=grid['journal_mode']):
+        write_a3m_from_template(template, job['combined_sequence'], a3m_filepath, chain_lengths=job['chain_lengths'], store_folder=grid['a3m_store_folder'])
+
+
+def record_job_timings(grid:Dict, job:Dict, container_start:Optional[datetime.datetime], **attributes) -> None:
+    # colabfold logs a timestamped line for each stage, so we'll split the time in the container into backend init, msa setup, compile, inference and relax
+    record_colabfold_log(grid['journal_filepath'], job['experiment_number'], job['pdb_code'], f"{job['local_output_folder']}/log.txt", job['jobname'], attributes=span_attributes(grid, job, **attributes), container_start=container_start, journal_mode=grid['journal_mode'])
+
+
+def record_container_span(grid:Dict, job:Dict, gpu:str, start_time:datetime.datetime, returncode:Optional[int], **attributes) -> None:
+    seconds = (datetime.datetime.now() - start_time).total_seconds()
+    record_span(grid['journal_filepath'], job['experiment_number'], job['pdb_code'], 'container', seconds, start_time=start_time, attributes=span_attributes(grid, job, gpu=gpu, returncode=returncode, **attributes), journal_mode=grid['journal_mode'])
+
+
+def job_lease_filepath(grid:Dict, job:Dict) -> str:
+    return f"{grid['experiments'][job['experiment_number']]['folder']}/leases/{job['pdb_code']}.lease"
+
+
+def claim_job(grid:Dict, job:Dict) -> bool:
+    # without leases every job is ours, with them a job is only run by the node which holds its lease
+    return claim_job_lease(grid['claims'], job_lease_filepath(grid, job), job['job_id'])
+
+
+def release_job(grid:Dict, job:Dict) -> None:
+    release_job_lease(grid['claims'], job_lease_filepath(grid, job))
+
+
+def holds_job(grid:Dict, job:Dict) -> bool:
+    # the lease file is read again, so a job taken over since the last heartbeat isn't recorded as ours
+    return holds_job_lease(grid['claims'], job_lease_filepath(grid, job))
+
+
+def finished_elsewhere(grid:Dict, job:Dict) -> bool:
+    # with leases the journal is this node's own, so whether another node has finished the job since it was queued comes from the folder's manifest
+    if grid['claims'] is None:
+        return False
+    return is_archived(job['local_output_folder']) or verify_completion_manifest(job['local_output_folder'])
+
+
+def give_up_job(grid:Dict, job:Dict) -> None:
+    # another node took the job over when our lease expired, so its outputs and journal entry are left to them and we'll wait for them to finish it
+    note_claimed_elsewhere(grid['claims'], job['job_id'])
+    grid['console'].print(f"[bold yellow]Lost the lease on {job['job_id']}, leaving it to the node which took it over[/bold yellow]")
+
+
+async def watch_job_leases(grid:Dict, jobs:List[Dict]) -> None:
+    # the heartbeat notes the leases it finds have been lost, we'll check every second so the container is stopped soon after
+    lease_filepaths = [job_lease_filepath(grid, job) for job in jobs]
+    while not all(is_lease_lost(grid['claims'], lease_filepath) for lease_filepath in lease_filepaths):
+        await asyncio.sleep(1)
+
+
+async def run_leased_command(grid:Dict, jobs:List[Dict], command:str, log_filepath:str, timeout:Optional[float], container_name:str, on_progress:Optional[Callable[[Dict], None]]) -> Optional[int]:
+    """
+    This function will run a job's container, stopping it if another node takes over the leases of the jobs it is running.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        jobs (List[Dict]): The jobs the container is running, it is only stopped once every one of their leases has been lost
+        command (str): The command to run
+        log_filepath (str): The path to write the stdout and stderr to, without the extension
+        timeout (float): The wall clock timeout in seconds, or None for no timeout
+        container_name (str): The name of the container, used to stop it
+        on_progress (Callable): An optional function called with each progress update parsed from the container output
+
+    Returns:
+        returncode (int): The exit code of the container, or None if it was stopped because the leases were lost
+    """
+    command_task = asyncio.ensure_future(run_command_async(command, log_filepath, timeout=timeout, container_name=container_name, on_progress=on_progress))
+    if grid['claims'] is None:
+        return await command_task
+    lease_task = asyncio.ensure_future(watch_job_leases(grid, jobs))
+    try:
+        await asyncio.wait([command_task, lease_task], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # whichever finishes first the other is stopped, and if we've been cancelled both are
+        for task in [command_task, lease_task]:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(command_task, lease_task, return_exceptions=True)
+    if lease_task.done() and not lease_task.cancelled():
+        return None
+    return command_task.result()
+
+
+def complete_job(grid:Dict, job:Dict) -> bool:
+    # colabfold writes '<jobname>.done.txt' last, so without it the prediction didn't finish whatever the exit code was
+    try:
+        job['manifest'] = record_completed_prediction(grid['completion_index_filepath'], job['local_output_folder'], job['index_key'], job['jobname'])
+    except FileNotFoundError:
+        return False
+    if grid['use_cache']:
+        store_prediction(grid['prediction_cache_folder'], job['cache_key'], job['local_output_folder'], job['jobname'], {'experiment_number': job['experiment_number'], 'pdb_code': job['pdb_code']})
+    return True
+
+
+def finish_job(grid:Dict, job:Dict, start_time:datetime.datetime, changes:Dict) -> bool:
+    """
+    This function will complete a job whose predictions have been written, giving it its manifest, index and cache entries, marking it as done and adding it to the results database.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        start_time (datetime.datetime): When the job started running
+        changes (Dict): Anything else to record in the job's journal entry, e.g. the batch size
+
+    Returns:
+        finished (bool): False if the predictions weren't finished after all, in which case the job is marked as failed
+    """
+    experiment = grid['experiments'][job['experiment_number']]
+    if not complete_job(grid, job):
+        update_experiment_log(experiment, job['pdb_code'], {'status': 'failed', **changes}, grid['testing'])
+        return False
+    end_time = datetime.datetime.now()
+    update_experiment_log(experiment, job['pdb_code'], {'status': 'done', 'end_time': end_time.isoformat(), 'elapsed_time': (end_time - start_time).total_seconds(), 'cache_key': job['cache_key'], **changes}, grid['testing'])
+    if grid['index_results']:
+        index_job_results(grid, job)
+    return True
+
+
+def index_job_results(grid:Dict, job:Dict) -> None:
+    # the job is done whatever happens here, a prediction which isn't indexed now is picked up by the next 'results_db.py index'
+    prediction = {
+        'experiment_number': job['experiment_number'],
+        'pdb_code': job['pdb_code'],
+        'folder': job['local_output_folder'],
+        'jobname': job['jobname'],
+        'completed': job['manifest']['completed'],
+        'manifest_sha256': manifest_digest(job['manifest'])
+    }
+    try:
+        timings = load_job_timings(grid['journal_filepath'], (job['experiment_number'], job['pdb_code']), grid['journal_mode']).get((job['experiment_number'], job['pdb_code']))
+        index_prediction(grid['results_db_filepath'], prediction, len(grid['b2m_seq']), job['structure'], grid['experiment_parameters'].get(job['experiment_number']), timings, grid['journal_mode'])
+    except (sqlite3.Error, OSError, ValueError, KeyError) as error:
+        grid['console'].print(f"[bold yellow]Could not add {job['job_id']} to the results database: {error}[/bold yellow]")
+
+
+def relax_job(grid:Dict, job:Dict, start_time:datetime.datetime, changes:Dict) -> None:
+    """
+    This function will hand the top ranked models of a job to the relax pool, the job is finished by the relax completion thread once they have all been relaxed.
+
+    The GPU worker moves straight on to its next job, and the job keeps its lease until it has been relaxed and finished.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        start_time (datetime.datetime): When the job started running
+        changes (Dict): Anything else to record in the job's journal entry once it's done
+    """
+    experiment = grid['experiments'][job['experiment_number']]
+    if grid['testing']:
+        grid['console'].print(f"Relax the top {grid['relax_top_k']} models of {job['local_output_folder']} with the {grid['relax_backend']} backend")
+        return
+    update_experiment_log(experiment, job['pdb_code'], {'status': 'relaxing', **changes}, grid['testing'])
+
+    def relaxed(seconds:float, error:Optional[Exception]) -> None:
+        # this is called from the pool's own thread, which swallows any exception, so the job is finished on the relax completion thread instead
+        grid['relax_completions'].put({'job': job, 'start_time': start_time, 'changes': changes, 'seconds': seconds, 'error': error})
+
+    submit_relaxation(grid['relax_pool'], grid['config'], job['local_output_folder'], job['docker_output_folder'], job['jobname'], grid['relax_top_k'], grid['relax_backend'], relaxed)
+
+
+def start_relax_completions(grid:Dict) -> None:
+    """
+    This function will start the relax pool, and the thread which finishes each job once its models have been relaxed.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run, the relax pool, queue and thread are added to it
+    """
+    # spawned rather than forked workers, as the GPU worker threads may be holding locks when the pool starts a process
+    grid['relax_pool'] = concurrent.futures.ProcessPoolExecutor(max_workers=grid['relax_workers'], mp_context=multiprocessing.get_context('spawn'))
+    grid['relax_completions'] = queue.Queue()
+    grid['relax_completer'] = threading.Thread(target=complete_relaxations, args=(grid,), daemon=True)
+    grid['relax_completer'].start()
+
+
+def stop_relax_completions(grid:Dict, cancelled:bool) -> None:
+    """
+    This function will shut the relax pool down, then wait for the relax completion thread to finish the jobs it has been given.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        cancelled (bool): Whether the run was cancelled, in which case the models waiting to be relaxed are dropped rather than waited for
+    """
+    if grid['relax_pool'] is None:
+        return
+    # the GPU work is finished, but the last jobs may still be relaxing, unless we've been cancelled
+    grid['relax_pool'].shutdown(wait=not cancelled, cancel_futures=cancelled)
+    grid['relax_completions'].put(None)
+    grid['relax_completer'].join()
+
+
+def complete_relaxations(grid:Dict) -> None:
+    # we'll finish each relaxed job in turn until the queue is closed with None
+    while True:
+        relaxation = grid['relax_completions'].get()
+        if relaxation is None:
+            return
+        job = relaxation['job']
+        try:
+            complete_relaxation(grid, job, relaxation['start_time'], relaxation['changes'], relaxation['seconds'], relaxation['error'])
+        except Exception as error:
+            # the job mustn't be left 'relaxing', so we'll record it as failed and a rerun will relax it again
+            record_relax_failure(grid, job, error)
+        finally:
+            # the lease is only let go once the job is done (or failed), so no other node can pick it up part of the way through
+            release_job(grid, job)
+
+
+def complete_relaxation(grid:Dict, job:Dict, start_time:datetime.datetime, changes:Dict, seconds:float, error:Optional[Exception]) -> None:
+    """
+    This function will finish a job once its models have been relaxed, or record why they weren't.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        start_time (datetime.datetime): When the job started running
+        changes (Dict): Anything else to record in the job's journal entry once it's done
+        seconds (float): The total time spent relaxing the job's models
+        error (Exception): The first error from relaxing the models, or None
+    """
+    if isinstance(error, concurrent.futures.CancelledError):
+        # the run was cancelled, so the job is left to be relaxed when it's resumed rather than marked as failed
+        update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'cancelled'}, grid['testing'])
+        return
+    if error is not None:
+        record_relax_failure(grid, job, error)
+        return
+    record_span(grid['journal_filepath'], job['experiment_number'], job['pdb_code'], 'cpu_relax', seconds, attributes=span_attributes(grid, job, relax_backend=grid['relax_backend'], relax_top_k=grid['relax_top_k']), journal_mode=grid['journal_mode'])
+    if not holds_job(grid, job):
+        give_up_job(grid, job)
+        return
+    if finish_job(grid, job, start_time, changes):
+        grid['console'].print(f"[bold green]{job['job_id']} relaxed[/bold green]")
+
+
+def record_relax_failure(grid:Dict, job:Dict, error:Exception) -> None:
+    grid['relax_failures'][job['job_id']] = {'job_id': job['job_id'], 'status': 'failed', 'error': str(error)}
+    grid['console'].print(f"[bold red]{job['job_id']} relaxation failed: {error}[/bold red]")
+    try:
+        update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'failed', 'relax_error': str(error)}, grid['testing'])
+    except (sqlite3.Error, OSError) as journal_error:
+        grid['console'].print(f"[bold red]Could not record the failure of {job['job_id']} in the journal: {journal_error}[/bold red]")
+
+
+def hand_over_job(grid:Dict, job:Dict, start_time:datetime.datetime, changes:Dict) -> Tuple[bool, bool]:
+    """
+    This function will finish a job whose container has written its predictions, or hand it to the relax pool when relaxation is pipelined.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        start_time (datetime.datetime): When the job started running
+        changes (Dict): Anything else to record in the job's journal entry once it's done
+
+    Returns:
+        handed_to_relax (bool): True if the job went to the relax pool, which releases its lease once it's relaxed
+        finished (bool): Whether the job finished (or went to the relax pool)
+    """
+    if grid['pipelined_relax']:
+        relax_job(grid, job, start_time, changes)
+        return True, True
+    return False, finish_job(grid, job, start_time, changes)
+
+
+def stopped_status(error:BaseException) -> str:
+    if isinstance(error, subprocess.TimeoutExpired):
+        return 'timeout'
+    return 'cancelled' if isinstance(error, (asyncio.CancelledError, KeyboardInterrupt)) else 'failed'
+
+
+def job_progress(grid:Dict, job_id:str) -> Optional[Callable[[Dict], None]]:
+    on_progress = grid['on_progress']
+    return None if on_progress is None else lambda progress: on_progress(job_id, progress)
+
+
+def start_job(grid:Dict, job:Dict, gpu:str) -> Optional[Dict]:
+    """
+    This function will get a single job ready to run, writing its input and claiming it, off the event loop.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        gpu (str): The GPU the job runs on
+
+    Returns:
+        started (Dict): A dictionary with the command, container_name, start_time and log_filepath, or None if the job shouldn't be run (testing mode, another node holds it or it's already done)
+    """
+    config = grid['config']
+    experiment = grid['experiments'][job['experiment_number']]
+    pdb_code = job['pdb_code']
+
+    # we'll create the a3m file if it doesn't exist
+    if not os.path.exists(job['local_a3m_filepath']):
+        write_job_a3m(grid, job, job['local_a3m_filepath'])
+
+    if not os.path.exists(job['local_output_folder']):
+        os.makedirs(job['local_output_folder'])
+
+    container_name = f"viridien_{job['experiment_number']}_{pdb_code}"
+    colabfold_command = build_colabfold_command(config, job['docker_a3m_filepath'], job['docker_output_folder'], gpu=gpu, container_name=container_name, interactive=False, colabfold_options=grid['colabfold_options'])
+
+    if grid['testing']:
+        grid['console'].print(colabfold_command)
+        return None
+
+    # if another node holds the job's lease we'll leave it to them, and if another node has finished it we'll leave it be
+    if not claim_job(grid, job):
+        return None
+    if finished_elsewhere(grid, job):
+        update_experiment_log(experiment, pdb_code, {'status': 'done'}, grid['testing'])
+        release_job(grid, job)
+        return None
+
+    # if another worker has finished this job since it was queued we'll leave it alone
+    start_time = datetime.datetime.now()
+    if not update_experiment_log(experiment, pdb_code, {'status': 'running', 'start_time': start_time.isoformat(), 'gpu': gpu}, grid['testing'], unless_status=['done']):
+        release_job(grid, job)
+        return None
+    return {'command': colabfold_command, 'container_name': container_name, 'start_time': start_time, 'log_filepath': f"{experiment['folder']}/logs/{pdb_code}"}
+
+
+def end_job(grid:Dict, job:Dict, gpu:str, started:Dict, returncode:int) -> bool:
+    """
+    This function will record the outcome of a single job's container, then finish the job or hand it to the relax pool.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        gpu (str): The GPU the job ran on
+        started (Dict): The dictionary returned by start_job
+        returncode (int): The exit code of the container
+
+    Returns:
+        succeeded (bool): True if the job finished (or went to the relax pool)
+    """
+    start_time = started['start_time']
+    handed_to_relax = False
+    try:
+        record_container_span(grid, job, gpu, start_time, returncode)
+        # colabfold writes '<jobname>.done.txt' last, so without it the prediction didn't finish whatever the exit code was
+        if returncode != 0 or not os.path.exists(f"{job['local_output_folder']}/{job['jobname']}.done.txt"):
+            update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'failed', 'returncode': returncode}, grid['testing'])
+            return False
+        record_job_timings(grid, job, start_time, gpu=gpu)
+        if not holds_job(grid, job):
+            give_up_job(grid, job)
+            return True
+        handed_to_relax, finished = hand_over_job(grid, job, start_time, {})
+        return finished
+    finally:
+        if not handed_to_relax:
+            release_job(grid, job)
+
+
+def stop_job(grid:Dict, job:Dict, gpu:str, started:Dict, error:BaseException) -> None:
+    # the job's container has been stopped by a timeout or Ctrl-C, so we'll record why and let the job go
+    status = stopped_status(error)
+    record_container_span(grid, job, gpu, started['start_time'], None, stopped=status)
+    update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': status}, grid['testing'])
+    release_job(grid, job)
+
+
+async def run_job(grid:Dict, job:Dict, gpu:str, timeout:Optional[float]) -> bool:
+    """
+    This function will run a single job's container on a GPU, the job scheduler calls it with the grid bound.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        job (Dict): The job dictionary returned by prepare_job
+        gpu (str): The GPU to run on
+        timeout (float): The wall clock timeout in seconds, or None for no timeout
+
+    Returns:
+        succeeded (bool): True if the job finished, or there was nothing for this node to run
+    """
+    started = await asyncio.to_thread(start_job, grid, job, gpu)
+    if started is None:
+        return True
+    try:
+        returncode = await run_leased_command(grid, [job], started['command'], started['log_filepath'], timeout, started['container_name'], job_progress(grid, job['job_id']))
+    except BaseException as error:
+        stop_job(grid, job, gpu, started, error)
+        raise
+    if returncode is None:
+        # the container writes straight into the job's folder, so it was stopped as soon as the lease was lost
+        record_container_span(grid, job, gpu, started['start_time'], None, stopped='lease_lost')
+        give_up_job(grid, job)
+        release_job(grid, job)
+        return True
+    return await asyncio.to_thread(end_job, grid, job, gpu, started, returncode)
+
+
+def start_batch(grid:Dict, batch_job:Dict, gpu:str) -> Optional[Dict]:
+    """
+    This function will get a batch of jobs ready to run in one container, claiming each member and writing its input into the batch's input folder.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        batch_job (Dict): A dictionary with the batch's job_id and its members, the jobs in it
+        gpu (str): The GPU the batch runs on
+
+    Returns:
+        started (Dict): A dictionary with the command, container_name, start_time, container_start, the members being run, log_filepath, input_folder and output_folder, or None if there's nothing to run
+    """
+    config = grid['config']
+    # we'll write every query in the batch into one input folder, and run a single container over the folder
+    batch_id = batch_job['job_id']
+    local_input_folder = f"{grid['a3m_tmp_folder']}/batches/{batch_id}"
+    local_batch_output_folder = f"{grid['a3m_tmp_folder']}/batches/{batch_id}_output"
+    reset_folder(local_input_folder)
+    reset_folder(local_batch_output_folder)
+
+    # if this is a retry, or another worker (or node) has got to some of them first, we'll only run the members that aren't done
+    start_time = datetime.datetime.now()
+    members = []
+    for job in batch_job['members']:
+        if not claim_job(grid, job):
+            continue
+        if finished_elsewhere(grid, job):
+            update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'done'}, grid['testing'])
+            release_job(grid, job)
+            continue
+        if update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'running', 'start_time': start_time.isoformat(), 'gpu': gpu, 'batch_id': batch_id}, grid['testing'], unless_status=['done']):
+            members.append(job)
+        else:
+            release_job(grid, job)
+    if len(members) == 0:
+        return None
+
+    try:
+        for job in members:
+            write_job_a3m(grid, job, f"{local_input_folder}/{job['jobname']}.a3m")
+    except BaseException:
+        for job in members:
+            release_job(grid, job)
+        raise
+
+    container_name = f"viridien_batch_{batch_id}"
+    docker_input_folder = f"/work/{config['OUTPUT_FOLDER']}/tmp/batches/{batch_id}"
+    colabfold_command = build_colabfold_command(config, docker_input_folder, f"{docker_input_folder}_output", gpu=gpu, container_name=container_name, interactive=False, colabfold_options=grid['colabfold_options'])
+
+    if grid['testing']:
+        grid['console'].print(colabfold_command)
+        return None
+    return {'command': colabfold_command, 'container_name': container_name, 'start_time': start_time, 'container_start': datetime.datetime.now(), 'members': members, 'log_filepath': f"{grid['a3m_tmp_folder']}/batches/logs/{batch_id}", 'input_folder': local_input_folder, 'output_folder': local_batch_output_folder}
+
+
+def end_batch(grid:Dict, batch_job:Dict, gpu:str, started:Dict, returncode:int) -> bool:
+    """
+    This function will split a batch's outputs into the folder of each member, then finish each member whose predictions were written or hand it to the relax pool.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        batch_job (Dict): The batch dictionary
+        gpu (str): The GPU the batch ran on
+        started (Dict): The dictionary returned by start_batch
+        returncode (int): The exit code of the container, or None if it was stopped because every member's lease was lost
+
+    Returns:
+        succeeded (bool): True if every member finished (or went to the relax pool)
+    """
+    batch_id = batch_job['job_id']
+    members = started['members']
+    start_time = started['start_time']
+    container_start = started['container_start']
+    container_seconds = (datetime.datetime.now() - container_start).total_seconds()
+
+    # the members handed to the relax workers keep their leases until they're relaxed
+    handed_to_relax = set()
+    try:
+        # the outputs of a member another node has taken over are left in the batch folder, so they don't overwrite the other node's
+        held_members = []
+        for job in members:
+            if holds_job(grid, job):
+                held_members.append(job)
+            else:
+                give_up_job(grid, job)
+
+        # even if the container failed part of the way through, the queries it finished are kept
+        moved_files = split_batch_outputs(started['output_folder'], {job['jobname']: job['local_output_folder'] for job in held_members})
+        all_done = True
+        for position, job in enumerate(held_members):
+            # the container time is shared between the members, and only the first query waits for the container to launch
+            record_span(grid['journal_filepath'], job['experiment_number'], job['pdb_code'], 'container', container_seconds / len(members), start_time=container_start, attributes=span_attributes(grid, job, gpu=gpu, returncode=returncode, batch_id=batch_id, batch_size=len(members)), journal_mode=grid['journal_mode'])
+            if f"{job['jobname']}.done.txt" in moved_files[job['jobname']]:
+                record_job_timings(grid, job, container_start if position == 0 else None, gpu=gpu, batch_id=batch_id, batch_size=len(members))
+                relaxing, finished = hand_over_job(grid, job, start_time, {'batch_size': len(members)})
+                if relaxing:
+                    handed_to_relax.add(job['job_id'])
+                all_done = all_done and finished
+            else:
+                update_experiment_log(grid['experiments'][job['experiment_number']], job['pdb_code'], {'status': 'failed', 'returncode': returncode}, grid['testing'])
+                all_done = False
+
+        # the batch folders hold a copy of every query a3m, so we'll tidy them up once everything has been split out
+        if all_done:
+            shutil.rmtree(started['input_folder'])
+            shutil.rmtree(started['output_folder'])
+        return all_done
+    finally:
+        for job in members:
+            if job['job_id'] not in handed_to_relax:
+                release_job(grid, job)
+
+
+def stop_batch(grid:Dict, started:Dict, gpu:str, error:BaseException) -> None:
+    # the finished queries are still split out of a stopped batch, as colabfold wrote them before it was stopped, apart from those of members another node has taken over
+    held_members = [job for job in started['members'] if holds_job(grid, job)]
+    split_batch_outputs(started['output_folder'], {job['jobname']: job['local_output_folder'] for job in held_members})
+    for job in started['members']:
+        if job not in held_members:
+            give_up_job(grid, job)
+            release_job(grid, job)
+        elif os.path.exists(f"{job['local_output_folder']}/{job['jobname']}.done.txt") and finish_job(grid, job, started['start_time'], {'batch_size': len(started['members'])}):
+            release_job(grid, job)
+        else:
+            stop_job(grid, job, gpu, started, error)
+
+
+async def run_batch(grid:Dict, batch_job:Dict, gpu:str, timeout:Optional[float]) -> bool:
+    """
+    This function will run a batch of jobs through a single container on a GPU, the job scheduler calls it with the grid bound.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        batch_job (Dict): A dictionary with the batch's job_id and its members
+        gpu (str): The GPU to run on
+        timeout (float): The wall clock timeout in seconds, or None for no timeout
+
+    Returns:
+        succeeded (bool): True if every member finished, or there was nothing for this node to run
+    """
+    started = await asyncio.to_thread(start_batch, grid, batch_job, gpu)
+    if started is None:
+        return True
+    try:
+        # the batch writes into a folder of its own, so it's only stopped once every member has been taken over, and end_batch leaves those members' outputs alone
+        returncode = await run_leased_command(grid, started['members'], started['command'], started['log_filepath'], timeout, started['container_name'], job_progress(grid, batch_job['job_id']))
+    except BaseException as error:
+        stop_batch(grid, started, gpu, error)
+        raise
+    return await asyncio.to_thread(end_batch, grid, batch_job, gpu, started, returncode)
+
+
+def other_journal_filepaths(grid:Dict) -> Optional[List[str]]:
+    # across several nodes each experiment's log.json includes the jobs the other nodes have finished
+    if grid['journal_mode'] != SHARED_JOURNAL_MODE:
+        return None
+    return journal_filepaths(grid['config'])
+
+
+def report_status(grid:Dict, status:Dict) -> None:
+    console = grid['console']
+    if status['status'] == 'done' and is_claimed_elsewhere(grid['claims'], status['job_id']):
+        console.print(f"[bold yellow]{status['job_id']} is running on another node[/bold yellow]")
+    elif status['status'] in ['done', 'failed', 'timeout', 'cancelled']:
+        colour = 'green' if status['status'] == 'done' else 'red'
+        console.print(f"[bold {colour}]{status['job_id']} {status['status']} on GPU {status['gpu']} after {status['attempts']} attempt(s)[/bold {colour}]")
+    elif status['status'] == 'queued' and status['error']:
+        console.print(f"[bold yellow]{status['job_id']} {status['error']} on GPU {status['gpu']}, retrying in {status['retry_in']:.0f}s[/bold yellow]")
+
+
+def schedule_jobs(grid:Dict, jobs:List[Dict], gpus:List[str], batch_size:int, max_retries:int, timeout:Optional[float], retry_backoff:float) -> Dict[str, Dict]:
+    """
+    This function will run jobs across the GPUs, singly or grouped into batches of the same length.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        jobs (List[Dict]): The jobs returned by prepare_jobs
+        gpus (List[str]): The GPUs to run on, one worker is started per entry
+        batch_size (int): The maximum number of structures of the same length run by a single colabfold_batch container
+        max_retries (int): The number of times a failed job is retried
+        timeout (float): The wall clock timeout in seconds for each job, or None for no timeout
+        retry_backoff (float): The number of seconds before a failed job is retried, doubling for each retry after
+
+    Returns:
+        job_status (Dict[str, Dict]): The final status of each job (or batch of jobs), keyed by job_id
+    """
+    on_status = functools.partial(report_status, grid)
+    if batch_size > 1:
+        # we'll group the jobs into batches of the same length, each batch becomes a single job on the queue
+        batch_jobs = [{'job_id': create_batch_id(batch), 'members': batch} for batch in bucket_jobs_by_length(jobs, batch_size)]
+        return run_jobs(batch_jobs, gpus, functools.partial(run_batch, grid), max_retries=max_retries, timeout=timeout, backoff=retry_backoff, on_status=on_status)
+    return run_jobs(jobs, gpus, functools.partial(run_job, grid), max_retries=max_retries, timeout=timeout, backoff=retry_backoff, on_status=on_status)
+
+
+def wait_for_other_nodes(grid:Dict, jobs:List[Dict], job_status:Dict[str, Dict], gpus:List[str], max_retries:int, timeout:Optional[float], retry_backoff:float) -> None:
+    """
+    This function will check the jobs other nodes held when we got to them again, until they're finished or we can claim them ourselves.
+
+    Each node only has its own journal, so a job is finished once its folder has a completion manifest. A job whose lease has expired, or been let go without the job being finished, is claimed and run here.
+
+    Args:
+        grid (Dict): The run state returned by create_grid_run
+        jobs (List[Dict]): The jobs returned by prepare_jobs
+        job_status (Dict[str, Dict]): The job status returned by schedule_jobs, updated with the outcome of the jobs other nodes ran
+        gpus (List[str]): The GPUs to run the jobs we take over on
+        max_retries (int): The number of times a failed job is retried
+        timeout (float): The wall clock timeout in seconds for each job, or None for no timeout
+        retry_backoff (float): The number of seconds before a failed job is retried, doubling for each retry after
+    """
+    claims = grid['claims']
+    while claims is not None:
+        waiting_ids = take_claimed_elsewhere(claims)
+        if len(waiting_ids) == 0:
+            break
+        waiting = []
+        for job in jobs:
+            if job['job_id'] not in waiting_ids:
+                continue
+            if finished_elsewhere(grid, job):
+                job_status[job['job_id']] = {'job_id': job['job_id'], 'status': 'done', 'attempts': 0, 'gpu': None, 'error': None}
+            else:
+                waiting.append(job)
+        if len(waiting) == 0:
+            break
+        grid['console'].print(f"Waiting for {len(waiting)} predictions running on other nodes")
+        time.sleep(min(claims['ttl'] / 4, 15))
+        # run_job claims each job whose lease is free, and leaves the rest to be checked again
+        job_status.update(run_jobs(waiting, gpus, functools.partial(run_job, grid), max_retries=max_retries, timeout=timeout, backoff=retry_backoff, on_status=functools.partial(report_status, grid)))
+
+
+def run_experiment_grid(config:Dict, experiment_numbers:List[str], structures_to_predict:List[Dict], allele_sequences:Dict, b2m_seq:str, gpus:List[str], max_retries:int, timeout:Optional[float], testing:bool, console:Console, batch_size:int=1, share_a3m:bool=False, use_cache:bool=True, relax_workers:int=0, relax_top_k:int=5, relax_backend:str='auto', shard:Optional[Tuple[int, int]]=None, lease_ttl:Optional[float]=None, retry_backoff:float=10.0, on_progress:Optional[Callable[[str, Dict], None]]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> Dict[str, Dict]:
+    """
+    This function will run the predictions for every (experiment, structure) pair, spreading the jobs across the GPUs provided.
+
+    It sets up the run with create_grid_run and prepare_jobs, runs the jobs with schedule_jobs and waits for the jobs other nodes hold with wait_for_other_nodes.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        experiment_numbers (List[str]): The experiment numbers to run
+        structures_to_predict (List[Dict]): The structures to predict for each experiment
+        allele_sequences (Dict): A dictionary with the allele as the key and the sequence as the value
+        b2m_seq (str): The canonical sequence of the B2M gene
+        gpus (List[str]): The GPUs to run on, one worker is started per entry
+        max_retries (int): The number of times a failed job is retried
+        timeout (float): The wall clock timeout in seconds for each job, or None for no timeout
+        testing (bool): Whether we are in testing mode or not, in testing mode the commands are printed rather than run
+        console (Console): The rich console to print to
+        batch_size (int): The maximum number of structures of the same length run by a single colabfold_batch container
+        share_a3m (bool): Whether to hard link identical per structure a3m files from a content addressed store rather than writing a copy for each
+        use_cache (bool): Whether to resolve jobs from (and add finished jobs to) the prediction cache
+        relax_workers (int): The number of CPU processes relaxing models, if more than 0 the GPU containers only run inference and relaxation is pipelined behind them, if 0 colabfold relaxes in the GPU container as set in the COLABFOLD_OPTIONS
+        relax_top_k (int): The number of top ranked models relaxed by the relax workers
+        relax_backend (str): How the relax workers relax each model, 'local' (colabfold and OpenMM installed here), 'container' (a CPU only container per model) or 'auto' to use local if it's installed
+        shard (Tuple[int, int]): The shard of this node and the number of shards returned by parse_shard, only the jobs in this node's shard are run, or None to run every job
+        lease_ttl (float): If set, each job is claimed through a lease file under outputs/experiments/<n>/leases before it runs, so several nodes can work through the same jobs, and a lease without a heartbeat for this many seconds is taken over
+        retry_backoff (float): The number of seconds before a failed job is retried, doubling for each retry after
+        on_progress (Callable): An optional function called with the job_id and each progress update (recycle, pLDDT) parsed from the container output
+        journal_mode (str): The SQLite journal mode of the journal, SHARED_JOURNAL_MODE when several nodes share the project folder, in which case each node keeps a journal of its own and the jobs aren't added to the results database as they finish
+
+    Returns:
+        job_status (Dict[str, Dict]): The final status of each job (or batch of jobs), keyed by job_id
+    """
+    grid = create_grid_run(config, b2m_seq, testing, console, share_a3m=share_a3m, use_cache=use_cache, relax_workers=relax_workers, relax_top_k=relax_top_k, relax_backend=relax_backend, lease_ttl=lease_ttl, on_progress=on_progress, journal_mode=journal_mode)
+    jobs, relax_only_jobs = prepare_jobs(grid, experiment_numbers, structures_to_predict, allele_sequences)
+
+    if shard is not None:
+        # the split only depends on the job ids, so every node works out the same shards without talking to the others
+        jobs = [job for job in jobs if in_shard(job['job_id'], *shard)]
+        relax_only_jobs = [job for job in relax_only_jobs if in_shard(job['job_id'], *shard)]
+        console.print(f"Running the {len(jobs) + len(relax_only_jobs)} predictions in shard {shard[0]} of {shard[1]}")
+
+    if grid['pipelined_relax'] and not testing:
+        start_relax_completions(grid)
+
+    if len(jobs) > 0:
+        console.print(f"Scheduling {len(jobs)} predictions across GPU(s) {', '.join(gpus)}")
+
+    # the heartbeat keeps the leases of this node's running (and relaxing) jobs from expiring
+    stop_heartbeat = start_claims_heartbeat(grid['claims'])
+
+    cancelled = False
+    try:
+        for job in relax_only_jobs:
+            if not claim_job(grid, job):
+                continue
+            console.print(f"[bold yellow]Relaxing the remaining models for {job['pdb_code']} in experiment {job['experiment_number']}[/bold yellow]")
+            relax_job(grid, job, datetime.datetime.now(), {})
+
+        job_status = schedule_jobs(grid, jobs, gpus, batch_size, max_retries, timeout, retry_backoff)
+        wait_for_other_nodes(grid, jobs, job_status, gpus, max_retries, timeout, retry_backoff)
+    except KeyboardInterrupt:
+        # the running containers have been stopped and their jobs marked as cancelled, so a rerun picks them up again
+        cancelled = True
+        console.print("[bold red]Cancelled, the running predictions have been stopped[/bold red]")
+        export_experiment_logs(grid['experiments'], testing, other_journal_filepaths(grid))
+        raise
+    finally:
+        stop_relax_completions(grid, cancelled)
+        if stop_heartbeat is not None:
+            stop_heartbeat.set()
+    job_status.update(grid['relax_failures'])
+
+    # we'll write each experiment's log.json once, now that the journal is up to date
+    export_experiment_logs(grid['experiments'], testing, other_journal_filepaths(grid))
+
+    # finally we'll keep the prediction cache within its size limit, dropping the least recently used entries
+    if use_cache and not testing:
+        evicted = evict_predictions(grid['prediction_cache_folder'], int(config.get('PREDICTION_CACHE_MAX_GB', 100) * 1024 ** 3))
+        if evicted:
+            console.print(f"Evicted {len(evicted)} predictions from the cache")
+    return job_status
+
+
 
 @click.command()
 @click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
 @click.option("--structure_set", default='full', help="The structure set to use for the predictions, can either be full, partial or single.")
-@click.option("--experiment_number", default=None, help="The experiment number to use for the predictions.")
-@click.option("--gpu_number", default='all', help="The GPU number to use for the predictions.")
+@click.option("--experiment_number", default=None, help="The experiment number to use for the predictions, several experiments can be given separated by commas e.g. 31,32,33.")
+@click.option("--gpu_number", default='all', help="The GPU(s) to use for the predictions, can either be all, auto (one worker per detected GPU), a single number or a comma separated list e.g. 0,1,2,3.")
+@click.option("--max_retries", default=1, help="The number of times a failed prediction will be retried.")
+@click.option("--timeout", default=None, type=float, help="The wall clock timeout in seconds for each prediction.")
+@click.option("--batch_size", default=1, help="The maximum number of structures of the same length to run in a single colabfold_batch container.")
+@click.option("--share_a3m", is_flag=True, default=False, help="Hard link identical per structure a3m files from a content addressed store in outputs/tmp/a3m_store.")
+@click.option("--no_cache", is_flag=True, default=False, help="Don't resolve predictions from, or add them to, the prediction cache in outputs/cache/predictions.")
+@click.option("--relax_workers", default=0, help="The number of CPU processes relaxing models, if more than 0 the GPU containers only run inference and the relaxation runs alongside them.")
+@click.option("--relax_top_k", default=5, help="The number of top ranked models to relax when using --relax_workers.")
+@click.option("--relax_backend", default='auto', type=click.Choice(['auto', 'local', 'container']), help="How to relax with --relax_workers, local (colabfold and OpenMM installed here), container (a CPU only container per model) or auto.")
+@click.option("--shard", default=None, help="Only run this node's share of the predictions, given as i/N e.g. 2/4 for the second of four nodes.")
+@click.option("--distributed", is_flag=True, default=False, help="Claim each prediction through a lease file before running it, so several nodes sharing the project folder can work through the same experiments.")
+@click.option("--lease_ttl", default=300.0, help="The number of seconds without a heartbeat after which another node takes over a prediction's lease when using --distributed.")
+@click.option("--retry_backoff", default=10.0, help="The number of seconds before a failed prediction is retried, doubling for each retry after.")
+@click.option("--backend", default=None, type=click.Choice(['docker', 'stub']), help="Run colabfold_batch in docker, or the stub colabfold_batch which writes the same outputs without a GPU, overriding COLABFOLD_BACKEND in the config.")
 @click.option("--testing", default=None, help="Whether we are in testing mode or not.")
 
-def run_predictions(environment, structure_set, experiment_number, gpu_number, testing):
+def run_predictions(environment, structure_set, experiment_number, gpu_number, max_retries, timeout, batch_size, share_a3m, no_cache, relax_workers, relax_top_k, relax_backend, shard, distributed, lease_ttl, retry_backoff, backend, testing):
 
     # First we'll load the configuration file for the chosen environment
     config = load_config(environment)
+    if config is not None and backend is not None:
+        config['COLABFOLD_BACKEND'] = backend
     print (config)
 
     console = Console()
 
-    # We'll set the experiment a3m to None for now
-    experiment_a3m = None
-
     # We'll check the input parameter for whether we're in testing mode or not
     if testing is not None:
         testing = True
@@ -76,128 +1068,74 @@ def run_predictions(environment, structure_set, experiment_number, gpu_number, t
         print ("No experiment number provided, please provide an experiment number and try again.")
         exit()
 
-    # We'll set the a3m filepath for the experiment, and if that experiment a3m file doesn't exist we'll exit
-    experiment_a3m_filepath = f"inputs/experiments/experiment{experiment_number}.a3m"
-    if not os.path.exists(experiment_a3m_filepath):
-        print (f"Experiment a3m file does not exist at {experiment_a3m_filepath}")
-        exit()
+    # We'll set the a3m filepath for each experiment, and if that experiment a3m file doesn't exist we'll exit
+    experiment_numbers = [number.strip() for number in experiment_number.split(',') if number.strip()]
+    for number in experiment_numbers if config is not None else []:
+        experiment_a3m_filepath = make_filepath(config, 'input', 'experiments', f"experiment{number}.a3m")
+        if not os.path.exists(experiment_a3m_filepath):
+            print (f"Experiment a3m file does not exist at {experiment_a3m_filepath}")
+            exit()
+
+    # We'll check the shard is something like 2/4
+    if shard is not None:
+        try:
+            shard = parse_shard(shard)
+        except ValueError as error:
+            print (error)
+            exit()
 
+    # when several nodes share the project folder each keeps a journal of its own without WAL, every node should be run with the same options
+    journal_mode = SHARED_JOURNAL_MODE if shard is not None or distributed else LOCAL_JOURNAL_MODE
+
+    # We'll work out which GPUs to spread the predictions across
+    gpus = parse_gpu_numbers(gpu_number, config)
 
     # We'll print out the CLI options selected
     print ('CLI options selected:')
     print (f'Environment: {environment}')
     print (f'Structure set: {structure_set}')
-    print (f'Experiment number: {experiment_number}')
-    print (f'GPU number: {gpu_number}')
+    print (f'Experiment number(s): {", ".join(experiment_numbers)}')
+    print (f'GPU(s): {", ".join(gpus)}')
+    print (f'Max retries: {max_retries}')
+    print (f'Timeout: {timeout}')
+    print (f'Batch size: {batch_size}')
+    print (f'Relax workers: {relax_workers}')
+    print (f'Shard: {"all" if shard is None else f"{shard[0]}/{shard[1]}"}')
+    print (f'Distributed: {distributed}')
     print (f'Testing: {testing}')
 
 
-    # We'll create the output folder structure if it doesn't exist
-    a3m_tmp_filepath = 'outputs/tmp'
-    if not os.path.exists(a3m_tmp_filepath):
-        os.makedirs(a3m_tmp_filepath)
+    if config is not None:
+        # We'll create the output folder structure if it doesn't exist
+        experiments_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}/experiments"
+        if not os.path.exists(experiments_folder):
+            os.makedirs(experiments_folder)
 
-    experiments_folder = 'outputs/experiments'
-    if not os.path.exists(experiments_folder):
-        os.makedirs(experiments_folder)
+        # finally for the set up we'll load the prediction data
+        structures_to_predict, allele_sequences, b2m_seq = load_prediction_data(config, structure_set)
 
-    experiment_folder = f"outputs/experiments/{experiment_number}"
-    if not os.path.exists(experiment_folder):
-        os.makedirs(experiment_folder)
+    if config is not None and len(structures_to_predict) > 0:
 
+        with console.status("Running predictions...", spinner="dots") as status:
+            # the spinner shows the latest recycle of each running prediction, the full output is in each job's log files
+            progress = {}
 
-    # if the log file exists we'll load it, otherwise we'll create an empty dictionary
-    experiment_log_filepath = f"{experiment_folder}/log.json"
-    if os.path.exists(experiment_log_filepath):
-        with open(experiment_log_filepath, 'r') as f:
-            experiment_log = json.load(f)
-    else:
-        experiment_log = {}
-        # and then we'll write the empty dictionary to the log file
-        write_log_file(experiment_log, experiment_log_filepath, testing)
+            def on_progress(job_id:str, update:Dict) -> None:
+                if update['event'] == 'recycle':
+                    model = update['model'].split('_model_')[-1].split('_')[0]
+                    # the most recently updated predictions are moved to the end
+                    progress.pop(job_id, None)
+                    progress[job_id] = f"{job_id} model {model} recycle {update['recycle']} pLDDT {update['plddt']:.1f}"
+                    status.update(f"Running predictions... {' | '.join(list(progress.values())[-3:])}")
 
-    # finally for the set up we'll load the prediction data
-    structures_to_predict, allele_sequences, b2m_seq = load_prediction_data(config, structure_set)
+            job_status = run_experiment_grid(config, experiment_numbers, structures_to_predict, allele_sequences, b2m_seq, gpus, max_retries, timeout, testing, console, batch_size=batch_size, share_a3m=share_a3m, use_cache=not no_cache, relax_workers=relax_workers, relax_top_k=relax_top_k, relax_backend=relax_backend, shard=shard, lease_ttl=lease_ttl if distributed else None, retry_backoff=retry_backoff, on_progress=on_progress, journal_mode=journal_mode)
 
-    if config is not None and len(structures_to_predict) > 0:
+        failed = [job_id for job_id, status in job_status.items() if status['status'] != 'done']
+        if failed:
+            console.print(f"[bold red]{len(failed)} predictions did not complete: {', '.join(failed)}[/bold red]")
+        if journal_mode == SHARED_JOURNAL_MODE and not testing:
+            console.print("Once every node has finished, add the predictions to the results database with 'python steps/results_db.py index'")
 
-        with console.status("Running predictions...", spinner="dots"):
-            
-            # now we'll iterate over the list of predictions and run the predictions
-            for structure in structures_to_predict:
-
-                # we'll load the experiment a3m file, we do this for each prediction as we need to create one per prediction with the concatenated sequence as the first sequence in the alignment
-                with open(experiment_a3m_filepath, 'r') as f:
-                    experiment_a3m = f.read()
-
-                # first we'll generate a a3m file for the prediction if it doesn't exist
-                pdb_code = structure['pdb_code']
-                
-                # we'll check if the predictions have already been run for this PDB code
-                if pdb_code in experiment_log:
-                    if experiment_log[pdb_code]['status'] == 'done':
-                        console.print(f"[bold green]Predictions already exist for {pdb_code}[/bold green]")
-                        continue
-                else:
-                    experiment_log[pdb_code] = {'status': 'preparing'}
-                    write_log_file(experiment_log, experiment_log_filepath, testing)
-
-                # we'll create the local and in container filepath for the a3m file
-                local_a3m_filepath = f"{a3m_tmp_filepath}/{pdb_code}_{experiment_number}.a3m"
-                docker_a3m_filepath = f"/work/{config['OUTPUT_FOLDER']}/tmp/{pdb_code}_{experiment_number}.a3m"
-
-                # we'll create the a3m file if it doesn't exist
-                if not os.path.exists(local_a3m_filepath):
-                    with open(local_a3m_filepath, 'w') as f:
-                        combined_sequence = create_combined_sequence(allele_sequences, structure, b2m_seq, 274)
-                        prediction_string = f">101\t102\t103\n{combined_sequence}"
-                        this_a3m = experiment_a3m.replace('###', prediction_string)
-
-                        f.write(this_a3m)
-                
-                # we'll create the in container filepath for the output folder and the local output folder
-                item_path = f"{config['OUTPUT_FOLDER']}/experiments/{experiment_number}/{pdb_code}"
-                local_output_folder = f"{config['PROJECT_FOLDER']}/{item_path}"
-                docker_output_folder = f"/work/{item_path}"
-
-                # we'll set the predictions_exist flag to False
-                predictions_exist = False
-
-                # we'll check if the predictions have already been run for this PDB code
-                if os.path.exists(local_output_folder):
-                    # each colabfold run will generate 26 files, so if we have 26 files we can assume the predictions are done for that PDB code
-                    if len(os.listdir(local_output_folder)) == 26:
-                        predictions_exist = True
-                else:
-                    os.makedirs(local_output_folder)
-
-                # if the predictions don't exist we'll run them
-                if not predictions_exist:
-                    experiment_log[pdb_code]['status'] = 'running'
-                    start_time = datetime.datetime.now()
-                    experiment_log[pdb_code]['start_time'] = start_time.isoformat()
-                    write_log_file(experiment_log, experiment_log_filepath, testing)
-
-                    if gpu_number == 'all':
-                        gpu_field = "--gpus=all"
-                    else:
-                        gpu_field = f"--gpus=\"device={gpu_number}\""
-                    colabfold_command = f"docker run --user $(id -u) -ti --rm {gpu_field} -v {config['AF_WEIGHTS_FOLDER']}:/cache:rw -v $(pwd):/work:rw {config['CONTAINER_IMAGE']} colabfold_batch {config['COLABFOLD_OPTIONS']} {docker_a3m_filepath} {docker_output_folder}"
-                    
-                    if testing:
-                        console.print(colabfold_command)
-                    else:
-                        os.system(colabfold_command)
-
-                        experiment_log[pdb_code]['status'] = 'done'
-                        end_time = datetime.datetime.now()
-                        experiment_log[pdb_code]['end_time'] = end_time.isoformat()
-                        experiment_log[pdb_code]['elapsed_time'] = (end_time - start_time).total_seconds()
-                        write_log_file(experiment_log, experiment_log_filepath, testing)
-
-                else:
-                    console.print(f"[bold green]Predictions already exist for {pdb_code}[/bold green]")
-                    
     else:
         console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
     pass
@@ -207,4 +1145,3 @@ def run_predictions(environment, structure_set, experiment_number, gpu_number, t
 
 if __name__ == "__main__":
     run_predictions()
-
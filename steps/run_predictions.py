@@ -1,12 +1,17 @@
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import json
 import os
+import shutil
 import datetime
 import click
 from rich.console import Console
 
-from functions import load_config, load_prediction_list, load_allele_sequences, load_b2m_sequence, make_filepath, create_tmp_fasta_file
+from functions import load_config, load_prediction_list, load_allele_sequences, load_b2m_sequence, make_filepath, create_tmp_fasta_file, build_colabfold_command, deslugify_allele_slug, colabfold_jobname
+from batching import bucket_jobs_by_length, create_batch_id, reset_folder, split_batch_outputs
+from prediction_cache import compute_prediction_key, lookup_cached_prediction, store_prediction, evict_predictions
+from manifest import load_completion_index, is_prediction_complete, record_completed_prediction
+from async_executor import run_command_async, run_jobs
 
 
 
@@ -15,8 +20,16 @@ from functions import load_config, load_prediction_list, load_allele_sequences,
 
 @click.command()
 @click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
-def run_predictions(environment):
+@click.option("--batch_size", default=1, help="The maximum number of structures of the same length to run in a single colabfold_batch container.")
+@click.option("--no_cache", is_flag=True, default=False, help="Don't resolve predictions from, or add them to, the prediction cache in outputs/cache/predictions.")
+@click.option("--backend", default=None, type=click.Choice(['docker', 'stub']), help="Run colabfold_batch in docker, or the stub colabfold_batch which writes the same outputs without a GPU, overriding COLABFOLD_BACKEND in the config.")
+@click.option("--timeout", default=None, type=float, help="The wall clock timeout in seconds for each prediction (or batch).")
+@click.option("--max_retries", default=0, help="The number of times a failed prediction (or batch) will be retried.")
+@click.option("--retry_backoff", default=10.0, help="The number of seconds before a failed prediction is retried, doubling for each retry after.")
+def run_predictions(environment, batch_size, no_cache, backend, timeout, max_retries, retry_backoff):
     config = load_config(environment)
+    if config is not None and backend is not None:
+        config['COLABFOLD_BACKEND'] = backend
 
     console = Console()
     if config is not None:
@@ -30,6 +43,13 @@ def run_predictions(environment):
         if not os.path.exists(predictions_path):
             os.makedirs(predictions_path)
 
+        # predictions are cached on their inputs rather than the date, so a rerun on a new day links to the earlier results
+        prediction_cache_folder = make_filepath(config, 'output', 'cache', 'predictions')
+
+        # we'll load the index of finished prediction folders once, rather than looking in every folder
+        completion_index_filepath = make_filepath(config, 'output', 'predictions', 'completion_index.jsonl')
+        completed = load_completion_index(completion_index_filepath)
+
 
         with console.status("Running predictions...", spinner="dots"):
             # first we'll load the list of predictions to run from the CSV file
@@ -41,6 +61,13 @@ def run_predictions(environment):
             # next we'll load the canonical sequence of the B2M gene
             b2m_seq = load_b2m_sequence(config)
 
+            # the jobs we'll run in batches if batch_size is more than one, otherwise one at a time
+            batch_jobs = []
+            single_jobs = []
+
+            # each container's output goes to its own log files rather than the console
+            logs_folder = make_filepath(config, 'output', 'logs', timestamp)
+
             # now we'll iterate over the list of predictions and run the predictions
             for structure in structures_to_predict:
 
@@ -58,17 +85,88 @@ def run_predictions(environment):
                 item_path = f"{config['OUTPUT_FOLDER']}/predictions/{timestamp}/{pdb_code}"
                 local_output_folder = f"{config['PROJECT_FOLDER']}/{item_path}"
                 docker_output_folder = f"/work/{item_path}"
-                predictions_exist = False
 
-                if os.path.exists(local_output_folder):
-                    # each colabfold run will generate 26 files, so if we have 26 files we can assume the predictions are done for that PDB code
-                    if len(os.listdir(local_output_folder)) == 26:
-                        predictions_exist = True
+                # in a batch colabfold names the outputs after the input file, otherwise after the FASTA header
+                if batch_size > 1:
+                    jobname = pdb_code
+                else:
+                    jobname = colabfold_jobname(f"{pdb_code} | {deslugify_allele_slug(structure['allele_slug'])}:{structure['peptide_sequence']}")
 
-                # if the predictions don't exist we'll run them
+                predictions_exist = is_prediction_complete(local_output_folder, item_path, jobname, completed, completion_index_filepath)
+
+                # the MSA comes from the colabfold server, so the key only needs the sequence, options and container
+                prediction_sequence = f"{allele_sequences[structure['allele_slug']].replace('-','')}:{b2m_seq}:{structure['peptide_sequence']}"
+                cache_key = compute_prediction_key(prediction_sequence, 'colabfold_msa_server', config['COLABFOLD_OPTIONS'], config['CONTAINER_IMAGE'])
+                if not predictions_exist and not no_cache:
+                    predictions_exist = lookup_cached_prediction(prediction_cache_folder, cache_key, local_output_folder, jobname)
+                    if predictions_exist:
+                        record_completed_prediction(completion_index_filepath, local_output_folder, item_path, jobname)
+
+                # if the predictions don't exist we'll queue them, either on their own or as part of a batch
                 if not predictions_exist:
-                    colabfold_command = f"docker run --user $(id -u) -ti --rm --gpus=all -v {config['AF_WEIGHTS_FOLDER']}:/cache:rw -v $(pwd):/work:rw {config['CONTAINER_IMAGE']} colabfold_batch {config['COLABFOLD_OPTIONS']} {docker_fasta_file} {docker_output_folder}"
-                    os.system(colabfold_command)
+                    if batch_size > 1:
+                        sequence_length = len(prediction_sequence.replace(':',''))
+                        batch_jobs.append({'job_id': pdb_code, 'jobname': jobname, 'sequence_length': sequence_length, 'fasta_file': tmp_fasta_file, 'local_output_folder': local_output_folder, 'index_key': item_path, 'cache_key': cache_key})
+                    else:
+                        container_name = f"viridien_{pdb_code}"
+                        colabfold_command = build_colabfold_command(config, docker_fasta_file, docker_output_folder, container_name=container_name, interactive=False)
+                        single_jobs.append({'job_id': pdb_code, 'command': colabfold_command, 'container_name': container_name, 'log_filepath': f"{logs_folder}/{pdb_code}", 'members': [{'job_id': pdb_code, 'jobname': jobname, 'local_output_folder': local_output_folder, 'index_key': item_path, 'cache_key': cache_key}]})
+
+            # for batches we'll group the structures by total length, so that the compiled model is reused within a batch
+            for batch in bucket_jobs_by_length(batch_jobs, batch_size):
+                batch_id = create_batch_id(batch)
+                batch_path = f"{config['OUTPUT_FOLDER']}/tmp/batches/{batch_id}"
+                local_input_folder = f"{config['PROJECT_FOLDER']}/{batch_path}"
+                reset_folder(local_input_folder)
+
+                # in a folder of inputs colabfold uses the file name as the jobname, so the outputs are prefixed with the pdb_code
+                for job in batch:
+                    shutil.copyfile(job['fasta_file'], f"{local_input_folder}/{job['jobname']}.fasta")
+
+                container_name = f"viridien_batch_{batch_id}"
+                colabfold_command = build_colabfold_command(config, f"/work/{batch_path}", f"/work/{batch_path}_output", container_name=container_name, interactive=False)
+                single_jobs.append({'job_id': batch_id, 'command': colabfold_command, 'container_name': container_name, 'log_filepath': f"{logs_folder}/batch_{batch_id}", 'members': batch, 'input_folder': local_input_folder, 'output_folder': f"{local_input_folder}_output"})
+
+            def record_prediction(member:Dict) -> bool:
+                # colabfold writes '<jobname>.done.txt' last, so we'll only record the prediction as complete if it's there
+                if not os.path.exists(f"{member['local_output_folder']}/{member['jobname']}.done.txt"):
+                    return False
+                record_completed_prediction(completion_index_filepath, member['local_output_folder'], member['index_key'], member['jobname'])
+                if not no_cache:
+                    store_prediction(prediction_cache_folder, member['cache_key'], member['local_output_folder'], member['jobname'], {'pdb_code': member['job_id']})
+                return True
+
+            def finish_batch(job:Dict) -> bool:
+                # then we'll move each structure's outputs into its own folder
+                split_batch_outputs(job['output_folder'], {member['jobname']: member['local_output_folder'] for member in job['members']})
+                if all([record_prediction(member) for member in job['members']]):
+                    shutil.rmtree(job['input_folder'])
+                    shutil.rmtree(job['output_folder'])
+                    return True
+                console.print(f"[bold red]Some predictions in batch {job['job_id']} did not complete[/bold red]")
+                return False
+
+            async def run_job(job:Dict, gpu:str, timeout:Optional[float]) -> bool:
+                if 'output_folder' in job:
+                    reset_folder(job['output_folder'])
+                returncode = await run_command_async(job['command'], job['log_filepath'], timeout=timeout, container_name=job['container_name'])
+                # even if the container failed part of the way through, the batch queries it finished are kept
+                if 'output_folder' in job:
+                    return finish_batch(job) and returncode == 0
+                return returncode == 0 and record_prediction(job['members'][0])
+
+            def on_status(status:Dict) -> None:
+                if status['status'] in ['failed', 'timeout', 'cancelled']:
+                    console.print(f"[bold red]{status['job_id']} {status['status']} after {status['attempts']} attempt(s), the container output is in {logs_folder}[/bold red]")
+                elif status['status'] == 'queued' and status['error']:
+                    console.print(f"[bold yellow]{status['job_id']} {status['error']}, retrying in {status['retry_in']:.0f}s[/bold yellow]")
+
+            # the containers are run one at a time on every GPU, as before, but without a terminal attached so we get their exit codes
+            run_jobs(single_jobs, ['all'], run_job, max_retries=max_retries, timeout=timeout, backoff=retry_backoff, on_status=on_status)
+
+            # finally we'll keep the prediction cache within its size limit, dropping the least recently used entries
+            if not no_cache:
+                evict_predictions(prediction_cache_folder, int(config.get('PREDICTION_CACHE_MAX_GB', 100) * 1024 ** 3))
                     
     else:
         console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
@@ -79,4 +177,3 @@ def run_predictions(environment):
 
 if __name__ == "__main__":
     run_predictions()
-
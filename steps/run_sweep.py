@@ -0,0 +1,256 @@
+from typing import List, Dict, Optional
+
+import concurrent.futures
+import datetime
+import json
+import math
+import os
+import random
+import click
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from functions import load_config, make_filepath
+from scheduler import parse_gpu_numbers
+from run_msa_predictions import load_prediction_data, run_experiment_grid
+from ingest_results import load_prediction_scores, compute_segment_metrics
+from evaluate_structures import find_crystal_structure, evaluate_pdb_code
+
+
+# each metric the experiments can be screened on, and whether a higher value is better
+SWEEP_METRICS = {
+    'peptide_plddt': True,
+    'peptide_groove_pae': False,
+    'peptide_rmsd': False
+}
+
+
+def load_sweep_experiments(config:Dict, experiment_log_filename:str) -> Dict[str, Dict]:
+    """
+    This function will load the experiments of an MSA sweep from its experiment log, e.g. netmhcba_experiment_log.json.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        experiment_log_filename (str): The filename of the experiment log in the inputs/experiments folder
+
+    Returns:
+        experiments (Dict[str, Dict]): A dictionary with the experiment number as the key and its settings (e.g. binding_cutoff, hamming_cutoff, allele_cutoff, filename) as the value
+    """
+    with open(make_filepath(config, 'input', 'experiments', experiment_log_filename), 'r') as f:
+        experiments = json.load(f)
+    return {str(experiment_number): settings for experiment_number, settings in experiments.items()}
+
+
+def stratified_order(structures:List[Dict], seed:int) -> List[Dict]:
+    """
+    This function will order the structures so that any prefix of the order is balanced across loci, alleles and peptide lengths.
+
+    The structures are grouped into strata by (locus, allele, peptide length). Each step picks the locus furthest behind its share of the structures, then the stratum of that locus furthest behind its share, so every stratum is represented once before any is repeated. Each round of the sweep takes a longer prefix of the same order, so the structures predicted in earlier rounds are reused.
+
+    Args:
+        structures (List[Dict]): The structures to order, each with a locus, allele_slug and peptide_sequence
+        seed (int): The random seed used to shuffle the structures within each stratum, and to break ties between strata
+
+    Returns:
+        ordered (List[Dict]): The structures in stratified order
+    """
+    generator = random.Random(seed)
+    strata = {}
+    for structure in structures:
+        strata.setdefault((structure['locus'], structure['allele_slug'], len(structure['peptide_sequence'])), []).append(structure)
+    for stratum_key in sorted(strata):
+        generator.shuffle(strata[stratum_key])
+    tie_breaks = {stratum_key: generator.random() for stratum_key in sorted(strata)}
+
+    sizes = {stratum_key: len(stratum) for stratum_key, stratum in strata.items()}
+    taken = {stratum_key: 0 for stratum_key in strata}
+    locus_sizes = {}
+    for stratum_key, size in sizes.items():
+        locus_sizes[stratum_key[0]] = locus_sizes.get(stratum_key[0], 0) + size
+    locus_taken = {locus: 0 for locus in locus_sizes}
+
+    ordered = []
+    while len(ordered) < len(structures):
+        locus = min((locus for locus in locus_sizes if locus_taken[locus] < locus_sizes[locus]), key=lambda locus: (locus_taken[locus] / locus_sizes[locus], locus_taken[locus], locus))
+        stratum_key = min((stratum_key for stratum_key in strata if stratum_key[0] == locus and taken[stratum_key] < sizes[stratum_key]), key=lambda stratum_key: (taken[stratum_key], taken[stratum_key] / sizes[stratum_key], tie_breaks[stratum_key]))
+        ordered.append(strata[stratum_key][taken[stratum_key]])
+        taken[stratum_key] += 1
+        locus_taken[locus] += 1
+    return ordered
+
+
+def score_experiments(config:Dict, experiment_numbers:List[str], structures:List[Dict], metric:str, b2m_length:int, crystal_folder:Optional[str]=None, crystal_chain_map:Optional[Dict[str, str]]=None, workers:Optional[int]=None) -> Dict[str, Dict]:
+    """
+    This function will score each experiment on a set of structures, from the top ranked model of each prediction.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        experiment_numbers (List[str]): The experiments to score
+        structures (List[Dict]): The structures to score them on
+        metric (str): One of the SWEEP_METRICS
+        b2m_length (int): The length of the B2M sequence
+        crystal_folder (str): The folder of crystal structures, needed for the peptide_rmsd metric
+        crystal_chain_map (Dict[str, str]): A mapping from the crystal structure chain ids to the model chain ids, for the peptide_rmsd metric
+        workers (int): The number of worker processes used for the peptide_rmsd metric
+
+    Returns:
+        scores (Dict[str, Dict]): A dictionary with the experiment number as the key and a dictionary of the mean 'score', the number of structures 'scored' and the 'missing' pdb_codes as the value
+    """
+    values = {experiment_number: {} for experiment_number in experiment_numbers}
+    experiments_folder = f"{config['PROJECT_FOLDER']}/{config['OUTPUT_FOLDER']}/experiments"
+    if metric == 'peptide_rmsd':
+        tasks = []
+        for structure in structures:
+            crystal_filepath = find_crystal_structure(crystal_folder, structure['pdb_code'])
+            if crystal_filepath is None:
+                continue
+            predictions = [{'experiment_number': experiment_number, 'folder': f"{experiments_folder}/{experiment_number}/{structure['pdb_code']}", 'jobname': f"{structure['pdb_code']}_{experiment_number}"} for experiment_number in experiment_numbers]
+            tasks.append({'pdb_code': structure['pdb_code'], 'crystal_filepath': crystal_filepath, 'crystal_chain_map': crystal_chain_map, 'cache_folder': make_filepath(config, 'output', 'cache', 'coordinates'), 'predictions': predictions})
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for rows in executor.map(evaluate_pdb_code, tasks):
+                # we'll prefer the relaxed top ranked model, falling back to the unrelaxed one if the models weren't relaxed
+                for row in sorted(rows, key=lambda row: row['kind'] == 'relaxed'):
+                    if row['rank'] == 1:
+                        values[row['experiment_number']][row['pdb_code']] = row['peptide_backbone_rmsd']
+    else:
+        for experiment_number in experiment_numbers:
+            for structure in structures:
+                records = [record for record in load_prediction_scores(f"{experiments_folder}/{experiment_number}/{structure['pdb_code']}", f"{structure['pdb_code']}_{experiment_number}") if record['rank'] == 1]
+                if len(records) == 0:
+                    continue
+                metrics = compute_segment_metrics(records[0]['plddt'][np.newaxis], records[0]['pae'][np.newaxis], b2m_length)
+                values[experiment_number][structure['pdb_code']] = float(metrics[metric][0])
+
+    scores = {}
+    for experiment_number, experiment_values in values.items():
+        finite_values = [value for value in experiment_values.values() if np.isfinite(value)]
+        scores[experiment_number] = {
+            'score': float(np.mean(finite_values)) if finite_values else None,
+            'scored': len(finite_values),
+            'missing': [structure['pdb_code'] for structure in structures if structure['pdb_code'] not in experiment_values]
+        }
+    return scores
+
+
+def select_survivors(scores:Dict[str, Dict], metric:str, keep:int) -> List[str]:
+    """
+    This function will pick the best experiments to carry into the next round, experiments without a score are ranked last.
+
+    Args:
+        scores (Dict[str, Dict]): The scores returned by score_experiments
+        metric (str): One of the SWEEP_METRICS
+        keep (int): The number of experiments to keep
+
+    Returns:
+        survivors (List[str]): The experiment numbers kept, best first
+    """
+    higher_is_better = SWEEP_METRICS[metric]
+    def sort_key(experiment_number:str):
+        score = scores[experiment_number]['score']
+        if score is None:
+            return (1, 0.0)
+        return (0, -score if higher_is_better else score)
+    return sorted(scores, key=sort_key)[:keep]
+
+
+def write_sweep_state(sweep_filepath:str, sweep:Dict) -> None:
+    tmp_filepath = f"{sweep_filepath}.{os.getpid()}.tmp"
+    with open(tmp_filepath, 'w') as f:
+        json.dump(sweep, f, indent=4)
+    os.replace(tmp_filepath, sweep_filepath)
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_log", default='netmhcba_experiment_log.json', help="The experiment log in inputs/experiments defining the experiments in the sweep.")
+@click.option("--metric", default='peptide_plddt', type=click.Choice(list(SWEEP_METRICS)), help="The metric used to rank the experiments each round.")
+@click.option("--initial_structures", default=16, help="The number of structures each experiment is run on in the first round.")
+@click.option("--eta", default=2, help="Each round keeps the best 1/eta of the experiments and runs them on eta times as many structures.")
+@click.option("--seed", default=42, help="The random seed for the stratified structure order.")
+@click.option("--crystal_folder", default=None, help="The folder of crystal structure PDB files for the peptide_rmsd metric, defaults to inputs/crystal_structures.")
+@click.option("--crystal_chains", default='A,B,C', help="The crystal structure chain ids of the heavy chain, B2M and peptide, in that order.")
+@click.option("--gpu_number", default='auto', help="The GPU(s) to use for the predictions, see run_msa_predictions.py.")
+@click.option("--max_retries", default=1, help="The number of times a failed prediction will be retried.")
+@click.option("--timeout", default=None, type=float, help="The wall clock timeout in seconds for each prediction.")
+@click.option("--batch_size", default=1, help="The maximum number of structures of the same length to run in a single colabfold_batch container.")
+@click.option("--testing", default=None, help="Whether we are in testing mode or not.")
+def run_sweep(environment, experiment_log, metric, initial_structures, eta, seed, crystal_folder, crystal_chains, gpu_number, max_retries, timeout, batch_size, testing):
+    config = load_config(environment)
+
+    console = Console()
+    testing = testing is not None
+    if config is None:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+        return
+    if eta < 2:
+        console.print("[bold red]eta must be at least 2[/bold red]")
+        return
+
+    # we'll only sweep the experiments whose a3m file has been built
+    sweep_experiments = load_sweep_experiments(config, experiment_log)
+    missing = [experiment_number for experiment_number in sweep_experiments if not os.path.exists(make_filepath(config, 'input', 'experiments', f"experiment{experiment_number}.a3m"))]
+    if missing:
+        console.print(f"[bold yellow]Skipping {len(missing)} experiments without an a3m file: {', '.join(missing)}[/bold yellow]")
+    survivors = [experiment_number for experiment_number in sweep_experiments if experiment_number not in missing]
+
+    structures, allele_sequences, b2m_seq = load_prediction_data(config, 'full')
+    ordered_structures = stratified_order(structures, seed)
+    gpus = parse_gpu_numbers(gpu_number, config)
+    if crystal_folder is None:
+        crystal_folder = f"{config['PROJECT_FOLDER']}/{config['INPUT_FOLDER']}/crystal_structures"
+    crystal_chain_map = dict(zip(crystal_chains.split(','), ['A', 'B', 'C']))
+
+    sweep_folder = make_filepath(config, 'output', 'sweeps', os.path.splitext(experiment_log)[0])
+    if not os.path.exists(sweep_folder):
+        os.makedirs(sweep_folder)
+    sweep = {'experiment_log': experiment_log, 'metric': metric, 'eta': eta, 'seed': seed, 'started': datetime.datetime.now().isoformat(), 'rounds': []}
+
+    subset_size = min(initial_structures, len(ordered_structures))
+    round_number = 1
+    while True:
+        subset = ordered_structures[:subset_size]
+        console.print(f"[bold]Round {round_number}: {len(survivors)} experiments on {len(subset)} structures[/bold]")
+
+        # the structures from earlier rounds are already done, so only the new part of the subset is predicted
+        job_status = run_experiment_grid(config, survivors, subset, allele_sequences, b2m_seq, gpus, max_retries, timeout, testing, console, batch_size=batch_size)
+        failed = [job_id for job_id, status in job_status.items() if status['status'] != 'done']
+        if failed:
+            console.print(f"[bold red]{len(failed)} predictions did not complete, the experiments are scored on the rest[/bold red]")
+        if testing:
+            break
+
+        scores = score_experiments(config, survivors, subset, metric, len(b2m_seq), crystal_folder, crystal_chain_map)
+        final_round = len(survivors) <= eta or subset_size >= len(ordered_structures)
+        keep = 1 if final_round else math.ceil(len(survivors) / eta)
+        ranked = select_survivors(scores, metric, len(survivors))
+
+        table = Table(title=f"Round {round_number} ({metric})")
+        for heading in ['Experiment', 'Binding cutoff', 'Hamming cutoff', 'Allele cutoff', 'Score', 'Scored', 'Kept']:
+            table.add_column(heading)
+        for position, experiment_number in enumerate(ranked):
+            settings = sweep_experiments[experiment_number]
+            score = scores[experiment_number]['score']
+            table.add_row(experiment_number, str(settings.get('binding_cutoff')), str(settings.get('hamming_cutoff')), str(settings.get('allele_cutoff')), f"{score:.3f}" if score is not None else 'n/a', str(scores[experiment_number]['scored']), 'yes' if position < keep else '')
+        console.print(table)
+
+        survivors = ranked[:keep]
+        sweep['rounds'].append({'round': round_number, 'structures': [structure['pdb_code'] for structure in subset], 'scores': scores, 'survivors': survivors})
+        write_sweep_state(f"{sweep_folder}/sweep.json", sweep)
+
+        if final_round:
+            break
+        subset_size = min(subset_size * eta, len(ordered_structures))
+        round_number += 1
+
+    if not testing:
+        best = survivors[0]
+        console.print(f"[bold green]Best experiment: {best} {sweep_experiments[best]}[/bold green]")
+        console.print(f"The rounds are recorded in {sweep_folder}/sweep.json")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    run_sweep()
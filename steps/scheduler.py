@@ -0,0 +1,44 @@
+from typing import Dict, List
+
+import subprocess
+
+
+def detect_gpus(config:Dict) -> List[str]:
+    """
+    This function will find the GPUs available for predictions.
+
+    The GPU_NUMBERS list in the environment config is used if it is set, otherwise we'll ask nvidia-smi.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+
+    Returns:
+        gpus (List[str]): A list of GPU device numbers, e.g. ['0', '1', '2', '3']
+    """
+    if config is not None and config.get('GPU_NUMBERS'):
+        return [str(gpu) for gpu in config['GPU_NUMBERS']]
+    try:
+        nvidia_smi = subprocess.run(['nvidia-smi', '--query-gpu=index', '--format=csv,noheader'], capture_output=True, text=True, check=True)
+    except (FileNotFoundError, subprocess.CalledProcessError):
+        return []
+    return [line.strip() for line in nvidia_smi.stdout.splitlines() if line.strip()]
+
+
+def parse_gpu_numbers(gpu_number:str, config:Dict) -> List[str]:
+    """
+    This function will turn the --gpu_number CLI option into the list of GPUs to schedule work on.
+
+    Args:
+        gpu_number (str): Either 'all' (one worker using every GPU), 'auto' (one worker per detected GPU), a single device number or a comma separated list of device numbers e.g. 0,1,2,3
+        config (Dict): A dictionary details of input/ouput paths and project location
+
+    Returns:
+        gpus (List[str]): A list with one entry per worker, each either 'all' or a device number
+    """
+    if gpu_number == 'all':
+        return ['all']
+    if gpu_number == 'auto':
+        gpus = detect_gpus(config)
+        # if we can't find any GPUs we'll fall back to letting docker choose
+        return gpus if gpus else ['all']
+    return [gpu.strip() for gpu in str(gpu_number).split(',') if gpu.strip()]
@@ -0,0 +1,271 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+import base64
+import datetime
+import json
+import math
+import os
+import random
+import time
+import click
+
+from functions import colabfold_jobname
+
+
+# the three letter codes used for the residues in the PDB files
+RESIDUE_NAMES = {'A': 'ALA', 'R': 'ARG', 'N': 'ASN', 'D': 'ASP', 'C': 'CYS', 'Q': 'GLN', 'E': 'GLU', 'G': 'GLY', 'H': 'HIS', 'I': 'ILE', 'L': 'LEU', 'K': 'LYS', 'M': 'MET', 'F': 'PHE', 'P': 'PRO', 'S': 'SER', 'T': 'THR', 'W': 'TRP', 'Y': 'TYR', 'V': 'VAL'}
+
+# a 1x1 PNG, so the plot files are there without drawing anything
+EMPTY_PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==')
+
+
+def parse_colabfold_options(options:List[str]) -> Dict:
+    """
+    This function will pick out the colabfold_batch options which change the output layout, the rest are ignored.
+
+    Args:
+        options (List[str]): The colabfold_batch options e.g. ['--num-recycle', '3', '--amber']
+
+    Returns:
+        settings (Dict): A dictionary with num_models, num_recycle, random_seed and num_relax
+    """
+    settings = {'num_models': 5, 'num_recycle': 3, 'random_seed': 0, 'num_relax': 0, 'amber': False}
+    keys = {'--num-models': 'num_models', '--num-recycle': 'num_recycle', '--random-seed': 'random_seed', '--num-relax': 'num_relax'}
+    for position, option in enumerate(options):
+        if option in keys and position + 1 < len(options):
+            settings[keys[option]] = int(options[position + 1])
+        elif option == '--amber':
+            settings['amber'] = True
+    # colabfold relaxes every model if --amber is given without --num-relax
+    if settings['amber'] and settings['num_relax'] == 0:
+        settings['num_relax'] = settings['num_models']
+    return settings
+
+
+def load_queries(input_path:str) -> List[Dict]:
+    """
+    This function will read the queries from a colabfold_batch input, an a3m or FASTA file, or a folder of them.
+
+    As with colabfold_batch, a single FASTA file takes its jobname from the header and anything else from the file name.
+
+    Args:
+        input_path (str): The local path of the input file or folder
+
+    Returns:
+        queries (List[Dict]): A list of dictionaries with the jobname, sequence and chain_lengths of each query
+    """
+    if os.path.isdir(input_path):
+        filepaths = sorted(f"{input_path}/{filename}" for filename in os.listdir(input_path) if os.path.splitext(filename)[1] in ['.a3m', '.fasta', '.fa'])
+    else:
+        filepaths = [input_path]
+
+    queries = []
+    for filepath in filepaths:
+        stem, extension = os.path.splitext(os.path.basename(filepath))
+        with open(filepath, 'r') as f:
+            # we only need the query, which comes before the rest of the alignment
+            lines = []
+            for line in f:
+                lines.append(line.strip())
+                if extension == '.a3m' and len([line for line in lines if line.startswith('>')]) > 1:
+                    break
+        if extension == '.a3m':
+            chain_lengths = None
+            if lines[0].startswith('#'):
+                chain_lengths = [int(length) for length in lines[0][1:].split('\t')[0].split(',')]
+            sequence = lines[[index for index, line in enumerate(lines) if line.startswith('>')][0] + 1]
+            queries.append({'jobname': colabfold_jobname(stem), 'sequence': sequence, 'chain_lengths': chain_lengths or [len(sequence)]})
+        else:
+            records = [(lines[index][1:], lines[index + 1]) for index in range(len(lines) - 1) if lines[index].startswith('>')]
+            for header, sequence in records:
+                jobname = colabfold_jobname(header) if len(filepaths) == 1 else colabfold_jobname(stem)
+                queries.append({'jobname': jobname, 'sequence': sequence.replace(':', ''), 'chain_lengths': [len(chain) for chain in sequence.split(':')]})
+    return queries
+
+
+def log_timestamp() -> str:
+    now = datetime.datetime.now()
+    return f"{now.strftime('%Y-%m-%d %H:%M:%S')},{now.microsecond // 1000:03d}"
+
+
+def build_pdb(sequence:str, chain_lengths:List[int], plddt:List[float], rng:random.Random) -> str:
+    """
+    This function will build a PDB file for a query, with the residues of each chain laid out along a helix and the pLDDT in the B-factor column, as colabfold does.
+
+    Args:
+        sequence (str): The query sequence, with the chains concatenated
+        chain_lengths (List[int]): The length of each chain
+        plddt (List[float]): The pLDDT of each residue
+        rng (random.Random): The random number generator for the coordinates
+
+    Returns:
+        pdb (str): The contents of the PDB file
+    """
+    atoms = [('N', -0.5), ('CA', 0.0), ('C', 0.5), ('O', 0.9)]
+    lines = [f"{'MODEL     1':<80}"]
+    serial = 1
+    position = 0
+    for chain_index, chain_length in enumerate(chain_lengths):
+        chain = chr(ord('A') + chain_index)
+        offset = rng.uniform(-2.0, 2.0)
+        for residue_number in range(1, chain_length + 1):
+            residue_name = RESIDUE_NAMES.get(sequence[position], 'UNK')
+            for atom_name, shift in atoms:
+                angle = (position + shift) * 100 * math.pi / 180
+                x, y, z = 2.3 * math.cos(angle) + 20 * chain_index, 2.3 * math.sin(angle) + offset, 1.5 * (residue_number + shift)
+                lines.append(f"ATOM  {serial:>5}  {atom_name:<3} {residue_name} {chain}{residue_number:>4}    {x:>8.3f}{y:>8.3f}{z:>8.3f}  1.00{plddt[position]:>6.2f}           {atom_name[0]}  ")
+                serial += 1
+            position += 1
+        lines.append(f"{f'TER   {serial:>5}      {residue_name} {chain}{chain_length:>4}':<80}")
+        serial += 1
+    lines.extend([f"{'ENDMDL':<80}", f"{'END':<80}", ''])
+    return '\n'.join(lines)
+
+
+def write_query_outputs(query:Dict, query_number:Tuple[int, int], output_folder:str, settings:Dict, log:Callable[[str], None], latency:float, full_outputs:bool, failure:Optional[str]) -> bool:
+    """
+    This function will write the outputs colabfold_batch writes for one query, logging each recycle and model as it goes.
+
+    Args:
+        query (Dict): The query dictionary returned by load_queries
+        query_number (Tuple[int, int]): The position of the query in the run, counting from 1, and the number of queries
+        output_folder (str): The local output folder
+        settings (Dict): The settings returned by parse_colabfold_options
+        log (Callable): A function writing a line to log.txt
+        latency (float): The number of seconds the query should take, spread across the models and recycles
+        full_outputs (bool): Whether to write full size outputs (the PAE matrices and backbone atoms), or small placeholders with the same names
+        failure (str): The failure to inject, 'crash', 'hang' or 'partial', or None
+
+    Returns:
+        finished (bool): False if the query failed part of the way through
+    """
+    jobname = query['jobname']
+    length = len(query['sequence'])
+    model_type = 'alphafold2_multimer_v3' if len(query['chain_lengths']) > 1 else 'alphafold2_ptm'
+    rng = random.Random(f"{jobname}_{settings['random_seed']}")
+
+    log(f"Query {query_number[0]}/{query_number[1]}: {jobname} (length {length})")
+    log("Setting max_seq=508, max_extra_seq=2048")
+    step_seconds = latency / max(settings['num_models'] * (settings['num_recycle'] + 1), 1)
+
+    models = []
+    for model_number in range(1, settings['num_models'] + 1):
+        model_name = f"{model_type}_model_{model_number}_seed_{settings['random_seed']:03d}"
+        model_start = time.time()
+        for recycle in range(settings['num_recycle'] + 1):
+            time.sleep(step_seconds)
+            mean_plddt = 60 + 30 * (recycle + 1) / (settings['num_recycle'] + 1) + rng.uniform(-3, 3)
+            ptm, iptm = rng.uniform(0.5, 0.9), rng.uniform(0.2, 0.9)
+            log(f"{model_name} recycle={recycle} pLDDT={mean_plddt:.3g} pTM={ptm:.3g} ipTM={iptm:.3g}")
+        log(f"{model_name} took {time.time() - model_start:.1f}s ({settings['num_recycle']} recycles)")
+        models.append({'model_number': model_number, 'name': model_name, 'mean_plddt': mean_plddt, 'ptm': ptm, 'iptm': iptm})
+
+        if failure is not None and model_number == 1:
+            # the failures happen after the first model, so the folder is left part written
+            if failure == 'hang':
+                time.sleep(10 ** 6)
+            if failure == 'crash':
+                log(f"Could not predict {jobname}. Not Enough GPU memory? RuntimeError('injected failure')")
+                return False
+
+    log(f"reranking models by '{'multimer' if model_type == 'alphafold2_multimer_v3' else 'plddt'}' metric")
+    models.sort(key=lambda model: 0.8 * model['iptm'] + 0.2 * model['ptm'], reverse=True)
+    for rank, model in enumerate(models, start=1):
+        plddt = [round(min(max(model['mean_plddt'] + rng.gauss(0, 6), 20.0), 98.0), 2) for position in range(length)]
+        pae = [[round(rng.uniform(0.5, 31.0), 2) for column in range(length)] for row in range(length)] if full_outputs else []
+        scores = {'plddt': plddt, 'max_pae': 31.75, 'pae': pae, 'ptm': round(model['ptm'], 2), 'iptm': round(model['iptm'], 2)}
+        with open(f"{output_folder}/{jobname}_scores_rank_{rank:03d}_{model['name']}.json", 'w') as f:
+            json.dump(scores, f)
+        pdb = build_pdb(query['sequence'], query['chain_lengths'], plddt, rng) if full_outputs else f"{'MODEL     1':<80}\n{'ENDMDL':<80}\n{'END':<80}\n"
+        with open(f"{output_folder}/{jobname}_unrelaxed_rank_{rank:03d}_{model['name']}.pdb", 'w') as f:
+            f.write(pdb)
+        if rank <= settings['num_relax']:
+            time.sleep(step_seconds)
+            log(f"Relaxation took {step_seconds:.1f}s")
+            with open(f"{output_folder}/{jobname}_relaxed_rank_{rank:03d}_{model['name']}.pdb", 'w') as f:
+                f.write(pdb)
+        log(f"rank_{rank:03d}_{model['name']} pLDDT={model['mean_plddt']:.3g} pTM={model['ptm']:.3g} ipTM={model['iptm']:.3g}")
+        if rank == 1:
+            with open(f"{output_folder}/{jobname}_predicted_aligned_error_v1.json", 'w') as f:
+                json.dump({'predicted_aligned_error': pae, 'max_predicted_aligned_error': 31.75}, f)
+
+    for plot in ['coverage', 'pae', 'plddt']:
+        with open(f"{output_folder}/{jobname}_{plot}.png", 'wb') as f:
+            f.write(EMPTY_PNG)
+
+    # a partial failure exits cleanly but never writes the done file, like a container killed part of the way through
+    if failure == 'partial':
+        return True
+    with open(f"{output_folder}/{jobname}.done.txt", 'w') as f:
+        f.write('')
+    return True
+
+
+def choose_failure(rng:random.Random, failure_rate:float, failure_mode:str) -> Optional[str]:
+    if failure_rate <= 0 or rng.random() >= failure_rate:
+        return None
+    return failure_mode
+
+
+def resolve_path(path:str, work_folder:Optional[str]) -> str:
+    # the paths are the in container paths, so we'll map /work back to the folder docker would have mounted
+    if work_folder and (path == '/work' or path.startswith('/work/')):
+        return f"{work_folder}{path[len('/work'):]}"
+    return path
+
+
+@click.command(context_settings={'ignore_unknown_options': True, 'allow_extra_args': True})
+@click.option("--work_folder", default=None, help="The folder docker would mount as /work, the in container paths of the input and output are mapped back to it.")
+@click.option("--latency", default=0.0, help="The number of seconds each query takes.")
+@click.option("--startup", default=0.0, help="The number of seconds before the first query starts, standing in for the container launch and backend init.")
+@click.option("--failure_rate", default=0.0, help="The fraction of queries which fail.")
+@click.option("--failure_mode", default='crash', type=click.Choice(['crash', 'hang', 'partial']), help="How queries fail, crash (a non zero exit part of the way through), hang (until killed) or partial (a clean exit without the done file).")
+@click.option("--seed", default=None, type=int, help="The seed for the failures, by default they're different on every run.")
+@click.option("--outputs", default='full', type=click.Choice(['full', 'minimal']), help="Whether to write full size outputs, or placeholders with the same names for benchmarking the orchestration.")
+@click.argument("arguments", nargs=-1, type=click.UNPROCESSED)
+def stub_colabfold(work_folder, latency, startup, failure_rate, failure_mode, seed, outputs, arguments):
+    """
+    A stand in for colabfold_batch which takes the same arguments and writes the same output layout, for running the orchestration without a GPU.
+    """
+    if len(arguments) < 2:
+        raise click.UsageError("The colabfold_batch input and output folder are required")
+    colabfold_options, input_path, output_folder = list(arguments[:-2]), resolve_path(arguments[-2], work_folder), resolve_path(arguments[-1], work_folder)
+    settings = parse_colabfold_options(colabfold_options)
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    log_file = open(f"{output_folder}/log.txt", 'a')
+
+    def log(message:str) -> None:
+        # colabfold writes each log line to the console as well as log.txt
+        line = f"{log_timestamp()} {message}"
+        log_file.write(f"{line}\n")
+        log_file.flush()
+        print(line, flush=True)
+
+    log("Running colabfold 1.5.5 (stub)")
+    time.sleep(startup)
+    log("Running on GPU")
+    queries = load_queries(input_path)
+    with open(f"{output_folder}/config.json", 'w') as f:
+        json.dump({'num_queries': len(queries), 'num_relax': settings['num_relax'], 'num_models': settings['num_models'], 'num_recycles': settings['num_recycle'], 'random_seed': settings['random_seed'], 'version': '1.5.5'}, f, indent=4)
+    with open(f"{output_folder}/cite.bibtex", 'w') as f:
+        f.write('')
+
+    failure_rng = random.Random(seed) if seed is not None else random.Random()
+    exit_code = 0
+    for query_index, query in enumerate(queries):
+        failure = choose_failure(failure_rng, failure_rate, failure_mode)
+        if not write_query_outputs(query, (query_index + 1, len(queries)), output_folder, settings, log, latency, outputs == 'full', failure):
+            exit_code = 1
+            break
+    if exit_code == 0:
+        log("Done")
+    log_file.close()
+    raise SystemExit(exit_code)
+
+
+
+
+if __name__ == "__main__":
+    stub_colabfold()
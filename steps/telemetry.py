@@ -0,0 +1,335 @@
+from typing import List, Dict, Optional
+
+import contextlib
+import datetime
+import json
+import os
+import re
+import statistics
+import click
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from functions import load_config, journal_filepath, journal_filepaths, completion_index_filepath
+from journal import LOCAL_JOURNAL_MODE, open_journal
+from manifest import load_completion_index
+from prediction_archive import read_result_file
+
+
+LOG_LINE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) (.*)$")
+RUN_START_PATTERN = re.compile(r"^Running colabfold\b")
+QUERY_PATTERN = re.compile(r"^Query \d+/\d+: (\S+) \(length (\d+)\)")
+MAX_SEQ_PATTERN = re.compile(r"^Setting max_seq=(\d+), max_extra_seq=(\d+)")
+RECYCLE_PATTERN = re.compile(r"^(\S+) recycle=(\d+) pLDDT=([\d.]+)")
+MODEL_TOOK_PATTERN = re.compile(r"^(\S+) took ([\d.]+)s \((\d+) recycles\)")
+RELAX_PATTERN = re.compile(r"^Relaxation took ([\d.]+)s")
+
+# the colabfold stages which keep the GPU busy, used for the GPU busy fraction
+GPU_STAGES = ['compile', 'inference']
+
+
+def parse_log_timestamp(timestamp:str) -> datetime.datetime:
+    return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S,%f")
+
+
+def parse_colabfold_log(log_text:str) -> Dict[str, Dict]:
+    """
+    This function will parse a colabfold log.txt into the time spent in each stage for each query in the run.
+
+    Colabfold appends to log.txt, so a retried prediction has a run in the log for each attempt. Each run starts at its 'Running colabfold' line, and a query run more than once is taken from the last run.
+
+    The stages are:
+        backend_init: from colabfold starting to the first query of the run (first query only)
+        msa_setup: from the query starting to the model inputs being ready ('Setting max_seq=...')
+        compile: the extra time the first model took over the median of the others, i.e. the JIT compile
+        inference: the rest of the model time
+        relax: the total Amber relaxation time
+        total: from the query starting to the next query (or the end of the run)
+
+    Args:
+        log_text (str): The contents of the log.txt file
+
+    Returns:
+        queries (Dict[str, Dict]): A dictionary with the jobname as the key and a dictionary of the query's stages, run_start, start_time, end_time, sequence_length, max_seq, max_extra_seq, models and recycle_seconds as the value
+    """
+    queries = {}
+    run_start = None
+    run_queries = 0
+    query = None
+    last_timestamp = None
+    for line in log_text.splitlines():
+        match = LOG_LINE_PATTERN.match(line)
+        if not match:
+            continue
+        timestamp = parse_log_timestamp(match.group(1))
+        message = match.group(2)
+        if RUN_START_PATTERN.match(message):
+            # a new attempt, the last query of the one before ended with its last line rather than this one
+            if query is not None and query['end_time'] is None:
+                query['end_time'] = last_timestamp
+            run_start = None
+            query = None
+        if run_start is None:
+            run_start = timestamp
+            run_queries = 0
+        last_timestamp = timestamp
+
+        query_match = QUERY_PATTERN.match(message)
+        if query_match:
+            if query is not None:
+                query['end_time'] = timestamp
+            query = {'jobname': query_match.group(1), 'sequence_length': int(query_match.group(2)), 'run_start': run_start, 'start_time': timestamp, 'end_time': None, 'inputs_ready': None, 'max_seq': None, 'max_extra_seq': None, 'models': [], 'recycle_seconds': [], 'relax_seconds': [], 'last_event': timestamp}
+            query['backend_init'] = (timestamp - run_start).total_seconds() if run_queries == 0 else 0.0
+            run_queries += 1
+            queries[query['jobname']] = query
+            continue
+        if query is None:
+            continue
+
+        max_seq_match = MAX_SEQ_PATTERN.match(message)
+        recycle_match = RECYCLE_PATTERN.match(message)
+        model_match = MODEL_TOOK_PATTERN.match(message)
+        relax_match = RELAX_PATTERN.match(message)
+        if max_seq_match:
+            query['inputs_ready'] = timestamp
+            query['max_seq'] = int(max_seq_match.group(1))
+            query['max_extra_seq'] = int(max_seq_match.group(2))
+            query['last_event'] = timestamp
+        elif recycle_match:
+            # each recycle line is written when the recycle finishes, so its duration is the time since the previous event
+            query['recycle_seconds'].append((timestamp - query['last_event']).total_seconds())
+            query['last_event'] = timestamp
+        elif model_match:
+            query['models'].append({'model': model_match.group(1), 'seconds': float(model_match.group(2)), 'recycles': int(model_match.group(3))})
+            query['last_event'] = timestamp
+        elif relax_match:
+            query['relax_seconds'].append(float(relax_match.group(1)))
+    if query is not None and query['end_time'] is None:
+        query['end_time'] = last_timestamp
+
+    for query in queries.values():
+        model_seconds = [model['seconds'] for model in query['models']]
+        compile_seconds = 0.0
+        if len(model_seconds) > 1:
+            compile_seconds = max(model_seconds[0] - statistics.median(model_seconds[1:]), 0.0)
+        query['stages'] = {
+            'backend_init': query.pop('backend_init'),
+            'msa_setup': (query['inputs_ready'] - query['start_time']).total_seconds() if query['inputs_ready'] else 0.0,
+            'compile': compile_seconds,
+            'inference': sum(model_seconds) - compile_seconds,
+            'relax': sum(query['relax_seconds']),
+            'total': (query['end_time'] - query['start_time']).total_seconds()
+        }
+        query.pop('last_event')
+    return queries
+
+
+def record_span(journal_filepath:str, experiment_number:str, pdb_code:str, stage:str, duration:float, source:str='orchestrator', start_time:Optional[datetime.datetime]=None, end_time:Optional[datetime.datetime]=None, attributes:Optional[Dict]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> None:
+    """
+    This function will record the time spent in one stage of a job in the timing store (the spans table of the journal).
+
+    Args:
+        journal_filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        pdb_code (str): The PDB code
+        stage (str): The name of the stage e.g. a3m_build, container, inference
+        duration (float): The time spent in the stage in seconds
+        source (str): Where the timing came from, either 'orchestrator' or 'colabfold'
+        start_time (datetime): When the stage started, if known
+        end_time (datetime): When the stage ended, if known
+        attributes (Dict): Any extra details, e.g. the GPU, sequence length or MSA depth
+        journal_mode (str): The SQLite journal mode, see journal.open_journal
+    """
+    with open_journal(journal_filepath, journal_mode) as connection:
+        connection.execute(
+            "INSERT INTO spans (experiment_number, pdb_code, stage, source, start_time, end_time, duration, attributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (experiment_number, pdb_code, stage, source, start_time.isoformat() if start_time else None, end_time.isoformat() if end_time else None, duration, json.dumps(attributes or {}))
+        )
+
+
+@contextlib.contextmanager
+def timed_span(journal_filepath:Optional[str], experiment_number:str, pdb_code:str, stage:str, attributes:Optional[Dict]=None, journal_mode:str=LOCAL_JOURNAL_MODE):
+    """
+    This function will time the code inside a with block and record it as a span, nothing is recorded if journal_filepath is None.
+
+    Args:
+        journal_filepath (str): The path to the journal database, or None to not record anything (e.g. in testing mode)
+        experiment_number (str): The experiment number
+        pdb_code (str): The PDB code
+        stage (str): The name of the stage
+        attributes (Dict): Any extra details, the with block can add to the dictionary it is given
+        journal_mode (str): The SQLite journal mode, see journal.open_journal
+
+    Yields:
+        attributes (Dict): The attributes dictionary, which is recorded with the span when the block finishes
+    """
+    attributes = attributes if attributes is not None else {}
+    start_time = datetime.datetime.now()
+    try:
+        yield attributes
+    finally:
+        end_time = datetime.datetime.now()
+        if journal_filepath is not None:
+            record_span(journal_filepath, experiment_number, pdb_code, stage, (end_time - start_time).total_seconds(), start_time=start_time, end_time=end_time, attributes=attributes, journal_mode=journal_mode)
+
+
+def record_colabfold_log(journal_filepath:str, experiment_number:str, pdb_code:str, log_filepath:str, jobname:str, attributes:Optional[Dict]=None, container_start:Optional[datetime.datetime]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> Optional[Dict]:
+    """
+    This function will parse a colabfold log.txt and record the stages of one query from it as spans.
+
+    If the time the container was launched is given, the time until colabfold started the run the query is from is recorded as the docker_launch stage.
+
+    Args:
+        journal_filepath (str): The path to the journal database
+        experiment_number (str): The experiment number
+        pdb_code (str): The PDB code
+        log_filepath (str): The path to the log.txt file, which is read from the archive if its folder is archived
+        jobname (str): The jobname of the query in the log
+        attributes (Dict): Any extra details to record with each span, e.g. the MSA depth
+        container_start (datetime): When the container was launched
+        journal_mode (str): The SQLite journal mode, see journal.open_journal
+
+    Returns:
+        query (Dict): The parsed query returned by parse_colabfold_log, or None if the query isn't in the log
+    """
+    try:
+        log_text = read_result_file(log_filepath).decode()
+    except FileNotFoundError:
+        return None
+    query = parse_colabfold_log(log_text).get(jobname)
+    if query is None:
+        return None
+    attributes = dict(attributes or {})
+    attributes.update({'sequence_length': query['sequence_length'], 'max_seq': query['max_seq'], 'max_extra_seq': query['max_extra_seq'], 'recycles': sum(model['recycles'] for model in query['models']), 'models': len(query['models'])})
+    for stage, duration in query['stages'].items():
+        record_span(journal_filepath, experiment_number, pdb_code, stage, duration, source='colabfold', attributes=attributes, journal_mode=journal_mode)
+    if container_start is not None:
+        # the query is from the last run in the log, which is the one this container started
+        docker_launch = (query['run_start'] - container_start).total_seconds()
+        record_span(journal_filepath, experiment_number, pdb_code, 'docker_launch', max(docker_launch, 0.0), start_time=container_start, attributes=attributes, journal_mode=journal_mode)
+    return query
+
+
+def load_spans(journal_filepath:str, experiment_numbers:Optional[List[str]]=None, journal_mode:Optional[str]=LOCAL_JOURNAL_MODE) -> List[Dict]:
+    query = "SELECT * FROM spans"
+    parameters = []
+    if experiment_numbers is not None:
+        query += f" WHERE experiment_number IN ({','.join('?' for number in experiment_numbers)})"
+        parameters = experiment_numbers
+    with open_journal(journal_filepath, journal_mode) as connection:
+        rows = connection.execute(query, parameters).fetchall()
+    return [{**dict(row), 'attributes': json.loads(row['attributes'])} for row in rows]
+
+
+def summarise_spans(spans:List[Dict]) -> Dict[str, Dict]:
+    """
+    This function will summarise the spans of each experiment, the duration percentiles of each stage, the GPU busy fraction and the seconds per residue.
+
+    Args:
+        spans (List[Dict]): The spans returned by load_spans
+
+    Returns:
+        summaries (Dict[str, Dict]): A dictionary with the experiment number as the key and a dictionary of 'stages', 'gpu_busy_fraction', 'seconds_per_residue' and 'msa_depth' as the value
+    """
+    summaries = {}
+    for experiment_number in sorted(set(span['experiment_number'] for span in spans), key=lambda number: (len(number), number)):
+        experiment_spans = [span for span in spans if span['experiment_number'] == experiment_number]
+        stages = {}
+        for span in experiment_spans:
+            stages.setdefault((span['source'], span['stage']), []).append(span['duration'])
+        stage_summaries = {}
+        for (source, stage), durations in sorted(stages.items()):
+            durations = np.array(durations)
+            stage_summaries[f"{source}:{stage}"] = {'count': len(durations), 'p50': float(np.percentile(durations, 50)), 'p95': float(np.percentile(durations, 95)), 'total': float(durations.sum())}
+
+        # the GPU is busy for the compile and inference stages, out of the time the containers were running
+        gpu_seconds = sum(span['duration'] for span in experiment_spans if span['source'] == 'colabfold' and span['stage'] in GPU_STAGES)
+        container_seconds = sum(span['duration'] for span in experiment_spans if span['source'] == 'orchestrator' and span['stage'] == 'container')
+        inference_spans = [span for span in experiment_spans if span['source'] == 'colabfold' and span['stage'] == 'inference' and span['attributes'].get('sequence_length')]
+        depths = [span['attributes']['msa_depth'] for span in experiment_spans if span['attributes'].get('msa_depth') is not None]
+        summaries[experiment_number] = {
+            'stages': stage_summaries,
+            'gpu_busy_fraction': gpu_seconds / container_seconds if container_seconds > 0 else None,
+            'seconds_per_residue': float(np.median([span['duration'] / span['attributes']['sequence_length'] for span in inference_spans])) if inference_spans else None,
+            'msa_depth': int(np.median(depths)) if depths else None
+        }
+    return summaries
+
+
+def backfill_colabfold_logs(config:Dict, journal_filepath:str, experiment_numbers:Optional[List[str]]=None, journal_mode:str=LOCAL_JOURNAL_MODE) -> int:
+    """
+    This function will record the colabfold stages of finished predictions which don't have any colabfold spans yet, from their log.txt files, archived or not.
+
+    Args:
+        config (Dict): A dictionary details of input/ouput paths and project location
+        journal_filepath (str): The path to the journal database
+        experiment_numbers (List[str]): Only backfill these experiments, or None for every experiment
+        journal_mode (str): The SQLite journal mode, see journal.open_journal
+
+    Returns:
+        recorded (int): The number of predictions recorded
+    """
+    # the predictions run across several nodes have their colabfold spans in the journal of the node which ran them
+    spans = load_spans(journal_filepath, experiment_numbers, journal_mode)
+    for filepath in journal_filepaths(config):
+        if os.path.abspath(filepath) != os.path.abspath(journal_filepath):
+            spans += load_spans(filepath, experiment_numbers, None)
+    recorded_jobs = set((span['experiment_number'], span['pdb_code']) for span in spans if span['source'] == 'colabfold')
+    completed = load_completion_index(completion_index_filepath(config))
+    recorded = 0
+    for index_key, entry in completed.items():
+        experiment_number, pdb_code = index_key.split('/')[-2:]
+        if (experiment_numbers is not None and experiment_number not in experiment_numbers) or (experiment_number, pdb_code) in recorded_jobs:
+            continue
+        if record_colabfold_log(journal_filepath, experiment_number, pdb_code, f"{config['PROJECT_FOLDER']}/{index_key}/log.txt", entry['jobname'], journal_mode=journal_mode) is not None:
+            recorded += 1
+    return recorded
+
+
+@click.command()
+@click.option("--environment", default='local', help="The name of the environment, can either be local or poc.")
+@click.option("--experiment_number", default=None, help="Only summarise these experiments, separated by commas e.g. 31,32,33.")
+@click.option("--backfill", is_flag=True, default=False, help="Parse the log.txt of finished predictions which don't have colabfold timings yet.")
+def summarise_timings(environment, experiment_number, backfill):
+    config = load_config(environment)
+
+    console = Console()
+    if config is not None:
+        experiment_numbers = [number.strip() for number in experiment_number.split(',')] if experiment_number else None
+
+        # the spans are kept in the same journal, and the backfill reads the same completion index, as run_msa_predictions
+        if backfill:
+            console.print(f"Recorded colabfold timings for {backfill_colabfold_logs(config, journal_filepath(config), experiment_numbers)} predictions")
+
+        # runs across several nodes keep their spans in a journal per node
+        summaries = summarise_spans([span for filepath in journal_filepaths(config) for span in load_spans(filepath, experiment_numbers, None)])
+        for experiment_number, summary in summaries.items():
+            table = Table(title=f"Experiment {experiment_number}")
+            for heading in ['Stage', 'Count', 'p50 (s)', 'p95 (s)', 'Total (s)']:
+                table.add_column(heading)
+            for stage, stage_summary in summary['stages'].items():
+                table.add_row(stage, str(stage_summary['count']), f"{stage_summary['p50']:.1f}", f"{stage_summary['p95']:.1f}", f"{stage_summary['total']:.0f}")
+            console.print(table)
+            gpu_busy = f"{summary['gpu_busy_fraction']:.0%}" if summary['gpu_busy_fraction'] is not None else 'n/a'
+            seconds_per_residue = f"{summary['seconds_per_residue']:.3f}" if summary['seconds_per_residue'] is not None else 'n/a'
+            console.print(f"GPU busy: {gpu_busy}, inference seconds per residue: {seconds_per_residue}, MSA depth: {summary['msa_depth'] or 'n/a'}")
+
+        # seconds per residue against MSA depth shows how much of the inference cost comes from the size of the alignment
+        depth_summaries = sorted([(summary['msa_depth'], experiment_number, summary['seconds_per_residue']) for experiment_number, summary in summaries.items() if summary['msa_depth'] is not None and summary['seconds_per_residue'] is not None])
+        if len(depth_summaries) > 0:
+            table = Table(title="Inference seconds per residue by MSA depth")
+            for heading in ['MSA depth', 'Experiment', 'Seconds per residue']:
+                table.add_column(heading)
+            for msa_depth, experiment_number, seconds_per_residue in depth_summaries:
+                table.add_row(str(msa_depth), experiment_number, f"{seconds_per_residue:.3f}")
+            console.print(table)
+    else:
+        console.print("[bold red]Cannot run. There was an error loading the configuration, please check you have filled in the config file.[/bold red]")
+    pass
+
+
+
+
+if __name__ == "__main__":
+    summarise_timings()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# the steps are run as scripts which import each other by name, so the tests do the same
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'steps'))
@@ -0,0 +1,56 @@
+import json
+import os
+
+from functions import input_bundle_sources, input_bundle_filepath, load_input_bundle, load_prediction_list, load_allele_sequences, load_b2m_sequence
+from input_bundle import compile_input_bundle
+
+
+PREDICTIONS = [
+    {'pdb_code': '1abc', 'locus': 'hla_a', 'allele_slug': 'hla_a_02_01', 'peptide_sequence': 'SLYNTVATL', 'resolution': '2.00'},
+    {'pdb_code': '2abc', 'locus': 'hla_b', 'allele_slug': 'hla_b_07_02', 'peptide_sequence': 'RPHERNGFTV', 'resolution': '1.80'}
+]
+
+
+def make_project(project_folder:str) -> dict:
+    # a project with two alleles, one of which has no canonical sequence so it isn't compiled into the bundle
+    config = {'PROJECT_FOLDER': project_folder, 'INPUT_FOLDER': 'inputs', 'OUTPUT_FOLDER': 'outputs'}
+    os.makedirs(f"{project_folder}/inputs/complexes")
+    os.makedirs(f"{project_folder}/inputs/sequences")
+    with open(f"{project_folder}/inputs/complexes/hla_class_i.csv", 'w') as f:
+        f.write(','.join(PREDICTIONS[0]) + '\n')
+        for prediction in PREDICTIONS:
+            f.write(','.join(prediction.values()) + '\n')
+    loci = {'hla_a': {'hla_a_02_01': {'canonical_sequence': 'GSHSMRYF'}}, 'hla_b': {'hla_b_07_02': {'canonical_sequence': None, 'sequence': 'GSHSMRYY'}}, 'hla_c': {}}
+    for locus, alleles in loci.items():
+        with open(f"{project_folder}/inputs/sequences/{locus}.json", 'w') as f:
+            json.dump(alleles, f)
+    with open(f"{project_folder}/inputs/sequences/human_b2m.json", 'w') as f:
+        json.dump({'canonical_sequence': 'IQRTPKIQ'}, f)
+    compile_input_bundle(input_bundle_sources(config), input_bundle_filepath(config))
+    return config
+
+
+def test_the_loaders_read_an_up_to_date_bundle(tmp_path):
+    config = make_project(str(tmp_path))
+    assert load_input_bundle(config) is not None
+    assert load_prediction_list(config) == PREDICTIONS
+    assert load_allele_sequences(PREDICTIONS[:1], config) == {'hla_a_02_01': 'GSHSMRYF'}
+    assert load_b2m_sequence(config) == 'IQRTPKIQ'
+
+
+def test_an_allele_missing_from_the_bundle_is_read_from_the_source_files(tmp_path):
+    config = make_project(str(tmp_path))
+    # the bundle would raise a KeyError for the allele without a canonical sequence, the loader gives what the source files give
+    with_bundle = load_allele_sequences(PREDICTIONS, config)
+    os.remove(input_bundle_filepath(config))
+    assert with_bundle == load_allele_sequences(PREDICTIONS, config) == {'hla_a_02_01': 'GSHSMRYF', 'hla_b_07_02': None}
+
+
+def test_a_corrupt_bundle_is_ignored(tmp_path):
+    config = make_project(str(tmp_path))
+    with open(input_bundle_filepath(config), 'r+b') as f:
+        f.seek(20)
+        f.write(b'not json')
+    assert load_input_bundle(config) is None
+    assert load_prediction_list(config) == PREDICTIONS
+    assert load_b2m_sequence(config) == 'IQRTPKIQ'
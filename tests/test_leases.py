@@ -0,0 +1,95 @@
+import json
+import multiprocessing
+import os
+import time
+
+from leases import acquire_lease, read_lease, release_lease, create_job_claims, claim_job_lease, holds_job_lease, is_lease_lost, start_claims_heartbeat
+
+
+PROCESSES = 8
+TRIALS = 20
+
+
+def race_for_lease(lease_filepath:str, owner:str, ttl:float, barrier, results) -> None:
+    # every process waits at the barrier so they all try for the lease at the same moment
+    barrier.wait()
+    results.put((owner, acquire_lease(lease_filepath, owner, ttl)))
+
+
+def run_race(lease_filepath:str, ttl:float) -> list:
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(PROCESSES)
+    results = context.Queue()
+    processes = [context.Process(target=race_for_lease, args=(lease_filepath, f"owner-{number}", ttl, barrier, results)) for number in range(PROCESSES)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get(timeout=30) for process in processes]
+    for process in processes:
+        process.join()
+    return [owner for owner, acquired in outcomes if acquired]
+
+
+def write_expired_lease(lease_filepath:str, owner:str, age:float) -> None:
+    with open(lease_filepath, 'w') as f:
+        json.dump({'owner': owner}, f)
+    expired = time.time() - age
+    os.utime(lease_filepath, (expired, expired))
+
+
+def test_only_one_process_acquires_a_new_lease(tmp_path):
+    for trial in range(TRIALS):
+        lease_filepath = str(tmp_path / f"{trial}.lease")
+        winners = run_race(lease_filepath, 60)
+        assert len(winners) == 1
+        assert read_lease(lease_filepath)['owner'] == winners[0]
+
+
+def test_only_one_process_takes_over_an_expired_lease(tmp_path):
+    for trial in range(TRIALS):
+        lease_filepath = str(tmp_path / f"{trial}.lease")
+        write_expired_lease(lease_filepath, 'dead-node', 120)
+        winners = run_race(lease_filepath, 60)
+        assert len(winners) == 1
+        assert read_lease(lease_filepath)['owner'] == winners[0]
+    # the takeover and new lease files are always cleaned up, only the leases are left
+    assert sorted(os.listdir(tmp_path)) == sorted(f"{trial}.lease" for trial in range(TRIALS))
+
+
+def test_a_live_lease_is_not_taken_over(tmp_path):
+    lease_filepath = str(tmp_path / 'job.lease')
+    assert acquire_lease(lease_filepath, 'first', 60)
+    assert run_race(lease_filepath, 60) == []
+    assert read_lease(lease_filepath)['owner'] == 'first'
+
+
+def test_release_only_removes_our_own_lease(tmp_path):
+    lease_filepath = str(tmp_path / 'job.lease')
+    assert acquire_lease(lease_filepath, 'first', 60)
+    release_lease(lease_filepath, 'second')
+    assert read_lease(lease_filepath)['owner'] == 'first'
+    release_lease(lease_filepath, 'first')
+    assert not os.path.exists(lease_filepath)
+    assert acquire_lease(lease_filepath, 'second', 60)
+
+
+def test_the_heartbeat_notices_a_lost_lease(tmp_path):
+    lease_filepath = str(tmp_path / 'job.lease')
+    claims = create_job_claims(0.4)
+    assert claim_job_lease(claims, lease_filepath, '1/abcd')
+    stop_heartbeat = start_claims_heartbeat(claims)
+    try:
+        # another node taking the lease over replaces the lease file with its own
+        time.sleep(0.3)
+        assert holds_job_lease(claims, lease_filepath)
+        with open(lease_filepath, 'w') as f:
+            json.dump({'owner': 'other-node'}, f)
+        deadline = time.time() + 5
+        while not is_lease_lost(claims, lease_filepath) and time.time() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop_heartbeat.set()
+    assert is_lease_lost(claims, lease_filepath)
+    assert not holds_job_lease(claims, lease_filepath)
+    assert lease_filepath not in claims['held']
+    # the other node's lease is left as it is
+    assert read_lease(lease_filepath)['owner'] == 'other-node'
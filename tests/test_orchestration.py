@@ -0,0 +1,183 @@
+import glob
+import os
+import shutil
+
+from rich.console import Console
+
+from benchmark_orchestration import write_synthetic_inputs
+from functions import journal_filepath
+from journal import list_jobs
+from manifest import verify_completion_manifest
+from run_msa_predictions import run_experiment_grid
+from telemetry import load_spans
+
+
+STRUCTURES = 3
+NUM_MODELS = 2
+
+
+def make_config(project_folder:str, **stub_settings) -> dict:
+    # the same config as the benchmark's scratch project, with fewer models so each stub query is quick
+    config = {
+        'PROJECT_FOLDER': project_folder,
+        'INPUT_FOLDER': 'inputs',
+        'OUTPUT_FOLDER': 'outputs',
+        'AF_WEIGHTS_FOLDER': project_folder,
+        'CONTAINER_IMAGE': 'stub',
+        'COLABFOLD_OPTIONS': f"--num-recycle 1 --random-seed 42 --num-models {NUM_MODELS}",
+        'COLABFOLD_BACKEND': 'stub',
+        'STUB_LATENCY': 0,
+        'STUB_FAILURE_RATE': 0,
+        'STUB_OUTPUTS': 'minimal'
+    }
+    config.update(stub_settings)
+    return config
+
+
+def make_sweep(project_folder:str, experiment_count:int=1) -> tuple:
+    return write_synthetic_inputs(project_folder, experiment_count, STRUCTURES, 8, 42)
+
+
+def run_grid(config:dict, sweep:tuple, experiment_numbers:list=None, timeout:float=None, batch_size:int=1) -> dict:
+    all_experiment_numbers, structures_to_predict, allele_sequences, b2m_seq = sweep
+    return run_experiment_grid(config, experiment_numbers or all_experiment_numbers, structures_to_predict, allele_sequences, b2m_seq, ['0'], 0, timeout, False, Console(quiet=True), batch_size=batch_size, retry_backoff=0)
+
+
+def journal_statuses(config:dict, experiment_number:str) -> dict:
+    return {pdb_code: entry['status'] for pdb_code, entry in list_jobs(journal_filepath(config), experiment_number).items()}
+
+
+def container_runs(config:dict) -> int:
+    return len([span for span in load_spans(journal_filepath(config)) if span['stage'] == 'container'])
+
+
+def prediction_folder(config:dict, experiment_number:str, pdb_code:str) -> str:
+    return f"{config['PROJECT_FOLDER']}/outputs/experiments/{experiment_number}/{pdb_code}"
+
+
+def assert_prediction_layout(config:dict, experiment_number:str, pdb_code:str) -> None:
+    folder = prediction_folder(config, experiment_number, pdb_code)
+    jobname = f"{pdb_code}_{experiment_number}"
+    for filename in [f"{jobname}.done.txt", f"{jobname}_predicted_aligned_error_v1.json", 'log.txt', 'config.json', 'manifest.json']:
+        assert os.path.exists(f"{folder}/{filename}"), filename
+    assert len(glob.glob(f"{folder}/{jobname}_scores_rank_*.json")) == NUM_MODELS
+    assert len(glob.glob(f"{folder}/{jobname}_unrelaxed_rank_*.pdb")) == NUM_MODELS
+    assert verify_completion_manifest(folder)
+
+
+def test_a_sweep_runs_every_structure(tmp_path):
+    config = make_config(str(tmp_path))
+    sweep = make_sweep(str(tmp_path))
+    job_status = run_grid(config, sweep)
+
+    assert [status['status'] for status in job_status.values()] == ['done'] * STRUCTURES
+    assert journal_statuses(config, '1') == {structure['pdb_code']: 'done' for structure in sweep[1]}
+    for structure in sweep[1]:
+        assert_prediction_layout(config, '1', structure['pdb_code'])
+    assert container_runs(config) == STRUCTURES
+
+
+def test_a_resume_skips_finished_structures(tmp_path):
+    config = make_config(str(tmp_path))
+    sweep = make_sweep(str(tmp_path))
+    run_grid(config, sweep)
+
+    # every container would crash now, so the resume only succeeds if it runs none of them
+    job_status = run_grid(make_config(str(tmp_path), STUB_FAILURE_RATE=1, STUB_FAILURE_MODE='crash'), sweep)
+    assert job_status == {}
+    assert journal_statuses(config, '1') == {structure['pdb_code']: 'done' for structure in sweep[1]}
+    assert container_runs(config) == STRUCTURES
+
+
+def test_a_crash_is_failed_and_rerun_on_resume(tmp_path):
+    config = make_config(str(tmp_path), STUB_FAILURE_RATE=1, STUB_FAILURE_MODE='crash')
+    sweep = make_sweep(str(tmp_path))
+    job_status = run_grid(config, sweep)
+
+    assert [status['status'] for status in job_status.values()] == ['failed'] * STRUCTURES
+    assert set(journal_statuses(config, '1').values()) == {'failed'}
+    for structure in sweep[1]:
+        jobname = f"{structure['pdb_code']}_1"
+        assert not os.path.exists(f"{prediction_folder(config, '1', structure['pdb_code'])}/{jobname}.done.txt")
+
+    job_status = run_grid(make_config(str(tmp_path)), sweep)
+    assert [status['status'] for status in job_status.values()] == ['done'] * STRUCTURES
+    for structure in sweep[1]:
+        assert_prediction_layout(config, '1', structure['pdb_code'])
+
+
+def test_a_partial_output_without_the_done_file_is_failed(tmp_path):
+    # the stub exits cleanly, so only the missing done file shows the prediction didn't finish
+    config = make_config(str(tmp_path), STUB_FAILURE_RATE=1, STUB_FAILURE_MODE='partial')
+    sweep = make_sweep(str(tmp_path))
+    run_grid(config, sweep)
+
+    entries = list_jobs(journal_filepath(config), '1')
+    assert {entry['status'] for entry in entries.values()} == {'failed'}
+    for structure in sweep[1]:
+        assert not os.path.exists(f"{prediction_folder(config, '1', structure['pdb_code'])}/manifest.json")
+
+
+def test_a_hang_is_stopped_by_the_timeout(tmp_path):
+    config = make_config(str(tmp_path), STUB_FAILURE_RATE=1, STUB_FAILURE_MODE='hang')
+    sweep = make_sweep(str(tmp_path))
+    run_grid(config, sweep, timeout=2)
+
+    assert set(journal_statuses(config, '1').values()) == {'timeout'}
+    stopped = [span['attributes'].get('stopped') for span in load_spans(journal_filepath(config)) if span['stage'] == 'container']
+    assert stopped == ['timeout'] * STRUCTURES
+
+
+def test_a_batch_is_split_into_each_structures_folder(tmp_path):
+    config = make_config(str(tmp_path))
+    sweep = make_sweep(str(tmp_path))
+    job_status = run_grid(config, sweep, batch_size=STRUCTURES)
+
+    # the structures are batched by sequence length, so at least two of the three shared a container
+    assert len(job_status) < STRUCTURES
+    batch_ids = [span['attributes']['batch_id'] for span in load_spans(journal_filepath(config)) if span['stage'] == 'container']
+    assert sorted(set(batch_ids)) == sorted(job_status)
+    assert journal_statuses(config, '1') == {structure['pdb_code']: 'done' for structure in sweep[1]}
+    for structure in sweep[1]:
+        assert_prediction_layout(config, '1', structure['pdb_code'])
+    # only the container logs are left of the batch's input and output folders
+    assert os.listdir(f"{tmp_path}/outputs/tmp/batches") == ['logs']
+
+
+def test_an_experiment_with_the_same_msa_is_linked_from_the_cache(tmp_path):
+    config = make_config(str(tmp_path))
+    sweep = make_sweep(str(tmp_path), experiment_count=2)
+    shutil.copyfile(f"{tmp_path}/inputs/experiments/experiment1.a3m", f"{tmp_path}/inputs/experiments/experiment2.a3m")
+    run_grid(config, sweep, experiment_numbers=['1'])
+
+    # every container would crash now, so experiment 2 only finishes if it comes from the cache
+    job_status = run_grid(make_config(str(tmp_path), STUB_FAILURE_RATE=1, STUB_FAILURE_MODE='crash'), sweep, experiment_numbers=['2'])
+    assert job_status == {}
+    assert container_runs(config) == STRUCTURES
+    entries = list_jobs(journal_filepath(config), '2')
+    assert {entry['status'] for entry in entries.values()} == {'done'}
+    assert all(entry.get('cached') for entry in entries.values())
+    for structure in sweep[1]:
+        assert_prediction_layout(config, '2', structure['pdb_code'])
+
+
+def test_a_deleted_prediction_is_run_again(tmp_path):
+    config = make_config(str(tmp_path))
+    sweep = make_sweep(str(tmp_path))
+    run_grid(config, sweep)
+
+    # the journal and the completion index still list the deleted folder, which mustn't be taken as done
+    deleted_pdb_code = sweep[1][0]['pdb_code']
+    shutil.rmtree(prediction_folder(config, '1', deleted_pdb_code))
+    assert run_grid(config, sweep) == {}
+    assert list_jobs(journal_filepath(config), '1')[deleted_pdb_code].get('cached')
+    assert_prediction_layout(config, '1', deleted_pdb_code)
+
+    # and without the prediction cache to link it from, it's predicted again
+    shutil.rmtree(prediction_folder(config, '1', deleted_pdb_code))
+    shutil.rmtree(f"{tmp_path}/outputs/cache/predictions")
+    job_status = run_grid(config, sweep)
+    assert list(job_status) == [f"1/{deleted_pdb_code}"]
+    assert container_runs(config) == STRUCTURES + 1
+    assert journal_statuses(config, '1') == {structure['pdb_code']: 'done' for structure in sweep[1]}
+    assert_prediction_layout(config, '1', deleted_pdb_code)